@@ -19,13 +19,98 @@ _MYPY = False
 if _MYPY:
     import typing  # noqa: F401 # pylint: disable=import-error,unused-import,useless-suppression
 
+# If true, every instance built by a trusted constructor (``_new_trusted()``)
+# is checked against one built by the validating constructor, and the values
+# encoded by serializers that trust their input against the validated
+# encoding. Meant for tests and debugging; it costs more than validation.
+trusted_debug = False
+
+
+def check_trusted(trusted, checked):
+    """
+    Asserts that the slots of an instance built by a trusted constructor
+    equal those of ``checked``, built by the validating constructor.
+    """
+    assert type(trusted) is type(checked), (trusted, checked)
+    for cls in type(checked).__mro__:
+        for slot in vars(cls).get('__slots__', ()):
+            trusted_value = getattr(trusted, slot, None)
+            checked_value = getattr(checked, slot, None)
+            assert trusted_value == checked_value, \
+                'Trusted value %r of %s.%s differs from validated value %r.' % (
+                    trusted_value, type(checked).__name__, slot, checked_value)
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError('%s is read-only' % type(self).__name__)
+
+
+class FrozenList(list):
+    """A list that cannot be modified, held by frozen structs and unions."""
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    __setslice__ = __delslice__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = clear = _read_only
+
+    def __reduce__(self):
+        return type(self), (list(self),)
+
+
+class FrozenDict(dict):
+    """A dict that cannot be modified, held by frozen structs and unions."""
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+
+def freeze(value):
+    """
+    Returns a read-only copy of a list or dict, and of the lists and dicts
+    in it, for frozen structs and unions. Other values are returned as is.
+    """
+    if isinstance(value, list) and not isinstance(value, FrozenList):
+        return FrozenList([freeze(v) for v in value])
+    elif isinstance(value, dict) and not isinstance(value, FrozenDict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    return value
+
+
+def is_slot_state(state):
+    """
+    Returns whether ``state``, passed to the ``__setstate__()`` of a struct,
+    holds the slots of an instance pickled before structs defined
+    ``__getstate__()``, rather than its fields.
+    """
+    return (isinstance(state, tuple) and len(state) == 2 and state[0] is None
+            and isinstance(state[1], dict))
+
+
+def set_slot_state(ins, state):
+    """Restores the slots of a struct from a state accepted by is_slot_state()."""
+    for slot, value in state[1].items():
+        object.__setattr__(ins, slot, value)
+
+
+def _restore_union(cls, tag, value):
+    """Unpickles a union. See Union.__reduce__()."""
+    return cls._new_trusted(tag, value)
+
 
 class Union(object):
-    # TODO(kelkabany): Possible optimization is to remove _value if a
-    # union is composed of only symbols.
-    __slots__ = ['_tag', '_value']
+    # Only unions with members that carry a value declare a _value slot.
+    # Unions composed of only symbols fall back to this class attribute.
+    __slots__ = ['_tag']
+    _value = None  # type: typing.Any
     _tagmap = {}  # type: typing.Dict[typing.Text, bv.Validator]
     _permissioned_tagmaps = set()  # type: typing.Set[typing.Text]
+    # Set by the classes of unions generated as frozen types, which hold
+    # read-only copies of their list and map values.
+    _frozen_ = False
 
     def __init__(self, tag, value=None):
         validator = None
@@ -40,8 +125,14 @@ class Union(object):
             validator.validate_type_only(value)
         else:
             validator.validate(value)
+        if self._frozen_:
+            value = freeze(value)
         self._tag = tag
-        self._value = value
+        try:
+            self._value = value
+        except AttributeError:
+            # Symbol-only unions have no _value slot.
+            pass
 
     def __eq__(self, other):
         # Also need to check if one class is a subclass of another. If one union extends another,
@@ -58,6 +149,49 @@ class Union(object):
     def __hash__(self):
         return hash((self._tag, self._value))
 
+    def __reduce__(self):
+        # Values are restored without being validated again, and symbols as
+        # the instance shared by the class.
+        return _restore_union, (type(self), self._tag, self._value)
+
+    def __copy__(self):
+        # Unions cannot be modified once built, so a copy can be the instance.
+        return self
+
+    @classmethod
+    def _symbol(cls, tag):
+        """
+        Returns the instance of this class shared by every occurrence of the
+        symbol (void or null) tag ``tag``. Instances are cached per class so
+        that a subclass never hands out an instance of its parent.
+        """
+        symbols = cls.__dict__.get('_symbols_')
+        if symbols is None:
+            symbols = {}  # type: typing.Dict[typing.Text, Union]
+            cls._symbols_ = symbols
+        try:
+            return symbols[tag]
+        except KeyError:
+            symbol = symbols[tag] = cls(tag)
+            return symbol
+
+    @classmethod
+    def _new_trusted(cls, tag, value=None):
+        """
+        Returns an instance with ``tag`` set to the already validated
+        ``value``, without validating either. Like decoded symbols, symbols
+        are the instance shared by the class.
+        """
+        if value is None:
+            ins = cls._symbol(tag)
+        else:
+            ins = cls.__new__(cls)
+            ins._tag = tag
+            ins._value = freeze(value) if cls._frozen_ else value
+        if trusted_debug:
+            check_trusted(ins, cls(tag, value))
+        return ins
+
     @classmethod
     def _is_tag_present(cls, tag, caller_permissions):
         assert tag, 'tag value should not be None'
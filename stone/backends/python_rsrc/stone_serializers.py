@@ -1,9 +1,8 @@
 """
 Serializers for Stone data types.
 
-Currently, only JSON is officially supported, but there's an experimental
-msgpack integration. If possible, serializers should be kept separate from the
-RPC format.
+JSON and a compact binary encoding are always supported, and msgpack if the
+msgpack package is installed. If possible, serializers should be kept separate from the RPC format.
 
 This module should be dropped into a project that requires the use of Stone. In
 the future, this could be imported from a pre-installed Python package, rather
@@ -13,12 +12,18 @@ than being added to a project.
 from __future__ import absolute_import, unicode_literals
 
 import base64
+import codecs
 import collections
 import datetime
 import functools
+import itertools
 import json
+import multiprocessing
+import os
+import pickle
 import re
 import six
+import struct
 import time
 
 try:
@@ -27,9 +32,14 @@ try:
 except (ImportError, SystemError, ValueError):
     # Catch errors raised when importing a relative module when not in a package.
     # This makes testing this file directly (outside of a package) easier.
-    import stone_validators as bb  # type: ignore # noqa: F401 # pylint: disable=unused-import
+    import stone_base as bb  # type: ignore # noqa: F401 # pylint: disable=unused-import
     import stone_validators as bv  # type: ignore
 
+try:
+    import msgpack  # pylint: disable=import-error,useless-suppression
+except ImportError:
+    msgpack = None
+
 _MYPY = False
 if _MYPY:
     import typing  # noqa: F401 # pylint: disable=import-error,unused-import,useless-suppression
@@ -124,12 +134,12 @@ class StoneSerializerBase(StoneEncoderInterface):
         """
         if isinstance(validator, bv.List):
             # Because Lists are mutable, we always validate them during
-            # serialization
-            validate_f = validator.validate
+            # serialization. Each item is validated as it is encoded.
+            validate_f = validator.validate_type_only
             encode_f = self.encode_list
         elif isinstance(validator, bv.Map):
             # Also validate maps during serialization because they are also mutable
-            validate_f = validator.validate
+            validate_f = validator.validate_type_only
             encode_f = self.encode_map
         elif isinstance(validator, bv.Nullable):
             validate_f = validator.validate
@@ -224,11 +234,691 @@ class StoneSerializerBase(StoneEncoderInterface):
         """
         raise NotImplementedError
 
+# ------------------------------------------------------------------------
+# Encode plans
+#
+# Rather than dispatching on the type of every validator it visits, the
+# primitive serializer compiles each validator graph once into a tree of
+# closures ("plans"). A plan validates and encodes a single value. Attribute
+# names, permission-expanded field lists and union tag tables are computed
+# when a plan first runs, since generated modules populate them only after
+# the validators have been constructed.
+#
+# Lists and maps only check their own type up front, and encode each item with
+# an element plan, which validates it as fully as the item validator's
+# ``validate()`` does. Every item is thus validated once, as it is encoded.
+#
+# Plans may also be compiled for a field mask (see _normalize_field_mask()),
+# which limits the fields of structs and the values of union tags that are
+# encoded. A mask is carried through lists, maps and nullables to the structs
+# and unions inside them, and required fields are only checked if they are in
+# the mask. Masks often vary by request, so each validator keeps only its
+# _MAX_MASKED_PLANS most recently used masked plans, apart from its other
+# plans, and the encodings of frozen structs are not cached for masks.
+#
+# Trusted plans encode values built by trusted constructors (``_new_trusted()``)
+# or otherwise known to be valid. They skip the validation of primitives and
+# containers, but still check the types of structs and unions, and that
+# encoded required fields are present.
+#
+# Modules generated with the ``--generate-codecs`` option of the Python types
+# backend give each struct and union class ``_to_json_compat()`` and
+# ``_from_json_compat()`` methods, which encode and decode its public fields
+# directly. They are used whenever no caller permissions, alias validators
+# or redaction are in effect.
+
+# Encoding hooks that plans are compiled from. Overriding any of them in a
+# subclass disables plans for that subclass.
+_ENCODE_HOOKS = (
+    'encode_list',
+    'encode_map',
+    'encode_nullable',
+    'encode_primitive',
+    'encode_struct',
+    'encode_struct_tree',
+    'encode_union',
+)
+
+_MAX_MASKED_PLANS = 16
+
+def _normalize_field_mask(field_mask):
+    # type: (typing.Any) -> typing.Optional[tuple]
+    """
+    Converts a field mask into its canonical, hashable form: a sorted tuple
+    of (name, mask) pairs, where the mask of a name is None if its value is
+    encoded in full. Returns None if ``field_mask`` is None.
+
+    A field mask is either an iterable of dotted paths, like
+    ``['name', 'sharing_info.read_only']``, or a dict mapping names to
+    masks, where a mask of None or True selects a value in full, like
+    ``{'name': True, 'sharing_info': {'read_only': True}}``. Names refer
+    to the fields of structs, including the fields of the subtypes of a
+    struct with enumerated subtypes, and the tags of unions. A path also
+    selects the value at any of its prefixes in full.
+    """
+    if field_mask is None or field_mask is True:
+        return None
+    elif isinstance(field_mask, dict):
+        tree = field_mask
+    else:
+        tree = {}
+        for path in field_mask:
+            if not isinstance(path, six.string_types):
+                raise TypeError('field paths must be strings, got %r' % (path,))
+            node = tree  # type: typing.Optional[typing.Dict[typing.Text, typing.Any]]
+            names = path.split('.')
+            for name in names[:-1]:
+                if node is None:
+                    break
+                node = node.setdefault(name, {})
+            if node is not None:
+                node[names[-1]] = None
+    return tuple(sorted((name, _normalize_field_mask(mask))
+                        for name, mask in tree.items()))
+
+def _get_cached_encoding(value, key, encode):
+    """
+    Returns the encoding of a sealed instance of a frozen struct kept under
+    ``key``, computing it with ``encode`` on first use. Frozen instances
+    cannot change, so the encoding stays valid for the instance's lifetime.
+    """
+    encodings = value._encodings
+    if encodings is None:
+        encodings = value._encodings = {}
+    try:
+        return encodings[key]
+    except KeyError:
+        encoded = encodings[key] = encode(value)
+        return encoded
+
+def _cache_redactions(apply_redactor, maxsize):
+    """
+    Wraps the ``apply()`` method of a redactor in a least recently used cache
+    of the redacted forms of up to ``maxsize`` values. Redactors are pure, so
+    values that recur, like ids and email addresses, are only redacted once.
+    """
+    cache = collections.OrderedDict()  # type: typing.Dict[typing.Any, typing.Any]
+
+    def apply(value):
+        # Keyed by type as well, since equal values like 1 and 1.0 are not
+        # redacted alike.
+        key = (type(value), value)
+        try:
+            redacted = cache.pop(key)
+        except KeyError:
+            redacted = apply_redactor(value)
+            if len(cache) >= maxsize:
+                try:
+                    cache.popitem(last=False)
+                except KeyError:
+                    # Emptied by another thread.
+                    pass
+        except TypeError:
+            # Unhashable values are not cached.
+            return apply_redactor(value)
+        cache[key] = redacted
+        return redacted
+    return apply
+
+class _EncodePlanCompiler(object):
+    """
+    Compiles encode plans for one set of serializer options.
+
+    Plans are cached on the validators themselves, keyed by the options, so
+    that every serializer configured the same way shares them and a plan is
+    released together with its validator.
+    """
+
+    def __init__(self, permissions, alias_validators, for_msgpack, old_style, should_redact,
+                 trusted=False, redaction_cache_size=0, native_timestamps=False):
+        # type: (typing.Iterable[typing.Text], typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool, bool, bool, int, bool) -> None # noqa: E501
+        self.permissions = tuple(permissions)
+        self.alias_validators = dict(alias_validators)
+        self.for_msgpack = for_msgpack
+        self.old_style = old_style
+        self.should_redact = should_redact
+        self.trusted = trusted
+        self.redaction_cache_size = redaction_cache_size if should_redact else 0
+        self.native_timestamps = _native_timestamps(for_msgpack, native_timestamps)
+        self.key = (self.permissions, frozenset(six.iteritems(self.alias_validators)),
+                    for_msgpack, old_style, should_redact, trusted, self.redaction_cache_size,
+                    self.native_timestamps)
+        self.element_key = ('element',) + self.key
+        # Alias validators are often made anew for each call, so plans that
+        # invoke them are kept by the compiler rather than added to the
+        # shared validators, where they would never be released.
+        self.shares_plans = not self.alias_validators
+        self._plans = None if self.shares_plans else {}  # type: typing.Optional[typing.Dict[typing.Any, typing.Callable]] # noqa: E501
+        # Generated codecs only know about public fields, and neither
+        # invoke alias validators nor redact.
+        self.use_codecs = not (self.permissions or self.alias_validators or should_redact)
+
+    def encode(self, validator, value):
+        """
+        Encodes a value of the given validator. Generated codecs call this
+        for every field they do not encode inline.
+        """
+        return self.get_plan(validator)(value)
+
+    def new_object(self):
+        # type: () -> typing.Dict[typing.Text, typing.Any]
+        """Returns an empty JSON object for generated codecs to fill in."""
+        return collections.OrderedDict()
+
+    def _get_codec(self, definition, name):
+        """
+        Returns the generated codec method of a struct or union class, or
+        None if the class was generated without one.
+        """
+        if self.use_codecs and name in vars(definition):
+            return getattr(definition, name)
+        return None
+
+    def get_plan(self, validator, mask=None):
+        # type: (bv.Validator, typing.Optional[tuple]) -> typing.Callable[[typing.Any], typing.Any] # noqa: E501
+        if mask is None:
+            return self._get_cached_plan(validator, self.key, self._compile)
+        return self._get_masked_plan(
+            validator, (self.key, mask), functools.partial(self._compile, mask=mask))
+
+    def get_element_plan(self, validator, mask=None):
+        # type: (bv.Validator, typing.Optional[tuple]) -> typing.Callable[[typing.Any], typing.Any] # noqa: E501
+        """
+        Returns a plan that validates a value like ``validator.validate()``
+        and encodes the value it returns.
+        """
+        if mask is None:
+            return self._get_cached_plan(validator, self.element_key, self._compile_element)
+        return self._get_masked_plan(
+            validator, (self.element_key, mask),
+            functools.partial(self._compile_element, mask=mask))
+
+    def _get_cached_plan(self, validator, key, compile_plan):
+        if self._plans is not None:
+            try:
+                return self._plans[validator, key]
+            except KeyError:
+                plan = self._plans[validator, key] = compile_plan(validator)
+                return plan
+        plans = getattr(validator, '_encode_plans', None)
+        if plans is not None:
+            plan = plans.get(key)
+            if plan is not None:
+                return plan
+        plan = compile_plan(validator)
+        if plans is None:
+            plans = validator._encode_plans = {}
+        plans[key] = plan
+        return plan
+
+    def _get_masked_plan(self, validator, key, compile_plan):
+        """
+        Like _get_cached_plan(), but for plans compiled for a mask, of which
+        each validator keeps at most _MAX_MASKED_PLANS.
+        """
+        if self._plans is not None:
+            # Kept by the compiler, whose serializer has a single mask.
+            return self._get_cached_plan(validator, key, compile_plan)
+        plans = getattr(validator, '_masked_encode_plans', None)
+        if plans is None:
+            plans = validator._masked_encode_plans = collections.OrderedDict()
+        try:
+            plan = plans.pop(key)
+        except KeyError:
+            plan = compile_plan(validator)
+            if len(plans) >= _MAX_MASKED_PLANS:
+                try:
+                    plans.popitem(last=False)
+                except KeyError:
+                    # Emptied by another thread.
+                    pass
+        plans[key] = plan
+        return plan
+
+    def _compile(self, validator, mask=None):
+        if self.should_redact and hasattr(validator, '_redact'):
+            return self._compile_redacted(validator._redact)
+        elif isinstance(validator, bv.List):
+            return self._compile_list(validator, mask)
+        elif isinstance(validator, bv.Map):
+            return self._compile_map(validator, mask)
+        elif isinstance(validator, bv.Nullable):
+            return self._compile_nullable(validator, mask)
+        elif isinstance(validator, bv.Primitive):
+            return self._compile_primitive(validator)
+        elif isinstance(validator, bv.StructTree):
+            return self._compile_struct_tree(validator, mask)
+        elif isinstance(validator, bv.Struct):
+            return self._compile_struct(validator, mask)
+        elif isinstance(validator, bv.Union):
+            return self._compile_union(validator, mask)
+        else:
+            raise bv.ValidationError('Unsupported data type {}'.format(type(validator).__name__))
+
+    def _compile_element(self, validator, mask=None):
+        if self.should_redact and hasattr(validator, '_redact'):
+            return self.get_plan(validator)
+        elif isinstance(validator, bv.Nullable):
+            encode_value = self.get_element_plan(validator.validator, mask)
+
+            def nullable_plan(value):
+                if value is None:
+                    return None
+                return encode_value(value)
+            return nullable_plan
+        elif isinstance(validator, bv.Primitive):
+            return self._compile_primitive(validator, encode_validated=True)
+        elif isinstance(validator, bv.Struct) and not isinstance(validator, bv.StructTree) \
+                and not self.permissions and mask is None and not self.trusted \
+                and not getattr(validator.definition, '_frozen_', False):
+            # Struct plans otherwise trust that required fields were checked
+            # on assignment. Frozen structs cannot change after that, so
+            # share the cached encodings of the struct plan.
+            validate = validator.validate
+            encode_fields = self._compile_struct_fields(validator.definition)
+
+            def struct_plan(value):
+                validate(value)
+                return encode_fields(value, collections.OrderedDict())
+            return self._cache_frozen(validator.definition, struct_plan)
+        else:
+            # The remaining plans already validate values fully, or, given a
+            # mask, check the masked fields of structs.
+            return self.get_plan(validator, mask)
+
+    def _compile_redacted(self, redactor):
+        apply_redactor = redactor.apply
+        if self.redaction_cache_size:
+            apply_redactor = _cache_redactions(apply_redactor, self.redaction_cache_size)
+
+        def plan(value):
+            if isinstance(value, list):
+                return [apply_redactor(v) for v in value]
+            elif isinstance(value, dict):
+                return {k: apply_redactor(v) for k, v in value.items()}
+            else:
+                return apply_redactor(value)
+        return plan
+
+    def _compile_list(self, validator, mask=None):
+        # Because Lists are mutable, we always validate them during
+        # serialization
+        item_validator = validator.item_validator
+        if (isinstance(item_validator, bv.Primitive) and not self.trusted
+                and item_validator not in self.alias_validators
+                and not (self.should_redact and hasattr(item_validator, '_redact'))):
+            return self._compile_primitive_list(validator)
+
+        validate = validator.validate_type_only
+        encode_item = self.get_element_plan(item_validator, mask)
+
+        if self.trusted:
+            return lambda value: [encode_item(item) for item in value]
+
+        def plan(value):
+            validate(value)
+            return [encode_item(item) for item in value]
+        return plan
+
+    def _compile_primitive_list(self, validator):
+        """
+        Compiles a plan for a list of primitives, which ``validate()`` checks
+        in bulk where it can.
+        """
+        validate = validator.validate
+        if isinstance(validator.item_validator, bv.Integer):
+            # Validated items are integral, and int() turns bools into 0 or 1.
+            transform = int
+        else:
+            transform = self._compile_primitive_transform(validator.item_validator)
+
+        if transform is None:
+            return validate
+        return lambda value: list(map(transform, validate(value)))
+
+    def _compile_map(self, validator, mask=None):
+        # Also validate maps during serialization because they are also mutable
+        validate = validator.validate_type_only
+        encode_key = self.get_element_plan(validator.key_validator)
+        encode_value = self.get_element_plan(validator.value_validator, mask)
+
+        if self.trusted:
+            return lambda value: {encode_key(k): encode_value(v) for k, v in value.items()}
+
+        def plan(value):
+            validate(value)
+            return {encode_key(k): encode_value(v) for k, v in value.items()}
+        return plan
+
+    def _compile_nullable(self, validator, mask=None):
+        if isinstance(validator.validator, bv.Primitive):
+            encode_value = self.get_plan(validator.validator)
+        else:
+            encode_value = self.get_element_plan(validator.validator, mask)
+
+        def plan(value):
+            if value is None:
+                return None
+            return encode_value(value)
+        return plan
+
+    def _compile_primitive(self, validator, encode_validated=False):
+        """
+        Compiles a plan that validates a primitive value and encodes it, or
+        with ``encode_validated``, the value ``validate()`` returns.
+        """
+        validate = validator.validate
+        alias_validator = self.alias_validators.get(validator)
+        transform = self._compile_primitive_transform(validator)
+
+        if self.trusted:
+            if alias_validator is not None:
+                def trusted_plan(value):
+                    alias_validator(value)
+                    return value if transform is None else transform(value)
+                return trusted_plan
+            return (lambda value: value) if transform is None else transform
+        elif encode_validated:
+            def validated_plan(value):
+                value = validate(value)
+                if alias_validator is not None:
+                    alias_validator(value)
+                return value if transform is None else transform(value)
+            return validated_plan
+        elif alias_validator is not None:
+            def plan(value):
+                validate(value)
+                alias_validator(value)
+                return value if transform is None else transform(value)
+        elif transform is not None:
+            def plan(value):
+                validate(value)
+                return transform(value)
+        else:
+            def plan(value):
+                validate(value)
+                return value
+        return plan
+
+    def _compile_primitive_transform(self, validator):
+        # type: (bv.Primitive) -> typing.Optional[typing.Callable[[typing.Any], typing.Any]]
+        """
+        Returns a function that converts a validated value into its
+        encoding, or None if the value is encoded as is.
+        """
+        if isinstance(validator, bv.Void):
+            return lambda value: None
+        elif isinstance(validator, bv.Timestamp):
+            if self.native_timestamps:
+                return _to_msgpack_timestamp
+            return _get_timestamp_codec(validator.format).format_value
+        elif isinstance(validator, bv.Bytes) and not self.for_msgpack:
+            return lambda value: base64.b64encode(value).decode('ascii')
+        elif isinstance(validator, bv.Integer):
+            # bool is sub-class of int so it passes Integer validation,
+            # but we want the bool to be encoded as ``0`` or ``1``, rather
+            # than ``False`` or ``True``, respectively
+            return lambda value: int(value) if isinstance(value, bool) else value
+        else:
+            return None
+
+    def compile_struct_check(self, validator):
+        # type: (bv.Struct) -> typing.Callable[[typing.Any], None]
+        """
+        Returns a function that validates a struct instance before its
+        fields are encoded.
+        """
+        if self.permissions:
+            return self._compile_struct_permissions_check(validator)
+        # Fields are already validated on assignment
+        return validator.validate_type_only
+
+    def struct_fields(self, definition):
+        # type: (typing.Any) -> typing.List[typing.Tuple[typing.Text, typing.Text, bv.Validator]]
+        """
+        Returns a tuple of (field name, presence attribute name, validator)
+        for each field of ``definition`` visible to the caller, in encoding
+        order.
+        """
+        all_fields = definition._all_fields_
+        for extra_permission in self.permissions:
+            all_fields_name = '_all_{}_fields_'.format(extra_permission)
+            all_fields = all_fields + getattr(definition, all_fields_name, [])
+        return [(field_name, '_%s_present' % field_name, field_validator)
+                for field_name, field_validator in all_fields]
+
+    def _compile_struct(self, validator, mask=None):
+        validate = self.compile_struct_check(validator)
+        encode_fields = self._compile_struct_fields(validator.definition, mask)
+
+        def plan(value):
+            validate(value)
+            return encode_fields(value, collections.OrderedDict())
+        return self._cache_frozen(validator.definition, plan, mask)
+
+    def _cache_frozen(self, definition, plan, mask=None):
+        """
+        Wraps the plan of a struct generated as a frozen type so that each
+        instance is encoded only once. The encoding is kept on the instance,
+        keyed by the plan, and shared by every later call. Plans kept by the
+        compiler alone, or for a mask, are not wrapped, as the encodings would
+        outlive them.
+        """
+        if (not getattr(definition, '_frozen_', False) or not self.shares_plans
+                or mask is not None):
+            return plan
+
+        def cached_plan(value):
+            if getattr(value, '_sealed', False):
+                return _get_cached_encoding(value, plan, plan)
+            return plan(value)
+        return cached_plan
+
+    def _compile_struct_tree(self, validator, mask=None):
+        if self.permissions:
+            validate = self._compile_struct_permissions_check(validator)
+        elif mask is not None or self.trusted:
+            # Only the required fields that are encoded are checked, as they
+            # are read.
+            validate = validator.validate_type_only
+        else:
+            validate = validator.validate
+        definition = validator.definition
+        old_style = self.old_style
+        subtypes = {}  # type: typing.Dict[type, typing.Tuple[typing.Text, typing.Callable]]
+
+        def plan(value):
+            validate(value)
+            pytype = type(value)
+            try:
+                tag, encode_fields = subtypes[pytype]
+            except KeyError:
+                tag, encode_fields = subtypes[pytype] = self._compile_subtype(
+                    definition, pytype, mask)
+            if old_style:
+                return {tag: encode_fields(value, collections.OrderedDict())}
+            else:
+                d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+                d['.tag'] = tag
+                return encode_fields(value, d)
+        return self._cache_frozen(definition, plan, mask)
+
+    def _compile_subtype(self, definition, pytype, mask=None):
+        pytype = getattr(pytype, '_lazy_definition_', pytype)
+        assert pytype in definition._pytype_to_tag_and_subtype_, \
+            '%r is not a serializable subtype of %r.' % (pytype, definition)
+
+        tags, subtype = definition._pytype_to_tag_and_subtype_[pytype]
+
+        assert len(tags) == 1, tags
+        assert not isinstance(subtype, bv.StructTree), \
+            'Cannot serialize type %r because it enumerates subtypes.' % subtype.definition
+
+        return tags[0], self._compile_struct_fields(subtype.definition, mask)
+
+    def _compile_struct_permissions_check(self, validator):
+        """
+        Equivalent to ``validator.validate_with_permissions``, with the names
+        of the fields that must be present computed only once.
+        """
+        validate = validator.validate_type_only
+        validate_fields = validator.validate_fields_only
+        definition = validator.definition
+        permissions = self.permissions
+        required = []  # type: typing.List[typing.Tuple[typing.Text, ...]]
+
+        def check(value):
+            validate(value)
+            validate_fields(value)
+            if not required:
+                field_names = []  # type: typing.List[typing.Text]
+                for extra_permission in permissions:
+                    all_field_names = '_all_{}_field_names_'.format(extra_permission)
+                    field_names.extend(getattr(definition, all_field_names, ()))
+                required[:] = [tuple(field_names)]
+            for field_name in required[0]:
+                if not hasattr(value, field_name):
+                    raise bv.ValidationError("missing required field '%s'" % field_name)
+        return check
+
+    def _compile_struct_fields(self, definition, mask=None):
+        """
+        Returns a function that encodes the fields of an instance of
+        ``definition`` into a given dict and returns it. Fields are
+        only encoded if they have been explicitly set, even if there is a
+        default. Given a mask, only the fields in the mask are encoded.
+        """
+        if mask is None:
+            codec = self._get_codec(definition, '_to_json_compat')
+            if codec is not None:
+                return functools.partial(codec, self)
+
+        table = []  # type: typing.List[typing.List[typing.Tuple[typing.Text, typing.Text, typing.Callable]]] # noqa: E501
+
+        def build_table():
+            if mask is None:
+                return [(field_name, presence_key, self.get_plan(field_validator))
+                        for field_name, presence_key, field_validator
+                        in self.struct_fields(definition)]
+            field_masks = dict(mask)
+            return [(field_name, presence_key,
+                     self.get_plan(field_validator, field_masks[field_name]))
+                    for field_name, presence_key, field_validator
+                    in self.struct_fields(definition)
+                    if field_name in field_masks]
+
+        def encode_fields(value, d):
+            if not table:
+                table[:] = [build_table()]
+            for field_name, presence_key, encode_field in table[0]:
+                try:
+                    field_value = getattr(value, field_name)
+                except AttributeError as exc:
+                    raise bv.ValidationError(exc.args[0])
+
+                if field_value is not None and getattr(value, presence_key):
+                    try:
+                        d[field_name] = encode_field(field_value)
+                    except bv.ValidationError as exc:
+                        exc.add_parent(field_name)
+                        raise
+            return d
+        return encode_fields
+
+    def _compile_union(self, validator, mask=None):
+        # Fields are already validated on assignment
+        validate = validator.validate_type_only
+        definition = validator.definition
+        codec = None
+        if not self.old_style and mask is None:
+            codec = self._get_codec(definition, '_to_json_compat')
+        table = []  # type: typing.List[typing.Dict[typing.Text, typing.Callable]]
+
+        if codec is not None:
+            def codec_plan(value):
+                validate(value)
+                if value._tag is None:
+                    raise bv.ValidationError('no tag set')
+                return codec(self, value)
+            return codec_plan
+
+        def plan(value):
+            validate(value)
+            tag = value._tag
+            if tag is None:
+                raise bv.ValidationError('no tag set')
+            if not table:
+                table[:] = [self._build_union_table(definition, mask)]
+            try:
+                encode_variant = table[0][tag]
+            except KeyError:
+                raise bv.ValidationError(
+                    "caller does not have access to '{}' tag".format(tag))
+            return encode_variant(value)
+        return plan
+
+    def _build_union_table(self, definition, mask=None):
+        """
+        Maps each tag visible to the caller to a function that encodes a
+        union instance with that tag set. Tags in the tagmaps of the
+        caller's permissions take precedence over public ones, in the
+        order of the permissions. The values of tags in the mask are
+        encoded with the tag's mask; those of other tags in full.
+        """
+        tagmap = dict(definition._tagmap)
+        for extra_permission in reversed(self.permissions):
+            tagmap_name = '_{}_tagmap'.format(extra_permission)
+            tagmap.update(getattr(definition, tagmap_name, {}))
+        tag_masks = dict(mask or ())
+        return {tag: self._compile_variant(tag, field_validator, tag_masks.get(tag))
+                for tag, field_validator in tagmap.items()}
+
+    def _compile_variant(self, tag, field_validator, mask=None):
+        old_style = self.old_style
+
+        if field_validator is None or isinstance(field_validator, bv.Void):
+            if old_style:
+                return lambda value: tag
+            return lambda value: {'.tag': tag}
+
+        encode_value = self.get_plan(field_validator, mask)
+        nullable = isinstance(field_validator, bv.Nullable)
+        if nullable:
+            # Only the wrapped validator decides the layout of non-null values
+            field_validator = field_validator.validator
+        is_flat_struct = isinstance(field_validator, bv.Struct) \
+            and not isinstance(field_validator, bv.StructTree)
+
+        def encode_variant(value):
+            if nullable and value._value is None:
+                return tag if old_style else {'.tag': tag}
+
+            try:
+                encoded_val = encode_value(value._value)
+            except bv.ValidationError as exc:
+                exc.add_parent(tag)
+                raise
+
+            if old_style:
+                return {tag: encoded_val}
+            elif is_flat_struct:
+                d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+                d['.tag'] = tag
+                d.update(encoded_val)
+                return d
+            else:
+                return collections.OrderedDict((
+                    ('.tag', tag),
+                    (tag, encoded_val),
+                ))
+        return encode_variant
+
 # ------------------------------------------------------------------------
 class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
 
-    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, should_redact):
-        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool, bool) -> None # noqa: E501
+    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+                 field_mask=None, trusted=False, redaction_cache_size=0, native_timestamps=False):
+        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool, bool, typing.Any, bool, int, bool) -> None # noqa: E501
         """
         Args:
             alias_validators (``typing.Mapping``, optional): Passed
@@ -239,12 +929,72 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
                 Defaults to ``False``.
             should_redact (bool, optional): Whether to perform redaction on
                 marked fields. Defaults to ``False``.
+            field_mask (optional): The fields of the value passed to
+                ``encode`` to encode. See :func:`json_encode`. Defaults to
+                ``None``, which encodes all fields.
+            trusted (bool, optional): See the like-named property. Defaults
+                to ``False``.
+            redaction_cache_size (int, optional): The number of redacted
+                values each redacted field keeps, so that values that recur
+                are only redacted once. Only plans use the cache. Defaults to
+                0, which disables it.
+            native_timestamps (bool, optional): With ``for_msgpack``,
+                whether to encode timestamps as msgpack timestamps rather
+                than formatted strings. See :func:`msgpack_encode`.
+                Defaults to ``False``.
         """
         super(StoneToPythonPrimitiveSerializer, self).__init__(
             caller_permissions, alias_validators=alias_validators)
         self._for_msgpack = for_msgpack
+        self._native_timestamps = _native_timestamps(for_msgpack, native_timestamps)
         self._old_style = old_style
-        self.should_redact = should_redact
+        self._should_redact = should_redact
+        self._trusted = trusted
+        self._redaction_cache_size = redaction_cache_size
+        self._encode_plan_compiler = None  # type: typing.Optional[_EncodePlanCompiler]
+
+        # Plans are compiled from this class's encoding hooks, so a subclass
+        # that overrides any of them is dispatched through the hooks instead.
+        cls = type(self)
+        self._uses_encode_plans = all(
+            six.get_unbound_function(getattr(cls, hook)) is
+            six.get_unbound_function(getattr(StoneToPythonPrimitiveSerializer, hook))
+            for hook in _ENCODE_HOOKS)
+        self._field_mask = _normalize_field_mask(field_mask)
+        assert self._field_mask is None or self._uses_encode_plans, \
+            'Field masks are not supported by serializers that override encoding hooks.'
+
+    @property
+    def field_mask(self):
+        """
+        The field mask applied by ``encode`` in canonical form, or None.
+        """
+        return self._field_mask
+
+    @property
+    def trusted(self):
+        """
+        A flag associated with the serializer indicating whether the values
+        it encodes are trusted to be valid, like instances built by the
+        ``_new_trusted()`` constructors of generated classes. Only the types
+        of structs and unions, and the presence of required fields, are
+        checked. Subclasses that override an encoding hook validate values
+        regardless.
+        """
+        return self._trusted
+
+    @property
+    def should_redact(self):
+        """
+        A flag associated with the serializer indicating whether fields
+        marked for redaction should be redacted.
+        """
+        return self._should_redact
+
+    @should_redact.setter
+    def should_redact(self, should_redact):
+        self._should_redact = should_redact
+        self._encode_plan_compiler = None
 
     @property
     def for_msgpack(self):
@@ -265,7 +1015,24 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         """
         return self._old_style
 
+    def encode(self, validator, value):
+        if self._field_mask is not None:
+            encoded = self._get_encode_plan_compiler().get_plan(validator, self._field_mask)(value)
+        else:
+            encoded = self.encode_sub(validator, value)
+        if self._trusted and bb.trusted_debug:
+            checked = StoneToPythonPrimitiveSerializer(
+                self.caller_permissions, self.alias_validators, self.for_msgpack,
+                self.old_style, self.should_redact, native_timestamps=self._native_timestamps)
+            checked._field_mask = self._field_mask
+            assert encoded == checked.encode(validator, value), \
+                'Trusted encoding %r differs from validated encoding.' % (encoded,)
+        return encoded
+
     def encode_sub(self, validator, value):
+        if self._uses_encode_plans:
+            return self._get_encode_plan(validator)(value)
+
         if self.should_redact and hasattr(validator, '_redact'):
             if isinstance(value, list):
                 return [validator._redact.apply(v) for v in value]
@@ -277,19 +1044,33 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         # Encode value normally
         return super(StoneToPythonPrimitiveSerializer, self).encode_sub(validator, value)
 
-    def encode_list(self, validator, value):
-        validated_value = validator.validate(value)
+    def _get_encode_plan(self, validator):
+        # type: (bv.Validator) -> typing.Callable[[typing.Any], typing.Any]
+        """
+        Returns the compiled encode plan for ``validator`` under this
+        serializer's options. See :class:`_EncodePlanCompiler`.
+        """
+        return self._get_encode_plan_compiler().get_plan(validator)
+
+    def _get_encode_plan_compiler(self):
+        # type: () -> _EncodePlanCompiler
+        compiler = self._encode_plan_compiler
+        if compiler is None:
+            compiler = self._encode_plan_compiler = _EncodePlanCompiler(
+                self.caller_permissions.permissions, self.alias_validators,
+                self.for_msgpack, self.old_style, self.should_redact, self.trusted,
+                self._redaction_cache_size, self._native_timestamps)
+        return compiler
 
+    def encode_list(self, validator, value):
         return [self.encode_sub(validator.item_validator, value_item) for value_item in
-                validated_value]
+                value]
 
     def encode_map(self, validator, value):
-        validated_value = validator.validate(value)
-
         return {
             self.encode_sub(validator.key_validator, key):
                 self.encode_sub(validator.value_validator, value) for
-            key, value in validated_value.items()
+            key, value in value.items()
         }
 
     def encode_nullable(self, validator, value):
@@ -305,7 +1086,9 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         if isinstance(validator, bv.Void):
             return None
         elif isinstance(validator, bv.Timestamp):
-            return _strftime(value, validator.format)
+            if self._native_timestamps:
+                return _to_msgpack_timestamp(value)
+            return _get_timestamp_codec(validator.format).format_value(value)
         elif isinstance(validator, bv.Bytes):
             if self.for_msgpack:
                 return value
@@ -352,10 +1135,11 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         return d
 
     def encode_struct_tree(self, validator, value):
-        assert type(value) in validator.definition._pytype_to_tag_and_subtype_, \
-            '%r is not a serializable subtype of %r.' % (type(value), validator.definition)
+        pytype = _struct_type(value)
+        assert pytype in validator.definition._pytype_to_tag_and_subtype_, \
+            '%r is not a serializable subtype of %r.' % (pytype, validator.definition)
 
-        tags, subtype = validator.definition._pytype_to_tag_and_subtype_[type(value)]
+        tags, subtype = validator.definition._pytype_to_tag_and_subtype_[pytype]
 
         assert len(tags) == 1, tags
         assert not isinstance(subtype, bv.StructTree), \
@@ -431,9 +1215,365 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
                 ))
 
 # ------------------------------------------------------------------------
+# JSON engines
+#
+# The JSON serializers turn JSON-compatible objects into text and back with a
+# JSON engine: the json module of the standard library, or a faster library
+# if one is installed and selected. Every engine writes valid JSON that
+# decodes to the same objects, with object keys in the same order, but the
+# text may differ. The standard library, ujson and rapidjson escape non-ASCII
+# characters and separate items with ', ', for instance, while orjson writes
+# compact UTF-8.
+
+JsonEngine = collections.namedtuple('JsonEngine', ['name', 'dumps', 'loads'])
+
+# Loaders of the engines besides the standard library's, which are optional C
+# extensions whose members pylint cannot see.
+
+def _load_orjson():
+    # pylint: disable=import-error,no-member,c-extension-no-member,useless-suppression
+    import orjson
+    # orjson writes bytes, and accepts both bytes and text.
+    return (lambda obj: orjson.dumps(obj).decode('utf-8')), orjson.loads
+
+def _load_ujson():
+    # pylint: disable=import-error,no-member,c-extension-no-member,useless-suppression
+    import ujson
+    # Unlike other engines, ujson escapes forward slashes by default.
+    return functools.partial(ujson.dumps, escape_forward_slashes=False), ujson.loads
+
+def _load_rapidjson():
+    # pylint: disable=import-error,no-member,c-extension-no-member,useless-suppression
+    import rapidjson
+    return rapidjson.dumps, rapidjson.loads
+
+# Functions returning the dumps() and loads() of the engines known by name.
+# Each engine is loaded on first use.
+_json_engine_loaders = collections.OrderedDict([
+    ('json', lambda: (json.dumps, json.loads)),
+    ('orjson', _load_orjson),
+    ('ujson', _load_ujson),
+    ('rapidjson', _load_rapidjson),
+])
+_json_engines = {}  # type: typing.Dict[typing.Text, JsonEngine]
+# The name of the engine used when none is given, set by set_json_engine().
+_json_engine_defaults = {'default': 'json'}
+
+def register_json_engine(name, dumps, loads):
+    """
+    Registers a JSON engine, which can then be selected by ``name``.
+
+    Args:
+        dumps: Returns the JSON text of a JSON-compatible object, keeping
+            the order of the keys of dicts.
+        loads: Returns the object of JSON text or UTF-8 bytes. Must raise
+            ValueError for invalid JSON.
+    """
+    _json_engines[name] = JsonEngine(name, dumps, loads)
+
+def get_json_engine(name=None):
+    """
+    Returns the :class:`JsonEngine` registered or known as ``name``, or the
+    default engine if None. Raises ValueError for an unknown name, and
+    ImportError if the engine is not installed.
+    """
+    if name is None:
+        name = _json_engine_defaults['default']
+    engine = _json_engines.get(name)
+    if engine is None:
+        try:
+            loader = _json_engine_loaders[name]
+        except KeyError:
+            raise ValueError('unknown JSON engine %r' % name)
+        dumps, loads = loader()
+        engine = _json_engines[name] = JsonEngine(name, dumps, loads)
+    return engine
+
+def set_json_engine(*names):
+    """
+    Makes the first of the engines ``names`` that is installed the default
+    of the JSON serializers, e.g. ``set_json_engine('orjson', 'ujson')``,
+    and returns its name. If none is installed, the standard library's
+    engine, ``'json'``, is made the default.
+    """
+    for name in names + ('json',):
+        try:
+            get_json_engine(name)
+        except ImportError:
+            continue
+        _json_engine_defaults['default'] = name
+        return name
+
+def _json_separators(engine):
+    """
+    Returns the strings with which ``engine`` separates the items of lists
+    and the keys and values of objects.
+    """
+    return engine.dumps([0, 0])[2:-2], engine.dumps({'': 0})[3:-2]
+
+# ------------------------------------------------------------------------
+# Default number of characters buffered by StoneToJsonSerializer.iterencode()
+# before a chunk is yielded.
+_JSON_CHUNK_SIZE = 64 * 1024
+
 class StoneToJsonSerializer(StoneToPythonPrimitiveSerializer):
+
+    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+                 field_mask=None, trusted=False, json_engine=None, redaction_cache_size=0):
+        """
+        Args:
+            json_engine (str, optional): The name of the JSON engine that
+                writes the JSON text. Defaults to the default engine; see
+                :func:`set_json_engine`.
+
+        See ``StoneToPythonPrimitiveSerializer.__init__`` for the other
+        arguments.
+        """
+        super(StoneToJsonSerializer, self).__init__(
+            caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+            field_mask, trusted, redaction_cache_size)
+        self._json_engine = get_json_engine(json_engine)
+        self._dumps = self._json_engine.dumps
+        self._item_sep, self._key_sep = _json_separators(self._json_engine)
+
     def encode(self, validator, value):
-        return json.dumps(super(StoneToJsonSerializer, self).encode(validator, value))
+        if (getattr(value, '_sealed', False) and self._uses_encode_plans
+                and self._field_mask is None
+                and self._get_encode_plan_compiler().shares_plans
+                and not (self._trusted and bb.trusted_debug)):
+            # Frozen structs keep their JSON text as well as their encoding.
+            plan = self._get_encode_plan_compiler().get_plan(validator)
+            dumps = self._dumps
+            return _get_cached_encoding(
+                value, ('json', self._json_engine.name, plan), lambda value: dumps(plan(value)))
+        return self._dumps(super(StoneToJsonSerializer, self).encode(validator, value))
+
+    def iterencode(self, validator, value, chunk_size=_JSON_CHUNK_SIZE):
+        """
+        Yields the JSON encoding of ``value`` in chunks of roughly
+        ``chunk_size`` characters. Joined together, the chunks equal the
+        result of :meth:`encode`.
+
+        Structs, lists, maps and nullables are written out piece by piece, so
+        that only a single list item or map entry is held in its encoded
+        form at a time. If validation fails partway through, the chunks
+        yielded so far hold incomplete JSON.
+        """
+        if not self._uses_encode_plans or self._field_mask is not None:
+            yield self.encode(validator, value)
+            return
+
+        buf = []  # type: typing.List[typing.Text]
+        buf_size = 0
+        for s in self._iterencode(validator, value):
+            buf.append(s)
+            buf_size += len(s)
+            if buf_size >= chunk_size:
+                yield ''.join(buf)
+                buf = []
+                buf_size = 0
+        if buf:
+            yield ''.join(buf)
+
+    def _iterencode(self, validator, value):
+        # Mirrors the dispatch in _EncodePlanCompiler._compile().
+        if self.should_redact and hasattr(validator, '_redact'):
+            pass
+        elif isinstance(validator, bv.List):
+            return self._iterencode_list(validator, value)
+        elif isinstance(validator, bv.Map):
+            return self._iterencode_map(validator, value)
+        elif isinstance(validator, bv.Nullable):
+            return self._iterencode_nullable(validator, value)
+        elif isinstance(validator, bv.Struct) and not isinstance(validator, bv.StructTree):
+            return self._iterencode_struct(validator, value)
+        return iter((self._dumps(self._get_encode_plan(validator)(value)),))
+
+    def _iterencode_list(self, validator, value):
+        # Items are encoded one at a time, each in one piece.
+        compiler = self._get_encode_plan_compiler()
+        if isinstance(validator.item_validator, bv.Primitive):
+            # Primitive items are validated together, as encode() does.
+            value = compiler.get_plan(validator)(value)
+            encode_item = lambda item: item  # noqa: E731
+        else:
+            encode_item = compiler.get_element_plan(validator.item_validator)
+            validator.validate_type_only(value)
+        dumps = self._dumps
+        item_sep = self._item_sep
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield item_sep
+            yield dumps(encode_item(item))
+        yield ']'
+
+    def _iterencode_map(self, validator, value):
+        compiler = self._get_encode_plan_compiler()
+        encode_key = compiler.get_element_plan(validator.key_validator)
+        encode_value = compiler.get_element_plan(validator.value_validator)
+        validator.validate_type_only(value)
+        dumps = self._dumps
+        item_sep = self._item_sep
+        yield '{'
+        for i, (k, v) in enumerate(value.items()):
+            if i:
+                yield item_sep
+            # Let the engine render the key exactly as it would in a dict.
+            yield dumps({encode_key(k): encode_value(v)})[1:-1]
+        yield '}'
+
+    def _iterencode_nullable(self, validator, value):
+        # The wrapped validator's own branch checks the value.
+        if value is None:
+            yield 'null'
+        else:
+            for s in self._iterencode(validator.validator, value):
+                yield s
+
+    def _iterencode_struct(self, validator, value):
+        compiler = self._get_encode_plan_compiler()
+        compiler.compile_struct_check(validator)(value)
+        item_sep, key_sep = self._item_sep, self._key_sep
+        yield '{'
+        sep = ''
+        for field_name, presence_key, field_validator in compiler.struct_fields(
+                validator.definition):
+            try:
+                field_value = getattr(value, field_name)
+            except AttributeError as exc:
+                raise bv.ValidationError(exc.args[0])
+
+            if field_value is not None and getattr(value, presence_key):
+                yield '{}{}{}'.format(sep, self._dumps(field_name), key_sep)
+                sep = item_sep
+                try:
+                    for s in self._iterencode(field_validator, field_value):
+                        yield s
+                except bv.ValidationError as exc:
+                    exc.add_parent(field_name)
+                    raise
+        yield '}'
+
+# --------------------------------------------------------------
+# Observers
+#
+# An observer attached to a StoneEncoder or StoneDecoder is told about each
+# call, e.g. to record metrics of the data types and routes that take the
+# most time to encode and decode. Encoders and decoders without an observer
+# only check that they have none.
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+class SerializationObserver(object):
+    """
+    Receives a report of each call of the :class:`StoneEncoder` or
+    :class:`StoneDecoder` it is attached to. Reports are made once a call
+    returns, and not for calls that raise. The methods of this class do
+    nothing, so subclasses only override those they need.
+
+    An observer may receive reports from several threads at once.
+    """
+
+    # If set, the struct instances encoded or decoded by each call are
+    # counted by class name. Counting walks the value once more, outside of
+    # the time reported.
+    count_structs = False
+
+    def on_encode(self, name, seconds, size, struct_counts):
+        # type: (typing.Text, float, typing.Optional[int], typing.Optional[typing.Dict[typing.Text, int]]) -> None # noqa: E501
+        """
+        Called after a value is encoded.
+
+        Args:
+            name (str): The data type encoded, as given by
+                :func:`data_type_name`, or for the route methods of an
+                encoder, the route and part, like ``'get_metadata_v2.arg'``.
+            seconds (float): The wall time taken by the call. For
+                ``iterencode()`` and ``encode_to()``, only the time spent
+                producing chunks counts.
+            size (int): The number of characters encoded, or None for
+                ``encode_compat()``.
+            struct_counts (dict): The number of instances of each struct
+                class encoded, if ``count_structs`` is set, or None.
+        """
+
+    def on_decode(self, name, seconds, size, struct_counts):
+        # type: (typing.Text, float, typing.Optional[int], typing.Optional[typing.Dict[typing.Text, int]]) -> None # noqa: E501
+        """
+        Called after a value is decoded, with the number of characters
+        decoded as its size, or None for ``decode_compat()``. See
+        :meth:`on_encode` for the other arguments.
+        """
+
+def data_type_name(data_type):
+    # type: (bv.Validator) -> typing.Text
+    """
+    Returns a short name for a data type: the name of the class of a struct
+    or union, the names of the items of lists and maps, like ``List(File)``
+    and ``Map(String, Int64)``, and a ``?`` suffix for nullables.
+    """
+    if isinstance(data_type, (bv.Struct, bv.Union)):
+        return data_type.definition.__name__
+    elif isinstance(data_type, bv.List):
+        return 'List({})'.format(data_type_name(data_type.item_validator))
+    elif isinstance(data_type, bv.Map):
+        return 'Map({}, {})'.format(data_type_name(data_type.key_validator),
+                                    data_type_name(data_type.value_validator))
+    elif isinstance(data_type, bv.Nullable):
+        return '{}?'.format(data_type_name(data_type.validator))
+    else:
+        return type(data_type).__name__
+
+def _route_part_name(route, part):
+    # type: (bb.Route, typing.Text) -> typing.Text
+    """
+    Names a part of a route the way generated modules name routes, with a
+    version suffix for versions other than 1.
+    """
+    if route.version == 1:
+        return '{}.{}'.format(route.name, part)
+    return '{}_v{}.{}'.format(route.name, route.version, part)
+
+def _count_structs(data_type, value, counts):
+    """
+    Adds the struct instances in a valid value of ``data_type`` to
+    ``counts``, by class name.
+    """
+    if value is None:
+        return
+    elif isinstance(data_type, bv.Nullable):
+        _count_structs(data_type.validator, value, counts)
+    elif isinstance(data_type, bv.List):
+        item_validator = data_type.item_validator
+        for item in value:
+            _count_structs(item_validator, item, counts)
+    elif isinstance(data_type, bv.Map):
+        value_validator = data_type.value_validator
+        for item in value.values():
+            _count_structs(value_validator, item, counts)
+    elif isinstance(data_type, bv.Struct):
+        # The class of the value, rather than of the data type, knows the
+        # fields of subtypes.
+        definition = type(value)
+        counts[definition.__name__] += 1
+        for field_name, field_validator in definition._all_fields_:
+            if getattr(value, '_%s_present' % field_name):
+                _count_structs(field_validator, getattr(value, field_name), counts)
+    elif isinstance(data_type, bv.Union):
+        tag_validator = type(value)._tagmap.get(value._tag)
+        if tag_validator is not None:
+            _count_structs(tag_validator, value._value, counts)
+
+def _struct_counts(observer, data_type, value):
+    """
+    Returns the struct counts that ``observer`` receives for ``value``.
+    """
+    if not observer.count_structs:
+        return None
+    counts = collections.Counter()  # type: typing.Dict[typing.Text, int]
+    _count_structs(data_type, value, counts)
+    return dict(counts)
 
 # --------------------------------------------------------------
 # JSON Encoder
@@ -442,7 +1582,7 @@ class StoneToJsonSerializer(StoneToPythonPrimitiveSerializer):
 # functions.
 
 def json_encode(data_type, obj, caller_permissions=None, alias_validators=None, old_style=False,
-                should_redact=False):
+                should_redact=False, field_mask=None, trusted=False, json_engine=None):
     """Encodes an object into JSON based on its type.
 
     Args:
@@ -453,6 +1593,22 @@ def json_encode(data_type, obj, caller_permissions=None, alias_validators=None,
         alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
             Custom validation functions. These must raise bv.ValidationError on
             failure.
+        field_mask: If set, only these fields of obj are encoded. Either a
+            list of dotted field paths, like ``['name', 'info.size']``, or a
+            nested dict of field names, like
+            ``{'name': True, 'info': {'size': True}}``. The mask is applied
+            through lists, maps, nullables, union tags and the subtypes of
+            structs. Required fields are only checked if they are in the
+            mask.
+        trusted (bool): If trusted, then obj is assumed to be valid, e.g.
+            because it was built with the ``_new_trusted()`` constructors of
+            generated classes, and only the types of structs and unions and
+            the presence of required fields are checked. If
+            ``stone_base.trusted_debug`` is set, the result is compared with
+            the result of a validating encode.
+        json_engine (str): The name of the JSON engine that writes the JSON
+            text. Defaults to the default engine; see
+            :func:`set_json_engine`.
 
     Returns:
         str: JSON-encoded object.
@@ -497,11 +1653,81 @@ def json_encode(data_type, obj, caller_permissions=None, alias_validators=None,
     """
     for_msgpack = False
     serializer = StoneToJsonSerializer(
-        caller_permissions, alias_validators, for_msgpack, old_style, should_redact)
+        caller_permissions, alias_validators, for_msgpack, old_style, should_redact, field_mask,
+        trusted, json_engine)
     return serializer.encode(data_type, obj)
 
+# The number of redacted values each redacted field keeps for
+# json_encode_for_log().
+_LOG_REDACTION_CACHE_SIZE = 1024
+
+def json_encode_for_log(data_type, obj, caller_permissions=None, old_style=False,
+                        redaction_cache_size=_LOG_REDACTION_CACHE_SIZE, json_engine=None):
+    """
+    Encodes an object into JSON for logging, with the fields marked for
+    redaction redacted.
+
+    Objects being logged have usually been validated already, when they were
+    built or decoded, so obj is trusted as if by ``json_encode(...,
+    trusted=True)`` and alias validators are not run. The redacted forms of
+    recurring values are cached; see ``StoneToPythonPrimitiveSerializer``.
+
+    Args:
+        redaction_cache_size (int): The number of redacted values each
+            redacted field keeps. 0 disables the cache.
+
+    See :func:`json_encode` for the other arguments.
+    """
+    for_msgpack = False
+    should_redact = True
+    field_mask = None
+    trusted = True
+    serializer = StoneToJsonSerializer(
+        caller_permissions, None, for_msgpack, old_style, should_redact, field_mask, trusted,
+        json_engine, redaction_cache_size)
+    return serializer.encode(data_type, obj)
+
+def json_encode_iter(data_type, obj, caller_permissions=None, alias_validators=None,
+                     old_style=False, should_redact=False, chunk_size=_JSON_CHUNK_SIZE,
+                     json_engine=None):
+    """
+    Like :func:`json_encode`, but returns an iterator over chunks of the
+    encoded JSON, e.g. to serve as the body of a WSGI response. Lists and
+    maps are encoded an item at a time, so memory use does not grow with
+    their length. See :meth:`StoneToJsonSerializer.iterencode`.
+
+    Args:
+        chunk_size (int): The approximate number of characters in each chunk.
+
+    See :func:`json_encode` for the other arguments.
+    """
+    for_msgpack = False
+    serializer = StoneToJsonSerializer(
+        caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+        json_engine=json_engine)
+    return serializer.iterencode(data_type, obj, chunk_size)
+
+def json_encode_to(stream, data_type, obj, caller_permissions=None, alias_validators=None,
+                   old_style=False, should_redact=False, chunk_size=_JSON_CHUNK_SIZE,
+                   json_engine=None):
+    """
+    Writes the JSON encoding of ``obj`` to ``stream`` incrementally. The
+    text written is identical to the result of :func:`json_encode`.
+
+    Args:
+        stream: A file-like object with a ``write`` method accepting text.
+            Wrap binary files and sockets with ``io.TextIOWrapper``. The
+            output is ASCII only, unless the JSON engine writes UTF-8.
+
+    See :func:`json_encode_iter` for the other arguments.
+    """
+    for chunk in json_encode_iter(data_type, obj, caller_permissions, alias_validators,
+                                  old_style, should_redact, chunk_size, json_engine):
+        stream.write(chunk)
+
 def json_compat_obj_encode(data_type, obj, caller_permissions=None, alias_validators=None,
-                           old_style=False, for_msgpack=False, should_redact=False):
+                           old_style=False, for_msgpack=False, should_redact=False,
+                           field_mask=None, trusted=False):
     """Encodes an object into a JSON-compatible dict based on its type.
 
     Args:
@@ -509,6 +1735,10 @@ def json_compat_obj_encode(data_type, obj, caller_permissions=None, alias_valida
         obj (object): Object to be serialized.
         caller_permissions (list): The list of raw-string caller permissions
             with which to serialize.
+        field_mask: If set, only these fields of obj are encoded. See
+            json_encode().
+        trusted (bool): If trusted, then obj is assumed to be valid. See
+            json_encode().
 
     Returns:
         An object that when passed to json.dumps() will produce a string
@@ -517,19 +1747,385 @@ def json_compat_obj_encode(data_type, obj, caller_permissions=None, alias_valida
     See json_encode() for additional information about validation.
     """
     serializer = StoneToPythonPrimitiveSerializer(
-        caller_permissions, alias_validators, for_msgpack, old_style, should_redact)
+        caller_permissions, alias_validators, for_msgpack, old_style, should_redact, field_mask,
+        trusted)
     return serializer.encode(data_type, obj)
 
+class StoneEncoder(object):
+    """
+    A reusable encoder, configured once with the options of
+    :func:`json_encode`.
+
+    The work of resolving the fields visible to the caller and the encoding
+    of each data type is shared by all calls. An encoder may be used by
+    several threads at once.
+
+    If an ``observer`` is given, it receives a report of each call; see
+    :class:`SerializationObserver`.
+    """
+
+    def __init__(self, caller_permissions=None, alias_validators=None, old_style=False,
+                 should_redact=False, trusted=False, json_engine=None, observer=None):
+        for_msgpack = False
+        field_mask = None
+        self._serializer = StoneToJsonSerializer(
+            caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+            field_mask, trusted, json_engine)
+        # The encoding of the serializer before it is written out as JSON,
+        # checked as that of encode().
+        self._encode_compat = super(StoneToJsonSerializer, self._serializer).encode
+        self._observer = observer  # type: typing.Optional[SerializationObserver]
+
+    def encode(self, data_type, obj):
+        """Like :func:`json_encode`."""
+        if self._observer is None:
+            return self._serializer.encode(data_type, obj)
+        return self._observe_encode(data_type_name(data_type), data_type, obj)
+
+    def encode_compat(self, data_type, obj):
+        """Like :func:`json_compat_obj_encode`."""
+        if self._observer is None:
+            return self._encode_compat(data_type, obj)
+        start = _timer()
+        encoded = self._encode_compat(data_type, obj)
+        seconds = _timer() - start
+        self._observer.on_encode(data_type_name(data_type), seconds, None,
+                                 _struct_counts(self._observer, data_type, obj))
+        return encoded
+
+    def encode_route_arg(self, route, obj):
+        """Encodes the argument of a route."""
+        return self._encode_route(route, 'arg', route.arg_type, obj)
+
+    def encode_route_result(self, route, obj):
+        """Encodes the result of a route."""
+        return self._encode_route(route, 'result', route.result_type, obj)
+
+    def encode_route_error(self, route, obj):
+        """Encodes the error of a route."""
+        return self._encode_route(route, 'error', route.error_type, obj)
+
+    def _encode_route(self, route, part, data_type, obj):
+        if self._observer is None:
+            return self._serializer.encode(data_type, obj)
+        return self._observe_encode(_route_part_name(route, part), data_type, obj)
+
+    def _observe_encode(self, name, data_type, obj):
+        start = _timer()
+        encoded = self._serializer.encode(data_type, obj)
+        seconds = _timer() - start
+        self._observer.on_encode(name, seconds, len(encoded),
+                                 _struct_counts(self._observer, data_type, obj))
+        return encoded
+
+    def iterencode(self, data_type, obj, chunk_size=_JSON_CHUNK_SIZE):
+        """Like :func:`json_encode_iter`."""
+        chunks = self._serializer.iterencode(data_type, obj, chunk_size)
+        if self._observer is None:
+            return chunks
+        return self._observe_iterencode(data_type, obj, chunks)
+
+    def _observe_iterencode(self, data_type, obj, chunks):
+        seconds = 0.0
+        size = 0
+        while True:
+            start = _timer()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                seconds += _timer() - start
+                break
+            seconds += _timer() - start
+            size += len(chunk)
+            yield chunk
+        self._observer.on_encode(data_type_name(data_type), seconds, size,
+                                 _struct_counts(self._observer, data_type, obj))
+
+    def encode_to(self, stream, data_type, obj, chunk_size=_JSON_CHUNK_SIZE):
+        """Like :func:`json_encode_to`."""
+        for chunk in self.iterencode(data_type, obj, chunk_size):
+            stream.write(chunk)
+
+# --------------------------------------------------------------
+# Parallel JSON Encoder
+#
+# json_encode_parallel() sends the items of a long top-level list to worker
+# processes a chunk at a time. Each worker returns the JSON text of the items
+# of its chunk, which are joined the way the JSON engine joins list items, so
+# the result equals that of json_encode(). Items are pickled on their way to the
+# workers; see the __getstate__() of generated structs. Pickling costs about as
+# much as encoding, so when json_encode_parallel() starts a pool that forks its
+# workers, the list is instead left where the workers inherit it, and chunks
+# only name a range of its items.
+#
+# The item validator is sent pickled, and each worker keeps a list validator
+# for each item validator it unpickles, keyed by its pickled form, so that
+# the plans cached on them are compiled once per worker rather than once per
+# chunk.
+
+# Lists with fewer items are encoded in-process.
+_PARALLEL_MIN_ITEMS = 20000
+# The number of list items sent to a worker at a time.
+_PARALLEL_CHUNK_ITEMS = 5000
+
+_worker_list_validators = {}  # type: typing.Dict[bytes, bv.List]
+_MAX_WORKER_LIST_VALIDATORS = 16
+
+# Lists encoded by forked workers, by the token their chunks carry.
+_forked_lists = {}  # type: typing.Dict[int, typing.Sequence]
+_forked_list_tokens = itertools.count()
+
+def _pool_start_method():
+    """
+    Returns how the workers of a pool started for a call are started: as set
+    by the application, or else by default. Unlike get_start_method() without
+    allow_none, this does not fix the start method for the application.
+    """
+    if six.PY2:
+        return 'fork' if os.name == 'posix' else 'spawn'
+    return (multiprocessing.get_start_method(allow_none=True)
+            or multiprocessing.get_all_start_methods()[0])
+
+def _encode_list_chunk(args):
+    """Returns the JSON text of a chunk of list items, without brackets."""
+    (caller_permissions, old_style, should_redact, field_mask, trusted, json_engine,
+     pickled_item_validator, items, span) = args
+    if items is None:
+        token, start, stop = span
+        items = _forked_lists[token][start:stop]
+    list_validator = _worker_list_validators.get(pickled_item_validator)
+    if list_validator is None:
+        if len(_worker_list_validators) >= _MAX_WORKER_LIST_VALIDATORS:
+            _worker_list_validators.clear()
+        list_validator = _worker_list_validators[pickled_item_validator] = bv.List(
+            pickle.loads(pickled_item_validator))
+    serializer = StoneToPythonPrimitiveSerializer(
+        caller_permissions, None, False, old_style, should_redact, field_mask, trusted)
+    plan = serializer._get_encode_plan_compiler().get_plan(
+        list_validator, serializer.field_mask)
+    return get_json_engine(json_engine).dumps(plan(items))[1:-1]
+
+def json_encode_parallel(data_type, obj, caller_permissions=None, alias_validators=None,
+                         old_style=False, should_redact=False, field_mask=None, trusted=False,
+                         json_engine=None, pool=None, processes=None,
+                         chunk_items=_PARALLEL_CHUNK_ITEMS, min_items=_PARALLEL_MIN_ITEMS):
+    """
+    Like :func:`json_encode`, but encodes the items of a list in several
+    processes. The result is identical.
+
+    Only lists with at least ``min_items`` items are split up; other values
+    are encoded in-process. So are values encoded with alias validators,
+    which are looked up by the identity of validators, and that does not
+    survive pickling.
+
+    Items must be picklable, and the modules that define their classes
+    importable by the workers, which must also know the JSON engine. Items
+    are not pickled if the pool started for the call forks its workers. If an
+    item fails validation, the error raised is that of an invalid item, not
+    necessarily the first.
+
+    Args:
+        pool: A ``multiprocessing.Pool``, ``concurrent.futures`` executor or
+            other object whose ``map(func, iterable)`` returns the results
+            of the calls in order. Since starting processes is costly, pass
+            a pool that lives as long as the application. If None, a
+            ``multiprocessing.Pool`` is started for the call.
+        processes (int): The number of processes of the pool started if
+            ``pool`` is None. Defaults to the number of CPUs. With fewer
+            than two, the value is encoded in-process.
+        chunk_items (int): The number of items encoded by a worker at a time.
+        min_items (int): The length from which lists are encoded in parallel.
+
+    See :func:`json_encode` for the other arguments.
+    """
+    validator = data_type
+    if isinstance(validator, bv.Nullable) and obj is not None:
+        validator = validator.validator
+    if pool is None and processes is None:
+        processes = multiprocessing.cpu_count()
+    if (not isinstance(validator, bv.List) or alias_validators
+            or not isinstance(obj, (list, tuple)) or len(obj) < min_items
+            or (pool is None and processes < 2)):
+        return json_encode(data_type, obj, caller_permissions, alias_validators, old_style,
+                           should_redact, field_mask, trusted, json_engine)
+
+    # Workers look the engine up by name, not relying on their default.
+    engine = get_json_engine(json_engine)
+    item_sep, _ = _json_separators(engine)
+    validator.validate_type_only(obj)
+    pickled_item_validator = pickle.dumps(validator.item_validator, pickle.HIGHEST_PROTOCOL)
+    options = (caller_permissions, old_style, should_redact, field_mask, trusted, engine.name,
+               pickled_item_validator)
+    starts = six.moves.range(0, len(obj), chunk_items)
+    if pool is not None:
+        texts = pool.map(_encode_list_chunk,
+                         [options + (obj[i:i + chunk_items], None) for i in starts])
+    else:
+        token = None
+        start_method = _pool_start_method()
+        if start_method == 'fork':
+            token = next(_forked_list_tokens)
+            _forked_lists[token] = obj
+            chunks = [options + (None, (token, i, i + chunk_items)) for i in starts]
+        else:
+            chunks = [options + (obj[i:i + chunk_items], None) for i in starts]
+        try:
+            if six.PY2:
+                pool = multiprocessing.Pool(processes)
+            else:
+                pool = multiprocessing.get_context(start_method).Pool(processes)
+            try:
+                texts = pool.map(_encode_list_chunk, chunks)
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            _forked_lists.pop(token, None)
+    return '[{}]'.format(item_sep.join(texts))
+
 # --------------------------------------------------------------
 # JSON Decoder
+def _make_union(definition, tag, val):
+    """
+    Symbols decode to the instance shared by the union class rather than to a
+    new one. Definitions that are not derived from bb.Union are constructed.
+    """
+    if val is None and hasattr(definition, '_symbol'):
+        return definition._symbol(tag)
+    return definition(tag, val)
+
+
+# Lazily decoded structs
+#
+# In lazy mode, the decoder returns structs as instances of a subclass of
+# their generated class, created once per class, that keeps the raw value of
+# each field until it is first read. The subclass shadows the ``_<field>_value``
+# slots of the generated class with properties, so the field properties,
+# __repr__() and generated codecs, all of which read those slots, see decoded
+# values. Fields are marked present up front.
+
+def _struct_type(value):
+    """Returns the generated class of a struct, even if decoded lazily."""
+    pytype = type(value)
+    return getattr(pytype, '_lazy_definition_', pytype)
+
+_lazy_struct_classes = {}  # type: typing.Dict[type, type]
+
+def _get_lazy_struct_class(definition):
+    """
+    Returns the lazily decoded subclass of a generated struct class,
+    creating it on first use.
+    """
+    lazy_class = _lazy_struct_classes.get(definition)
+    if lazy_class is None:
+        lazy_class = _lazy_struct_classes[definition] = _make_lazy_struct_class(definition)
+    return lazy_class
+
+def _struct_slot_field_names(definition):
+    """
+    Returns the names of all fields of a generated struct class, including
+    inherited fields and fields omitted for some callers, in the order of
+    their slots.
+    """
+    field_names = []  # type: typing.List[typing.Text]
+    for cls in reversed(definition.__mro__):
+        for slot in vars(cls).get('__slots__', ()):
+            if slot.startswith('_') and slot.endswith('_value'):
+                field_names.append(slot[1:-len('_value')])
+    return field_names
+
+def _struct_presence_bits(definition, field_names):
+    """
+    Returns the presence bit of each field of a generated struct class, or
+    None if it was generated without a presence bitmask.
+    """
+    if not hasattr(definition, '_required_mask_'):
+        return None
+    # Classes generated with a presence bitmask give the i-th field,
+    # counting inherited fields first, the i-th bit.
+    return {field_name: 1 << i for i, field_name in enumerate(field_names)}
+
+def _make_lazy_struct_class(definition):
+    field_names = _struct_slot_field_names(definition)
+
+    def __init__(self, *args, **kwargs):
+        self._lazy_fields = {}
+        self._lazy_decoder = None
+        definition.__init__(self, *args, **kwargs)
+
+    # Pickles and copies are instances of the generated class, with every
+    # field decoded.
+    def __reduce__(self):
+        return _restore_struct, (definition, self.__getstate__())
+
+    def __copy__(self):
+        return _restore_struct(definition, self.__getstate__())
+
+    namespace = {
+        '__slots__': ('_lazy_fields', '_lazy_decoder'),
+        '__init__': __init__,
+        '__reduce__': __reduce__,
+        '__copy__': __copy__,
+        '__module__': definition.__module__,
+        '_lazy_definition_': definition,
+        '_lazy_presence_bits_': _struct_presence_bits(definition, field_names),
+    }  # type: typing.Dict[str, typing.Any]
+    for field_name in field_names:
+        value_slot = '_%s_value' % field_name
+        namespace[value_slot] = _make_lazy_value_property(
+            field_name, getattr(definition, value_slot))
+    return type(str(definition.__name__), (definition,), namespace)
+
+def _restore_struct(cls, state):
+    """Unpickles a lazily decoded struct as an instance of ``cls``."""
+    ins = cls.__new__(cls)
+    ins.__setstate__(state)
+    return ins
+
+def _make_lazy_value_property(field_name, slot):
+    def get_value(self):
+        if field_name in self._lazy_fields:
+            field_data_type, raw_value = self._lazy_fields[field_name]
+            try:
+                value = self._lazy_decoder.json_compat_obj_decode_helper(
+                    field_data_type, raw_value)
+                # Validates the value like an eager decode and, through
+                # set_value(), stores it. Frozen instances are unsealed
+                # meanwhile.
+                sealed = getattr(self, '_sealed', False)
+                if sealed:
+                    self._sealed = False
+                try:
+                    setattr(self, field_name, value)
+                finally:
+                    if sealed:
+                        self._sealed = True
+            except bv.ValidationError as e:
+                e.add_parent(field_name)
+                raise
+        return slot.__get__(self, type(self))
+
+    def set_value(self, value):
+        slot.__set__(self, value)
+        self._lazy_fields.pop(field_name, None)
+
+    return property(get_value, set_value)
+
+
 class PythonPrimitiveToStoneDecoder(object):
-    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, strict):
+    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, strict,
+                 lazy=False):
         self.caller_permissions = (caller_permissions if
             caller_permissions else CallerPermissionsDefault())
         self.alias_validators = alias_validators
         self.strict = strict
+        self.lazy = lazy
         self._old_style = old_style
         self._for_msgpack = for_msgpack
+        # See _EncodePlanCompiler.use_codecs
+        self._use_codecs = not (self.caller_permissions.permissions or alias_validators)
+        # Maps struct classes to the result of get_struct_fields()
+        self._struct_fields = {}  # type: typing.Dict[type, typing.Tuple[typing.List[typing.Tuple[typing.Text, bv.Validator]], typing.Set[typing.Text], typing.Set[typing.Text]]] # noqa: E501
 
     @property
     def for_msgpack(self):
@@ -549,6 +2145,39 @@ class PythonPrimitiveToStoneDecoder(object):
         """
         return self._old_style
 
+    def get_struct_fields(self, definition):
+        """
+        Returns the list of (field name, validator) pairs and the set of field
+        names of a struct class that are visible to the caller, and the set
+        of those names that are only visible due to the caller's
+        permissions. They are computed once per class.
+        """
+        try:
+            return self._struct_fields[definition]
+        except KeyError:
+            pass
+        all_fields = definition._all_fields_
+        extra_field_names = set()  # type: typing.Set[typing.Text]
+        for extra_permission in self.caller_permissions.permissions:
+            all_extra_fields = '_all_{}_fields_'.format(extra_permission)
+            all_fields = all_fields + getattr(definition, all_extra_fields, [])
+            all_extra_field_names = '_all_{}_field_names_'.format(extra_permission)
+            extra_field_names.update(getattr(definition, all_extra_field_names, ()))
+        all_field_names = definition._all_field_names_.union(extra_field_names)
+        # Concurrent callers may both get here, but compute the same result.
+        struct_fields = self._struct_fields[definition] = (
+            all_fields, all_field_names, extra_field_names)
+        return struct_fields
+
+    def decode(self, data_type, obj):
+        """
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        if isinstance(data_type, bv.Primitive):
+            return self.make_stone_friendly(data_type, obj, True)
+        else:
+            return self.json_compat_obj_decode_helper(data_type, obj)
+
     def json_compat_obj_decode_helper(self, data_type, obj):
         """
         See json_compat_obj_decode() for argument descriptions.
@@ -588,43 +2217,88 @@ class PythonPrimitiveToStoneDecoder(object):
         elif not isinstance(obj, dict):
             raise bv.ValidationError('expected object, got %s' %
                                      bv.generic_type_name(obj))
-        all_fields = data_type.definition._all_fields_
-        for extra_permission in self.caller_permissions.permissions:
-            all_extra_fields = '_all_{}_fields_'.format(extra_permission)
-            all_fields = all_fields + getattr(data_type.definition, all_extra_fields, [])
+        if self._use_codecs and not self.lazy and \
+                '_from_json_compat' in vars(data_type.definition):
+            return data_type.definition._from_json_compat(self, obj)
+        all_fields, all_field_names, _ = self.get_struct_fields(data_type.definition)
 
         if self.strict:
-            all_field_names = data_type.definition._all_field_names_
-            for extra_permission in self.caller_permissions.permissions:
-                all_extra_field_names = '_all_{}_field_names_'.format(extra_permission)
-                all_field_names = all_field_names.union(
-                    getattr(data_type.definition, all_extra_field_names, {}))
-
             for key in obj:
                 if (key not in all_field_names and
                         not key.startswith('.tag')):
                     raise bv.ValidationError("unknown field '%s'" % key)
+        if self.lazy:
+            return self.decode_struct_lazily(data_type, all_fields, obj)
+        return self.new_struct(data_type, obj)
+
+    def new_struct(self, data_type, obj, decoded=False):
+        """
+        Returns a new instance of a struct class with the fields of ``obj``
+        set, and checks that all required fields are present. The values
+        of ``obj`` are JSON-compatible, or with ``decoded``, already decoded.
+        Unknown fields are ignored.
+        """
+        all_fields, _, extra_field_names = self.get_struct_fields(data_type.definition)
         ins = data_type.definition()
-        self.decode_struct_fields(ins, all_fields, obj)
+        # Instances of frozen types are sealed once their fields are set.
+        sealed = getattr(ins, '_sealed', False)
+        if sealed:
+            ins._sealed = False
+        self.decode_struct_fields(ins, all_fields, obj, decoded)
         # Check that all required fields have been set.
-        data_type.validate_fields_only_with_permissions(ins, self.caller_permissions)
+        data_type.validate_fields_only(ins)
+        for field_name in extra_field_names:
+            if not hasattr(ins, field_name):
+                raise bv.ValidationError("missing required field '%s'" % field_name)
+        if sealed:
+            ins._sealed = True
         return ins
 
-    def decode_struct_fields(self, ins, fields, obj):
+    def decode_struct_lazily(self, data_type, fields, obj):
+        """
+        Returns an instance of the lazily decoded subclass of a struct
+        class, which decodes and validates each field of ``obj`` when it is
+        first read. Only the presence of required fields is checked here.
+        """
+        lazy_class = _get_lazy_struct_class(data_type.definition)
+        presence_bits = lazy_class._lazy_presence_bits_
+        ins = lazy_class()
+        ins._lazy_decoder = self
+        lazy_fields = ins._lazy_fields
+        for name, field_data_type in fields:
+            if name in obj:
+                lazy_fields[name] = (field_data_type, obj[name])
+                if presence_bits is None:
+                    setattr(ins, '_%s_present' % name, True)
+                else:
+                    ins._presence |= presence_bits[name]
+            elif field_data_type.has_default():
+                setattr(ins, name, field_data_type.get_default())
+            elif not hasattr(ins, name):
+                # Fields with a default in the spec read as the default.
+                raise bv.ValidationError("missing required field '%s'" % name)
+        if getattr(lazy_class, '_frozen_', False):
+            ins._sealed = True
+        return ins
+
+    def decode_struct_fields(self, ins, fields, obj, decoded=False):
         """
         Args:
             ins: An instance of the class representing the data type being decoded.
                 The object will have its fields set.
             fields: A tuple of (field_name: str, field_validator: Validator)
             obj (dict): JSON-compatible dict that is being decoded.
-            strict (bool): See :func:`json_compat_obj_decode`.
+            decoded (bool): Whether the values of `obj` are already decoded.
         Returns:
             None: `ins` has its fields set based on the contents of `obj`.
         """
         for name, field_data_type in fields:
             if name in obj:
                 try:
-                    v = self.json_compat_obj_decode_helper(field_data_type, obj[name])
+                    if decoded:
+                        v = obj[name]
+                    else:
+                        v = self.json_compat_obj_decode_helper(field_data_type, obj[name])
                     setattr(ins, name, v)
                 except bv.ValidationError as e:
                     e.add_parent(name)
@@ -637,6 +2311,12 @@ class PythonPrimitiveToStoneDecoder(object):
         The data_type argument must be a Union.
         See json_compat_obj_decode() for argument descriptions.
         """
+        if self._use_codecs and '_from_json_compat' in vars(data_type.definition):
+            # The generated decoder returns None for input it does not
+            # handle, which is then decoded, or rejected, below.
+            ins = data_type.definition._from_json_compat(self, obj)
+            if ins is not None:
+                return ins
         val = None
         if isinstance(obj, six.string_types):
             # Handles the shorthand format where the union is serialized as only
@@ -661,7 +2341,7 @@ class PythonPrimitiveToStoneDecoder(object):
         else:
             raise bv.ValidationError("expected string or object, got %s" %
                                      bv.generic_type_name(obj))
-        return data_type.definition(tag, val)
+        return _make_union(data_type.definition, tag, val)
 
     def decode_union_dict(self, data_type, obj):
         if '.tag' not in obj:
@@ -788,7 +2468,7 @@ class PythonPrimitiveToStoneDecoder(object):
         else:
             raise bv.ValidationError("expected string or object, got %s" %
                                      bv.generic_type_name(obj))
-        return data_type.definition(tag, val)
+        return _make_union(data_type.definition, tag, val)
 
     def decode_struct_tree(self, data_type, obj):
         """
@@ -877,10 +2557,13 @@ class PythonPrimitiveToStoneDecoder(object):
         false.
         """
         if isinstance(data_type, bv.Timestamp):
-            try:
-                ret = datetime.datetime.strptime(val, data_type.format)
-            except (TypeError, ValueError) as e:
-                raise bv.ValidationError(e.args[0])
+            if self.for_msgpack and _msgpack_timestamps and isinstance(val, msgpack.Timestamp):
+                ret = _from_msgpack_timestamp(val)
+            else:
+                try:
+                    ret = _get_timestamp_codec(data_type.format).parse(val)
+                except (TypeError, ValueError) as e:
+                    raise bv.ValidationError(e.args[0])
         elif isinstance(data_type, bv.Bytes):
             if self.for_msgpack:
                 if isinstance(val, six.text_type):
@@ -908,7 +2591,8 @@ class PythonPrimitiveToStoneDecoder(object):
         return ret
 
 def json_decode(data_type, serialized_obj, caller_permissions=None,
-                alias_validators=None, strict=True, old_style=False):
+                alias_validators=None, strict=True, old_style=False, lazy=False,
+                json_engine=None, fused=False):
     """Performs the reverse operation of json_encode.
 
     Args:
@@ -925,6 +2609,19 @@ def json_decode(data_type, serialized_obj, caller_permissions=None,
             recipient of serialized JSON if it's guaranteed that its Stone
             specs are at least as recent as the senders it receives messages
             from.
+        lazy (bool): If lazy, then each field of a struct is only decoded
+            and validated when it is first read, and a ValidationError may be
+            raised then. Unknown fields and the presence of required fields
+            are still checked immediately. Structs are returned as instances
+            of a subclass of their definition.
+        json_engine (str): The name of the JSON engine that parses
+            serialized_obj. Defaults to the default engine; see
+            :func:`set_json_engine`.
+        fused (bool): If fused, then serialized_obj is parsed straight into
+            Stone objects by the json module's scanner, without building the
+            intermediate dicts and lists, and json_engine is not used.
+            serialized_obj may then also be a bytearray or memoryview of
+            UTF-8. See the fused JSON decoder section of this module.
 
     Returns:
         The returned object depends on the input data_type.
@@ -940,19 +2637,24 @@ def json_decode(data_type, serialized_obj, caller_permissions=None,
             - Timestamp -> datetime.datetime
             - Union -> An instance of its definition attribute.
     """
+    if fused:
+        decoder = PythonPrimitiveToStoneDecoder(caller_permissions,
+            alias_validators, False, old_style, strict, lazy)
+        return _FusedJsonDecoder(decoder).decode(data_type, serialized_obj)
     try:
-        deserialized_obj = json.loads(serialized_obj)
+        deserialized_obj = get_json_engine(json_engine).loads(serialized_obj)
     except ValueError:
         raise bv.ValidationError('could not decode input as JSON')
     else:
         return json_compat_obj_decode(
             data_type, deserialized_obj, caller_permissions=caller_permissions,
-            alias_validators=alias_validators, strict=strict, old_style=old_style)
+            alias_validators=alias_validators, strict=strict, old_style=old_style,
+            lazy=lazy)
 
 
 def json_compat_obj_decode(data_type, obj, caller_permissions=None,
                            alias_validators=None, strict=True,
-                           old_style=False, for_msgpack=False):
+                           old_style=False, for_msgpack=False, lazy=False):
     """
     Decodes a JSON-compatible object based on its data type into a
     representative Python object.
@@ -965,19 +2667,742 @@ def json_compat_obj_decode(data_type, obj, caller_permissions=None,
         strict (bool): If strict, then unknown struct fields will raise an
             error, and unknown union variants will raise an error even if a
             catch all field is specified. See json_decode() for more.
+        lazy (bool): If lazy, then struct fields are decoded when they are
+            first read. See json_decode() for more.
 
     Returns:
         See json_decode().
     """
     decoder = PythonPrimitiveToStoneDecoder(caller_permissions,
-        alias_validators, for_msgpack, old_style, strict)
+        alias_validators, for_msgpack, old_style, strict, lazy)
+    return decoder.decode(data_type, obj)
+
+# --------------------------------------------------------------
+# Fused JSON Decoder
+#
+# With ``fused``, json_decode() parses JSON text straight into Stone objects,
+# guided by the validators, rather than into dicts and lists that are then
+# decoded. Structs, lists, maps and nullables are decoded as they are parsed,
+# and primitives and object keys are parsed by the scanner of the json
+# module. Values whose decoding needs a whole object up front, namely unions,
+# structs with enumerated subtypes and lazily decoded structs, are scanned
+# into JSON-compatible objects and decoded by PythonPrimitiveToStoneDecoder.
+# So are lists and maps of primitives, which the scanner parses faster.
+#
+# The result equals that of the two-pass decode. Errors are raised as they
+# are reached in the input, though, so an invalid field may be reported
+# ahead of an unknown field that follows it in strict mode.
+#
+# The scanner and scanstring() are internals of the json module, which other
+# implementations of it need not have. Without them, values and keys are
+# parsed by JSONDecoder.raw_decode() instead, which wraps the scanner.
+
+_whitespace = re.compile(r'[ \t\n\r]*').match
+_raw_decode = json.JSONDecoder().raw_decode
+
+def _raw_scanstring(s, end):
+    # type: (typing.Text, int) -> typing.Tuple[typing.Text, int]
+    """Parses the JSON string whose opening quote is before ``end``."""
+    return _raw_decode(s, end - 1)
+
+try:
+    # Neither is in the stubs of the json module, as both are private.
+    _scan_once = json.JSONDecoder().scan_once  # type: ignore[attr-defined]
+    _scanstring = json.decoder.scanstring  # type: ignore[attr-defined]
+except AttributeError:
+    _scan_once = _raw_decode
+    _scanstring = _raw_scanstring
+
+def _has_primitive_items(data_type):
+    """
+    Whether the items of a list, or the values of a map, are primitives or
+    nullable primitives. The scanner parses such containers faster than
+    they are parsed item by item, and their JSON-compatible form is not
+    much larger than their decoded one.
+    """
+    if isinstance(data_type, bv.List):
+        item_validator = data_type.item_validator
+    else:
+        item_validator = data_type.value_validator
+    if isinstance(item_validator, bv.Nullable):
+        item_validator = item_validator.validator
+    return isinstance(item_validator, bv.Primitive)
+
+def _is_json_native(data_type, alias_validators):
+    """
+    Whether the JSON values of a validator decode to themselves: those of
+    strings, numbers and booleans, and lists and maps of them, none of
+    which have alias validators.
+    """
+    if data_type in alias_validators:
+        return False
+    elif isinstance(data_type, bv.Nullable):
+        return _is_json_native(data_type.validator, alias_validators)
+    elif isinstance(data_type, bv.List):
+        return _is_json_native(data_type.item_validator, alias_validators)
+    elif isinstance(data_type, bv.Map):
+        return (_is_json_native(data_type.key_validator, alias_validators)
+                and _is_json_native(data_type.value_validator, alias_validators))
+    return isinstance(data_type, (bv.String, bv.Integer, bv.Real, bv.Boolean))
+
+def _json_error():
+    return bv.ValidationError('could not decode input as JSON')
+
+class _FusedJsonDecoder(object):
+
+    def __init__(self, decoder):
+        # type: (PythonPrimitiveToStoneDecoder) -> None
+        self.decoder = decoder
+        # Maps struct classes to a dict from field names to validators
+        self._field_validators = {}  # type: typing.Dict[type, typing.Dict[typing.Text, bv.Validator]] # noqa: E501
+
+    def decode(self, data_type, s):
+        """See json_decode() for argument descriptions."""
+        if isinstance(s, (six.binary_type, bytearray, memoryview)):
+            try:
+                # Decodes the buffer in place, unlike bytes(s).decode().
+                s = codecs.decode(s, 'utf-8')
+            except UnicodeDecodeError:
+                raise _json_error()
+        idx = _whitespace(s, 0).end()
+        if isinstance(data_type, bv.Primitive):
+            obj, idx = self.scan(s, idx)
+            value = self.decoder.decode(data_type, obj)
+        else:
+            value, idx = self.parse(data_type, s, idx)
+        if _whitespace(s, idx).end() != len(s):
+            raise _json_error()
+        return value
+
+    def scan(self, s, idx):
+        """Parses the JSON value at ``idx`` into a JSON-compatible object."""
+        try:
+            return _scan_once(s, idx)
+        except (StopIteration, ValueError):
+            raise _json_error()
+
+    def parse(self, data_type, s, idx):
+        """
+        Parses the JSON value at ``idx``, which must not be whitespace, and
+        decodes it like json_compat_obj_decode_helper(). Returns the value
+        and the index where it ends.
+        """
+        if isinstance(data_type, bv.Primitive):
+            obj, idx = self.scan(s, idx)
+            return self.decoder.make_stone_friendly(data_type, obj, False), idx
+        elif isinstance(data_type, bv.Nullable):
+            if s.startswith('null', idx):
+                return None, idx + 4
+            return self.parse(data_type.validator, s, idx)
+        elif isinstance(data_type, (bv.List, bv.Map)) and not _has_primitive_items(data_type):
+            if isinstance(data_type, bv.List):
+                return self.parse_list(data_type, s, idx)
+            return self.parse_map(data_type, s, idx)
+        elif (isinstance(data_type, bv.Struct) and not isinstance(data_type, bv.StructTree)
+              and not self.decoder.lazy):
+            return self.parse_struct(data_type, s, idx)
+        else:
+            obj, idx = self.scan(s, idx)
+            return self.decoder.json_compat_obj_decode_helper(data_type, obj), idx
+
+    def parse_list(self, data_type, s, idx):
+        if not s.startswith('[', idx):
+            obj, idx = self.scan(s, idx)
+            raise bv.ValidationError('expected list, got %s' % bv.generic_type_name(obj))
+        item_validator = data_type.item_validator
+        items = []
+        idx = _whitespace(s, idx + 1).end()
+        if s.startswith(']', idx):
+            return items, idx + 1
+        while True:
+            item, idx = self.parse(item_validator, s, idx)
+            items.append(item)
+            idx = _whitespace(s, idx).end()
+            c = s[idx:idx + 1]
+            if c == ']':
+                return items, idx + 1
+            elif c != ',':
+                raise _json_error()
+            idx = _whitespace(s, idx + 1).end()
+
+    def parse_key(self, s, idx):
+        """
+        Parses the key of an object member at ``idx``, and the colon after
+        it. Returns the key and the index of the value.
+        """
+        if not s.startswith('"', idx):
+            raise _json_error()
+        try:
+            key, idx = _scanstring(s, idx + 1)
+        except ValueError:
+            raise _json_error()
+        idx = _whitespace(s, idx).end()
+        if not s.startswith(':', idx):
+            raise _json_error()
+        return key, _whitespace(s, idx + 1).end()
+
+    def parse_map(self, data_type, s, idx):
+        if not s.startswith('{', idx):
+            obj, idx = self.scan(s, idx)
+            raise bv.ValidationError('expected dict, got %s' % bv.generic_type_name(obj))
+        key_validator = data_type.key_validator
+        value_validator = data_type.value_validator
+        d = {}
+        idx = _whitespace(s, idx + 1).end()
+        if s.startswith('}', idx):
+            return d, idx + 1
+        while True:
+            key, idx = self.parse_key(s, idx)
+            key = self.decoder.json_compat_obj_decode_helper(key_validator, key)
+            d[key], idx = self.parse(value_validator, s, idx)
+            idx = _whitespace(s, idx).end()
+            c = s[idx:idx + 1]
+            if c == '}':
+                return d, idx + 1
+            elif c != ',':
+                raise _json_error()
+            idx = _whitespace(s, idx + 1).end()
+
+    def parse_struct(self, data_type, s, idx):
+        if not s.startswith('{', idx):
+            # Null may stand for the default.
+            obj, idx = self.scan(s, idx)
+            return self.decoder.decode_struct(data_type, obj), idx
+        definition = data_type.definition
+        _, all_field_names, _ = self.decoder.get_struct_fields(definition)
+        field_validators = self.get_field_validators(definition)
+        strict = self.decoder.strict
+        values = {}  # type: typing.Dict[typing.Text, typing.Any]
+        idx = _whitespace(s, idx + 1).end()
+        if s.startswith('}', idx):
+            idx += 1
+        else:
+            while True:
+                key, idx = self.parse_key(s, idx)
+                if strict and key not in all_field_names and not key.startswith('.tag'):
+                    raise bv.ValidationError("unknown field '%s'" % key)
+                field_validator, native = field_validators.get(key, (None, False))
+                if field_validator is None or native:
+                    value, idx = self.scan(s, idx)
+                    if native:
+                        values[key] = value
+                else:
+                    try:
+                        values[key], idx = self.parse(field_validator, s, idx)
+                    except bv.ValidationError as e:
+                        e.add_parent(key)
+                        raise
+                idx = _whitespace(s, idx).end()
+                c = s[idx:idx + 1]
+                if c == '}':
+                    idx += 1
+                    break
+                elif c != ',':
+                    raise _json_error()
+                idx = _whitespace(s, idx + 1).end()
+        return self.decoder.new_struct(data_type, values, decoded=True), idx
+
+    def get_field_validators(self, definition):
+        """
+        Returns a dict from the name of each field of a struct class visible
+        to the caller to its validator, and whether the field's JSON values
+        decode to themselves.
+        """
+        try:
+            return self._field_validators[definition]
+        except KeyError:
+            all_fields, _, _ = self.decoder.get_struct_fields(definition)
+            alias_validators = self.decoder.alias_validators or {}
+            field_validators = self._field_validators[definition] = {
+                name: (field_validator, _is_json_native(field_validator, alias_validators))
+                for name, field_validator in all_fields}
+            return field_validators
+
+# --------------------------------------------------------------
+# Streaming JSON Decoder
+
+class _JsonStreamReader(object):
+    """
+    Reads JSON text from a file-like object and parses it one value at a
+    time, so that the items of a JSON array can be decoded without holding
+    the whole document in memory.
+    """
+
+    _whitespace = ' \t\n\r'
+
+    def __init__(self, stream, chunk_size):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size):
+        """Reads at least one more chunk. Returns False at end of stream."""
+        if self._eof:
+            return False
+        text = ''
+        # A chunk of bytes may end in the middle of a character, and so
+        # decode to nothing until the next one is read.
+        while not text:
+            chunk = self._stream.read(size)
+            if isinstance(chunk, six.binary_type):
+                try:
+                    text = self._utf8_decoder.decode(chunk, final=not chunk)
+                except UnicodeDecodeError:
+                    raise bv.ValidationError('could not decode input as JSON')
+            else:
+                text = chunk
+            if not chunk:
+                self._eof = True
+                return False
+        # Drop what has been consumed already.
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """
+        Returns the next non-whitespace character without consuming it, or
+        '' at end of stream.
+        """
+        while True:
+            buf = self._buf
+            pos = self._pos
+            while pos < len(buf) and buf[pos] in self._whitespace:
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self._fill(self._chunk_size):
+                return ''
+
+    def next_char(self):
+        """Consumes and returns the next non-whitespace character."""
+        c = self.peek()
+        if not c:
+            raise bv.ValidationError('could not decode input as JSON')
+        self._pos += 1
+        return c
+
+    def read_value(self):
+        """Consumes and returns the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError as exc:
+                # Unless the value continues past the end of the buffer.
+                if self._eof or not self._may_continue(exc):
+                    raise bv.ValidationError('could not decode input as JSON')
+            else:
+                # A number at the end of the buffer may continue, too.
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            # Read as much again as is buffered so that a large value is not
+            # parsed over and over.
+            self._fill(max(self._chunk_size, len(self._buf) - self._pos))
+
+    def _may_continue(self, exc):
+        """
+        Returns whether a JSON syntax error may be due to the value being
+        cut off at the end of the buffer, rather than to invalid input that
+        more text cannot fix.
+        """
+        pos = getattr(exc, 'pos', None)
+        if pos is None:
+            # Errors raised by Python 2 don't say where they occurred.
+            return True
+        # Bad escapes are reported at the start of the escape, and strings
+        # that are not terminated at the start of the string.
+        return (pos >= len(self._buf) - len('\\uXXXX')
+                or exc.msg.startswith('Unterminated string'))
+
+    def read_end(self):
+        if self.peek():
+            raise bv.ValidationError('could not decode input as JSON')
+
+
+def json_decode_iter(stream, data_type, field_name=None, caller_permissions=None,
+                     alias_validators=None, strict=True, old_style=False,
+                     chunk_size=_JSON_CHUNK_SIZE):
+    """
+    Decodes the items of a JSON array read incrementally from a file-like
+    object, yielding them one at a time. Only a single item is held in
+    memory at once, which makes it possible to process responses larger
+    than the available memory.
+
+    Args:
+        stream: A file-like object with a ``read`` method returning text or
+            UTF-8 encoded bytes.
+        data_type (Validator): If ``field_name`` is None, a List (or a
+            Nullable List) validator for the whole document. Otherwise, a
+            Struct validator for the whole document.
+        field_name (str): The name of a List (or Nullable List) field of the
+            struct whose items should be yielded. The other fields of the
+            struct are checked for unknown names in strict mode, but are not
+            decoded.
+        chunk_size (int): The number of characters or bytes read at a time.
+
+    See :func:`json_decode` for the other arguments.
+
+    Items are decoded exactly as :func:`json_decode` would decode them.
+    Items of a struct field are also validated, as they would be on
+    assignment to the field, and the field's item count limits are
+    enforced. Errors in the input are only detected once they are reached,
+    so some items may have been yielded before a ValidationError is raised.
+    """
+    decoder = PythonPrimitiveToStoneDecoder(caller_permissions,
+        alias_validators, False, old_style, strict)
+    return _iter_json_decode(decoder, stream, data_type, field_name, chunk_size)
+
+
+def _iter_json_decode(decoder, stream, data_type, field_name, chunk_size):
+    reader = _JsonStreamReader(stream, chunk_size)
+    if field_name is None:
+        for item in _iter_json_list(reader, decoder, data_type, False):
+            yield item
+    else:
+        for item in _iter_json_struct_field(reader, decoder, data_type, field_name):
+            yield item
+    reader.read_end()
+
+
+def _iter_json_struct_field(reader, decoder, data_type, field_name):
+    assert isinstance(data_type, bv.Struct) and not isinstance(data_type, bv.StructTree), \
+        'Expected a struct without enumerated subtypes, got %r.' % data_type
+    definition = data_type.definition
+    all_fields, all_field_names, _ = decoder.get_struct_fields(definition)
+    field_data_type = dict(all_fields).get(field_name)
+    assert field_data_type is not None, \
+        '%r has no field %r.' % (definition, field_name)
+
+    if reader.peek() != '{':
+        raise bv.ValidationError('expected object, got %s' %
+                                 bv.generic_type_name(reader.read_value()))
+    reader.next_char()
+    found = False
+    if reader.peek() == '}':
+        reader.next_char()
+    else:
+        while True:
+            key = reader.read_value()
+            if not isinstance(key, six.string_types) or reader.next_char() != ':':
+                raise bv.ValidationError('could not decode input as JSON')
+            if decoder.strict and key not in all_field_names and not key.startswith('.tag'):
+                raise bv.ValidationError("unknown field '%s'" % key)
+            if key == field_name:
+                found = True
+                try:
+                    for item in _iter_json_list(reader, decoder, field_data_type, True):
+                        yield item
+                except bv.ValidationError as e:
+                    e.add_parent(field_name)
+                    raise
+            else:
+                reader.read_value()
+            c = reader.next_char()
+            if c == '}':
+                break
+            elif c != ',':
+                raise bv.ValidationError('could not decode input as JSON')
+    if not found and not field_data_type.has_default():
+        raise bv.ValidationError("missing required field '%s'" % field_name)
+
+
+def _iter_json_list(reader, decoder, data_type, validate):
+    if isinstance(data_type, bv.Nullable):
+        if reader.peek() == 'n' and reader.read_value() is None:
+            return
+        data_type = data_type.validator
+    assert isinstance(data_type, bv.List), 'Expected a list, got %r.' % data_type
+
+    if reader.peek() != '[':
+        raise bv.ValidationError('expected list, got %s' %
+                                 bv.generic_type_name(reader.read_value()))
+    reader.next_char()
+    item_validator = data_type.item_validator
+    count = 0
+    if reader.peek() == ']':
+        reader.next_char()
+    else:
+        while True:
+            item = decoder.json_compat_obj_decode_helper(item_validator, reader.read_value())
+            count += 1
+            if validate:
+                if data_type.max_items is not None and count > data_type.max_items:
+                    raise bv.ValidationError('list has more than %s items' %
+                                             data_type.max_items)
+                item = item_validator.validate(item)
+            yield item
+            c = reader.next_char()
+            if c == ']':
+                break
+            elif c != ',':
+                raise bv.ValidationError('could not decode input as JSON')
+    if validate and data_type.min_items is not None and count < data_type.min_items:
+        raise bv.ValidationError('list has fewer than %s items' % data_type.min_items)
+
+
+class StoneDecoder(object):
+    """
+    A reusable decoder, configured once with the options of
+    :func:`json_decode`.
+
+    The fields visible to the caller are resolved once per struct type and
+    shared by all calls. A decoder may be used by several threads at once.
+
+    If an ``observer`` is given, it receives a report of each call, other
+    than to ``iterdecode()``; see :class:`SerializationObserver`.
+    """
+
+    def __init__(self, caller_permissions=None, alias_validators=None, strict=True,
+                 old_style=False, lazy=False, json_engine=None, fused=False, observer=None):
+        for_msgpack = False
+        self._decoder = PythonPrimitiveToStoneDecoder(
+            caller_permissions, alias_validators, for_msgpack, old_style, strict, lazy)
+        self._loads = get_json_engine(json_engine).loads
+        self._fused_decoder = _FusedJsonDecoder(self._decoder) if fused else None
+        self._observer = observer  # type: typing.Optional[SerializationObserver]
+
+    def decode(self, data_type, serialized_obj):
+        """Like :func:`json_decode`."""
+        if self._observer is None:
+            return self._decode(data_type, serialized_obj)
+        return self._observe_decode(data_type_name(data_type), data_type, serialized_obj)
+
+    def decode_route_arg(self, route, serialized_obj):
+        """Decodes the argument of a route."""
+        return self._decode_route(route, 'arg', route.arg_type, serialized_obj)
+
+    def decode_route_result(self, route, serialized_obj):
+        """Decodes the result of a route."""
+        return self._decode_route(route, 'result', route.result_type, serialized_obj)
+
+    def decode_route_error(self, route, serialized_obj):
+        """Decodes the error of a route."""
+        return self._decode_route(route, 'error', route.error_type, serialized_obj)
+
+    def _decode_route(self, route, part, data_type, serialized_obj):
+        if self._observer is None:
+            return self._decode(data_type, serialized_obj)
+        return self._observe_decode(_route_part_name(route, part), data_type, serialized_obj)
+
+    def _observe_decode(self, name, data_type, serialized_obj):
+        start = _timer()
+        decoded = self._decode(data_type, serialized_obj)
+        seconds = _timer() - start
+        self._observer.on_decode(name, seconds, len(serialized_obj),
+                                 _struct_counts(self._observer, data_type, decoded))
+        return decoded
+
+    def _decode(self, data_type, serialized_obj):
+        if self._fused_decoder is not None:
+            return self._fused_decoder.decode(data_type, serialized_obj)
+        try:
+            deserialized_obj = self._loads(serialized_obj)
+        except ValueError:
+            raise bv.ValidationError('could not decode input as JSON')
+        return self._decoder.decode(data_type, deserialized_obj)
+
+    def decode_compat(self, data_type, obj):
+        """Like :func:`json_compat_obj_decode`."""
+        if self._observer is None:
+            return self._decoder.decode(data_type, obj)
+        start = _timer()
+        decoded = self._decoder.decode(data_type, obj)
+        seconds = _timer() - start
+        self._observer.on_decode(data_type_name(data_type), seconds, None,
+                                 _struct_counts(self._observer, data_type, decoded))
+        return decoded
+
+    def iterdecode(self, stream, data_type, field_name=None, chunk_size=_JSON_CHUNK_SIZE):
+        """Like :func:`json_decode_iter`."""
+        return _iter_json_decode(self._decoder, stream, data_type, field_name, chunk_size)
+
+
+# --------------------------------------------------------------
+# Columnar Data
+
+def _validate_struct_columns(data_type, columns, rows):
+    """
+    Validates the values of each public field of a list of structs as a
+    whole, given as either columns or rows. Returns the number of structs
+    and a list of (field name, field validator, validated column, whether
+    the column holds None) tuples in the order of ``_all_fields_``. The
+    column is None if no struct sets the field.
+    """
+    assert (columns is None) != (rows is None), 'Either columns or rows must be given.'
+    assert not isinstance(data_type, bv.StructTree), \
+        'Structs with enumerated subtypes are not supported.'
+    definition = data_type.definition
+    all_fields = definition._all_fields_
+
+    if rows is not None:
+        rows = list(rows)
+        for i, row in enumerate(rows):
+            if len(row) != len(all_fields):
+                raise bv.ValidationError('row %d has %d values, expected %d'
+                                         % (i, len(row), len(all_fields)))
+        length = len(rows)
+        columns = {field_name: [row[i] for row in rows]
+                   for i, (field_name, _) in enumerate(all_fields)}
+    else:
+        for field_name in columns:
+            if field_name not in definition._all_field_names_:
+                raise bv.ValidationError("unknown field '%s'" % field_name)
+        length = len(next(iter(columns.values()))) if columns else 0
+
+    # Fields read without being set are optional.
+    empty = definition()
+    fields = []
+    for field_name, field_validator in all_fields:
+        column = columns.get(field_name)
+        has_none = False
+        if column is not None:
+            if len(column) != length:
+                raise bv.ValidationError("column '%s' has %d values, expected %d"
+                                         % (field_name, len(column), length))
+            try:
+                column, has_none = _validate_column(field_validator, column)
+            except bv.ValidationError as e:
+                e.add_parent(field_name)
+                raise
+        if (column is None or has_none) and length and not hasattr(empty, field_name):
+            raise bv.ValidationError("missing required field '%s'" % field_name)
+        fields.append((field_name, field_validator, column, has_none))
+    return length, fields
+
+def _validate_column(validator, column):
+    """
+    Validates a column of field values like the setter of the field does
+    each value, where None leaves the field unset. Returns the validated
+    values and whether any of them is None.
+    """
+    if isinstance(validator, bv.Nullable):
+        validator = validator.validator
+    has_none = isinstance(column, (list, tuple)) and None in column
+    values = [v for v in column if v is not None] if has_none else column
+
+    if isinstance(validator, (bv.Struct, bv.Union)):
+        # Like setters, only check the types of user-defined values.
+        for value in values:
+            validator.validate_type_only(value)
+        values = list(values)
+    else:
+        values = bv.List(validator).validate(values)
+
+    if has_none:
+        it = iter(values)
+        values = [None if v is None else next(it) for v in column]
+    return values, has_none
+
+def _set_column(slot, instances, values):
+    """Assigns the i-th value to a slot of the i-th instance."""
+    collections.deque(six.moves.map(slot.__set__, instances, values), maxlen=0)
+
+def struct_list_from_columns(data_type, columns=None, rows=None):
+    """
+    Builds a list of structs from the values of their public fields. The
+    values are validated a field at a time rather than a struct at a time,
+    so ranges, lengths and patterns are checked in bulk where possible, and
+    the structs are built without calling the field setters.
+
+    Args:
+        data_type (Struct): Validator of the structs.
+        columns (dict): Maps field names to lists, tuples or NumPy arrays of
+            equal length, where the i-th item is the value of the field in
+            the i-th struct. Fields no struct sets may be left out.
+        rows (list): Instead of columns, tuples with the value of every
+            public field of a struct, in the order of ``_all_fields_``.
+
+    As with the constructor, a value of None leaves a field unset.
 
-    if isinstance(data_type, bv.Primitive):
-        return decoder.make_stone_friendly(
-            data_type, obj, True)
+    Returns:
+        list: Instances of the struct class.
+    """
+    definition = data_type.definition
+    length, fields = _validate_struct_columns(data_type, columns, rows)
+    frozen = getattr(definition, '_frozen_', False)
+    field_columns = {}
+    for field_name, field_validator, column, has_none in fields:
+        if isinstance(field_validator, bv.Nullable):
+            field_validator = field_validator.validator
+        if frozen and column is not None and isinstance(field_validator, (bv.List, bv.Map)):
+            # Frozen types hold read-only copies of lists and maps.
+            column = [bb.freeze(v) for v in column]
+        field_columns[field_name] = (column, has_none)
+    instances = list(six.moves.map(definition.__new__, itertools.repeat(definition, length)))
+
+    field_names = _struct_slot_field_names(definition)
+    presence_bits = _struct_presence_bits(definition, field_names)
+    presence = [0] * length
+    full_presence = 0
+    for field_name in field_names:
+        column, has_none = field_columns.get(field_name, (None, False))
+        _set_column(getattr(definition, '_%s_value' % field_name), instances,
+                    itertools.repeat(None, length) if column is None else column)
+        if column is None:
+            present = itertools.repeat(False, length)
+        elif has_none:
+            present = [v is not None for v in column]
+        else:
+            present = itertools.repeat(True, length)
+        if presence_bits is None:
+            _set_column(getattr(definition, '_%s_present' % field_name), instances, present)
+        elif column is not None and has_none:
+            bit = presence_bits[field_name]
+            presence = [p | bit if v is not None else p for p, v in zip(presence, column)]
+        elif column is not None:
+            full_presence |= presence_bits[field_name]
+    if presence_bits is not None:
+        _set_column(definition._presence, instances, [p | full_presence for p in presence])
+    if getattr(definition, '_frozen_', False):
+        _set_column(definition._sealed, instances, itertools.repeat(True, length))
+        _set_column(definition._encodings, instances, itertools.repeat(None, length))
+    return instances
+
+def json_encode_columns(data_type, columns=None, rows=None, alias_validators=None,
+                        old_style=False, should_redact=False, json_engine=None):
+    """
+    Encodes a list of structs, given as the values of their public fields,
+    into JSON without building the structs. The result is the same as that
+    of :func:`json_encode` for the list built by
+    :func:`struct_list_from_columns`.
+
+    See :func:`struct_list_from_columns` for the ``columns`` and ``rows``
+    arguments, and :func:`json_encode` for the others.
+    """
+    length, fields = _validate_struct_columns(data_type, columns, rows)
+    # The values have just been validated, so encode them like trusted ones.
+    compiler = _EncodePlanCompiler(
+        (), alias_validators or {}, False, old_style, should_redact, trusted=True)
+    names = []
+    encoded = []
+    sparse = False
+    for field_name, field_validator, column, has_none in fields:
+        if column is None:
+            continue
+        encode_value = compiler.get_plan(field_validator)
+        names.append(field_name)
+        if has_none:
+            encoded.append([None if v is None else encode_value(v) for v in column])
+            sparse = True
+        else:
+            encoded.append(list(six.moves.map(encode_value, column)))
+
+    values = six.moves.zip(*encoded) if encoded else itertools.repeat((), length)
+    if sparse:
+        objs = [collections.OrderedDict((name, v) for name, v in zip(names, row)
+                                        if v is not None)
+                for row in values]
     else:
-        return decoder.json_compat_obj_decode_helper(
-            data_type, obj)
+        objs = [collections.OrderedDict(zip(names, row)) for row in values]
+    return get_json_engine(json_engine).dumps(objs)
+
 
 # Adapted from:
 # http://code.activestate.com/recipes/306860-proleptic-gregorian-dates-and-strftime-before-1900/
@@ -1047,28 +3472,1086 @@ def _strftime(dt, fmt):
     return s
 
 
-try:
-    import msgpack
-except ImportError:
-    pass
-else:
+# Timestamp formats made up only of the fixed-width numeric directives below
+# and literal text, like the ubiquitous '%Y-%m-%dT%H:%M:%SZ', are compiled into
+# a regex and a %-format string. Anything the regex does not match, and every
+# other format, is handled by strptime() and _strftime() as before, so only
+# the common case is affected.
+_TIMESTAMP_FIELDS = ('year', 'month', 'day', 'hour', 'minute', 'second')
+
+_TIMESTAMP_DIRECTIVES = {
+    'Y': ('year', 4),
+    'm': ('month', 2),
+    'd': ('day', 2),
+    'H': ('hour', 2),
+    'M': ('minute', 2),
+    'S': ('second', 2),
+}
+
+_TIMESTAMP_FORMAT_TOKEN = re.compile(r'%(.?)|[^%]+', re.DOTALL)
+
+# The values strptime() gives the fields a format leaves out.
+_TIMESTAMP_DEFAULTS = {'year': 1900, 'month': 1, 'day': 1}
+
+class _TimestampCodec(object):
+    """
+    Parses and formats the timestamps of one format.
+    """
+
+    __slots__ = ('format', '_match', '_fields', '_positional', '_template')
+
+    def __init__(self, fmt):
+        # type: (typing.Text) -> None
+        self.format = fmt
+        self._match = None  # type: typing.Optional[typing.Callable[[typing.Text], typing.Any]]
+        self._fields = []  # type: typing.List[str]
+        self._positional = False
+        self._template = None  # type: typing.Optional[typing.Text]
+
+        pattern = []
+        template = []
+        for m in _TIMESTAMP_FORMAT_TOKEN.finditer(fmt):
+            directive = m.group(1)
+            if directive is None or directive == '%':
+                literal = m.group(0) if directive is None else '%'
+                if any(c.isspace() for c in literal):
+                    # strptime() matches any run of whitespace.
+                    return
+                pattern.append(re.escape(literal))
+                template.append(literal.replace('%', '%%'))
+            elif directive in _TIMESTAMP_DIRECTIVES:
+                field, width = _TIMESTAMP_DIRECTIVES[directive]
+                if field in self._fields:
+                    return
+                self._fields.append(field)
+                pattern.append('([0-9]{%d})' % width)
+                template.append('%%0%dd' % width)
+            else:
+                return
+        self._match = re.compile(''.join(pattern) + r'\Z').match
+        # Whether the fields can be passed to datetime() by position
+        self._positional = (len(self._fields) >= 3
+                            and tuple(self._fields) == _TIMESTAMP_FIELDS[:len(self._fields)])
+        self._template = ''.join(template)
+
+    def parse(self, val):
+        # type: (typing.Any) -> datetime.datetime
+        """
+        Parses a timestamp. Raises TypeError or ValueError like strptime().
+        """
+        if self._match is not None and isinstance(val, six.text_type):
+            m = self._match(val)
+            if m is not None:
+                # The values of the fields in _TIMESTAMP_FIELDS
+                values = [int(group) for group in m.groups()]
+                if self._positional:
+                    values.extend([0] * (len(_TIMESTAMP_FIELDS) - len(values)))
+                else:
+                    fields = dict(_TIMESTAMP_DEFAULTS)
+                    fields.update(zip(self._fields, values))
+                    values = [fields.get(field, 0) for field in _TIMESTAMP_FIELDS]
+                try:
+                    return datetime.datetime(
+                        values[0], values[1], values[2], values[3], values[4], values[5])
+                except ValueError:
+                    # Let strptime() report the out of range value.
+                    pass
+        return datetime.datetime.strptime(val, self.format)
+
+    def format_value(self, dt):
+        # type: (datetime.datetime) -> typing.Text
+        """Formats a timestamp like _strftime()."""
+        # The C library may not pad years before 1000 to four digits.
+        if self._template is not None and dt.year >= 1000:
+            return self._template % tuple(getattr(dt, field) for field in self._fields)
+        return _strftime(dt, self.format)
+
+_timestamp_codecs = {}  # type: typing.Dict[typing.Text, _TimestampCodec]
+
+def _get_timestamp_codec(fmt):
+    # type: (typing.Text) -> _TimestampCodec
+    """Returns the codec of a timestamp format, compiling it on first use."""
+    codec = _timestamp_codecs.get(fmt)
+    if codec is None:
+        codec = _timestamp_codecs[fmt] = _TimestampCodec(fmt)
+    return codec
+
+
+# --------------------------------------------------------------
+# msgpack
+#
+# The msgpack serializers share the JSON-compatible encoding, except that
+# bytes are written as msgpack bin rather than in base64. Text is written as
+# msgpack str and must decode as UTF-8. Bytes written as str by msgpack
+# serializers of earlier versions are still decoded.
+#
+# Timestamps are written as formatted strings, as in JSON. With the
+# native_timestamps option, they are written as the msgpack timestamp
+# extension type instead, and thus keep their microseconds even if their
+# format has none. Readers that predate the option cannot decode these. Like
+# the formatted strings, native timestamps hold the fields of a datetime
+# taken to be in UTC; the time zone of an aware datetime is not applied.
+# Timestamps of either kind are decoded. Versions of msgpack without the
+# timestamp type (before 1.0) always write formatted strings.
+
+_msgpack_timestamps = msgpack is not None and hasattr(msgpack, 'Timestamp')
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def _native_timestamps(for_msgpack, native_timestamps):
+    """Returns whether timestamps are encoded as msgpack timestamps."""
+    return bool(for_msgpack and native_timestamps and _msgpack_timestamps)
+
+def _to_msgpack_timestamp(value):
+    """Returns the msgpack timestamp of the fields of a datetime, in UTC."""
+    delta = value.replace(tzinfo=None) - _EPOCH
+    return msgpack.Timestamp(delta.days * 86400 + delta.seconds, delta.microseconds * 1000)
+
+def _from_msgpack_timestamp(timestamp):
+    """Returns the naive UTC datetime of a msgpack timestamp."""
+    return _EPOCH + datetime.timedelta(
+        seconds=timestamp.seconds, microseconds=timestamp.nanoseconds // 1000)
+
+if msgpack is not None:
+    # Default number of bytes read by msgpack_decode_iter(), and buffered by
+    # msgpack_encode_iter() before a chunk is yielded.
+    _MSGPACK_CHUNK_SIZE = 64 * 1024
+
     msgpack_compat_obj_encode = functools.partial(json_compat_obj_encode,
                                                   for_msgpack=True)
 
-    def msgpack_encode(data_type, obj):
-        return msgpack.dumps(
-            msgpack_compat_obj_encode(data_type, obj), encoding='utf-8')
+    def msgpack_encode(data_type, obj, caller_permissions=None, alias_validators=None,
+                       old_style=False, should_redact=False, field_mask=None, trusted=False,
+                       native_timestamps=False):
+        """
+        Like :func:`json_encode`, but returns msgpack bytes. See the
+        msgpack section of this module for the encoding.
+
+        Args:
+            native_timestamps (bool): Whether to write timestamps as the
+                msgpack timestamp extension type rather than as formatted
+                strings. Only readers that support the type can decode them.
+        """
+        serializer = StoneToPythonPrimitiveSerializer(
+            caller_permissions, alias_validators, True, old_style, should_redact, field_mask,
+            trusted, native_timestamps=native_timestamps)
+        return msgpack.packb(serializer.encode(data_type, obj), use_bin_type=True)
+
+    def msgpack_encode_iter(data_type, obj, caller_permissions=None, alias_validators=None,
+                            old_style=False, should_redact=False, chunk_size=_MSGPACK_CHUNK_SIZE,
+                            native_timestamps=False):
+        """
+        Like :func:`msgpack_encode`, but returns an iterator over chunks of
+        the encoded bytes. The items of a list are packed one at a time, so
+        that only one is held in its encoded form at once. Joined together,
+        the chunks equal the result of :func:`msgpack_encode`.
+
+        Args:
+            chunk_size (int): The approximate number of bytes in each chunk.
+        """
+        serializer = StoneToPythonPrimitiveSerializer(
+            caller_permissions, alias_validators, True, old_style, should_redact,
+            native_timestamps=native_timestamps)
+        return _iter_msgpack_encode(serializer, data_type, obj, chunk_size)
+
+    def msgpack_encode_to(stream, data_type, obj, caller_permissions=None,
+                          alias_validators=None, old_style=False, should_redact=False,
+                          chunk_size=_MSGPACK_CHUNK_SIZE, native_timestamps=False):
+        """
+        Writes the msgpack encoding of ``obj`` to the binary file-like object
+        ``stream`` incrementally. See :func:`msgpack_encode_iter`.
+        """
+        for chunk in msgpack_encode_iter(data_type, obj, caller_permissions, alias_validators,
+                                         old_style, should_redact, chunk_size,
+                                         native_timestamps):
+            stream.write(chunk)
+
+    def _iter_msgpack_encode(serializer, validator, value, chunk_size):
+        packer = msgpack.Packer(use_bin_type=True)
+        if isinstance(validator, bv.Nullable) and value is not None:
+            validator = validator.validator
+        if not isinstance(validator, bv.List):
+            yield packer.pack(serializer.encode(validator, value))
+            return
+
+        # Mirrors StoneToJsonSerializer._iterencode_list().
+        compiler = serializer._get_encode_plan_compiler()
+        if isinstance(validator.item_validator, bv.Primitive):
+            value = compiler.get_plan(validator)(value)
+            encode_item = lambda item: item  # noqa: E731
+        else:
+            encode_item = compiler.get_element_plan(validator.item_validator)
+            validator.validate_type_only(value)
+        buf = [packer.pack_array_header(len(value))]
+        buf_size = len(buf[0])
+        for item in value:
+            packed = packer.pack(encode_item(item))
+            buf.append(packed)
+            buf_size += len(packed)
+            if buf_size >= chunk_size:
+                yield b''.join(buf)
+                buf = []
+                buf_size = 0
+        if buf:
+            yield b''.join(buf)
 
     msgpack_compat_obj_decode = functools.partial(json_compat_obj_decode,
                                                   for_msgpack=True)
 
-    def msgpack_decode(
-            data_type, serialized_obj, alias_validators=None, strict=True):
-        # We decode everything as utf-8 because we want all object keys to be
-        # unicode. Otherwise, we need to do a lot more refactoring to make
-        # json/msgpack share the same code. We expect byte arrays to fail
-        # decoding, but when they don't, we have to convert them to bytes.
-        deserialized_obj = msgpack.loads(
-            serialized_obj, encoding='utf-8', unicode_errors='ignore')
+    def msgpack_decode(data_type, serialized_obj, alias_validators=None, strict=True,
+                       caller_permissions=None, old_style=False):
+        """
+        Performs the reverse operation of :func:`msgpack_encode`. See
+        :func:`json_decode` for the arguments. Input that is not valid
+        msgpack, or holds text that is not valid UTF-8, raises a
+        ValidationError.
+        """
+        try:
+            deserialized_obj = msgpack.unpackb(serialized_obj, raw=False)
+        except (ValueError, msgpack.UnpackException):
+            raise bv.ValidationError('could not decode input as msgpack')
         return msgpack_compat_obj_decode(
-            data_type, deserialized_obj, alias_validators, strict)
+            data_type, deserialized_obj, caller_permissions, alias_validators, strict,
+            old_style)
+
+    def msgpack_decode_iter(stream, data_type, field_name=None, caller_permissions=None,
+                            alias_validators=None, strict=True, old_style=False,
+                            chunk_size=_MSGPACK_CHUNK_SIZE):
+        """
+        Like :func:`json_decode_iter`, for msgpack read from a binary
+        file-like object.
+        """
+        decoder = PythonPrimitiveToStoneDecoder(caller_permissions,
+            alias_validators, True, old_style, strict)
+        return _iter_msgpack_decode(decoder, stream, data_type, field_name, chunk_size)
+
+    def _iter_msgpack_decode(decoder, stream, data_type, field_name, chunk_size):
+        unpacker = msgpack.Unpacker(stream, raw=False, read_size=chunk_size)
+        try:
+            if field_name is None:
+                items = _iter_msgpack_list(unpacker, decoder, data_type, False)
+            else:
+                items = _iter_msgpack_struct_field(unpacker, decoder, data_type, field_name)
+            for item in items:
+                yield item
+            try:
+                unpacker.skip()
+            except msgpack.OutOfData:
+                return
+        except (ValueError, msgpack.UnpackException):
+            pass
+        raise bv.ValidationError('could not decode input as msgpack')
+
+    def _iter_msgpack_struct_field(unpacker, decoder, data_type, field_name):
+        # Mirrors _iter_json_struct_field().
+        assert isinstance(data_type, bv.Struct) and not isinstance(data_type, bv.StructTree), \
+            'Expected a struct without enumerated subtypes, got %r.' % data_type
+        definition = data_type.definition
+        all_fields, all_field_names, _ = decoder.get_struct_fields(definition)
+        field_data_type = dict(all_fields).get(field_name)
+        assert field_data_type is not None, \
+            '%r has no field %r.' % (definition, field_name)
+
+        try:
+            size = unpacker.read_map_header()
+        except ValueError:
+            raise bv.ValidationError('expected object, got %s' %
+                                     bv.generic_type_name(unpacker.unpack()))
+        found = False
+        for _ in six.moves.range(size):
+            key = unpacker.unpack()
+            if not isinstance(key, six.string_types):
+                raise bv.ValidationError('could not decode input as msgpack')
+            if decoder.strict and key not in all_field_names and not key.startswith('.tag'):
+                raise bv.ValidationError("unknown field '%s'" % key)
+            if key == field_name:
+                found = True
+                try:
+                    for item in _iter_msgpack_list(unpacker, decoder, field_data_type, True):
+                        yield item
+                except bv.ValidationError as e:
+                    e.add_parent(field_name)
+                    raise
+            else:
+                unpacker.skip()
+        if not found and not field_data_type.has_default():
+            raise bv.ValidationError("missing required field '%s'" % field_name)
+
+    def _iter_msgpack_list(unpacker, decoder, data_type, validate):
+        nullable = isinstance(data_type, bv.Nullable)
+        if nullable:
+            data_type = data_type.validator
+        assert isinstance(data_type, bv.List), 'Expected a list, got %r.' % data_type
+
+        try:
+            size = unpacker.read_array_header()
+        except ValueError:
+            # The header was not consumed.
+            value = unpacker.unpack()
+            if nullable and value is None:
+                return
+            raise bv.ValidationError('expected list, got %s' % bv.generic_type_name(value))
+        if validate:
+            # The item count is known up front, unlike in JSON.
+            if data_type.max_items is not None and size > data_type.max_items:
+                raise bv.ValidationError('list has more than %s items' % data_type.max_items)
+            if data_type.min_items is not None and size < data_type.min_items:
+                raise bv.ValidationError('list has fewer than %s items' % data_type.min_items)
+        item_validator = data_type.item_validator
+        for _ in six.moves.range(size):
+            item = decoder.json_compat_obj_decode_helper(item_validator, unpacker.unpack())
+            if validate:
+                item = item_validator.validate(item)
+            yield item
+
+# --------------------------------------------------------------
+# Binary
+#
+# A compact encoding driven by the data types, in which struct fields and
+# union tags are identified by small integer ids rather than by name. The
+# Python types backend derives the ids from the names, and records them in
+# the _field_ids_ of struct classes and the _tag_ids_ of union classes.
+#
+#   * Booleans and unsigned integers are varints (unsigned LEB128), and
+#     signed integers zigzag-encoded varints. Floats are little-endian
+#     doubles.
+#   * Strings (UTF-8), bytes and timestamps (formatted as in JSON) are a
+#     varint length followed by that many bytes. Void values take none.
+#   * Lists are a varint count followed by their items, and maps a varint
+#     count followed by each key and its value. A nullable list item, map
+#     value or top-level value is preceded by a byte that is 0 if it is
+#     null, and 1 otherwise.
+#   * A struct is the sequence of its set, non-null fields, each a key
+#     followed by its value, and ends with a zero byte. The key is a varint
+#     of the field's id, shifted left by three bits, or'ed with the wire
+#     type of the value, which tells how to skip fields of unknown ids.
+#     Values that are lists, maps, structs or unions are preceded by their
+#     length in bytes. A struct with enumerated subtypes is preceded by the
+#     tag of its subtype, as a string.
+#   * A union is the key of its tag followed by its value, as if it were
+#     the only field of a struct. Symbols and null values have the wire
+#     type of void.
+#
+# Decoding turns the input into a JSON-compatible object that is then
+# decoded like msgpack, so the same strict and non-strict rules apply as to
+# JSON. Fields and tags of unknown ids are named '#<id>' in that object,
+# and in the errors they cause.
+#
+# The encoding is meant to be small rather than fast to decode: it is read
+# in Python, whereas JSON is parsed by the C parser of the json module, so
+# binary_decode is somewhat slower than json_decode. Both spend most of
+# their time decoding the JSON-compatible object.
+
+_WIRE_VARINT = 0
+_WIRE_FIXED64 = 1
+_WIRE_BYTES = 2
+_WIRE_VOID = 3
+
+_double = struct.Struct('<d')
+
+def _write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else (~n << 1) | 1
+
+def _unzigzag(n):
+    return ~(n >> 1) if n & 1 else n >> 1
+
+def _wire_type(validator):
+    """Returns the wire type of the non-null values of a validator."""
+    if isinstance(validator, bv.Nullable):
+        validator = validator.validator
+    if isinstance(validator, bv.Void):
+        return _WIRE_VOID
+    elif isinstance(validator, (bv.Boolean, bv.Integer)):
+        return _WIRE_VARINT
+    elif isinstance(validator, bv.Real):
+        return _WIRE_FIXED64
+    else:
+        return _WIRE_BYTES
+
+def _is_length_prefixed(validator):
+    """Whether field values of a validator are preceded by their length."""
+    return isinstance(validator, (bv.List, bv.Map, bv.Struct, bv.Union))
+
+def _wire_key(wire_id, wire_type):
+    key = bytearray()
+    _write_varint(key, wire_id << 3 | wire_type)
+    return bytes(key)
+
+def _write_primitive_func(validator):
+    # type: (bv.Primitive) -> typing.Callable[[typing.Any, bytearray], None]
+    """Returns a function that writes a validated primitive value."""
+    if isinstance(validator, bv.Void):
+        return lambda value, out: None
+    elif isinstance(validator, bv.Boolean):
+        return lambda value, out: out.append(1 if value else 0)
+    elif isinstance(validator, (bv.UInt32, bv.UInt64)):
+        return lambda value, out: _write_varint(out, int(value))
+    elif isinstance(validator, bv.Integer):
+        return lambda value, out: _write_varint(out, _zigzag(int(value)))
+    elif isinstance(validator, bv.Real):
+        return lambda value, out: out.extend(_double.pack(value))
+
+    if isinstance(validator, bv.String):
+        to_bytes = lambda value: value.encode('utf-8')  # noqa: E731
+    elif isinstance(validator, bv.Timestamp):
+        format_value = _get_timestamp_codec(validator.format).format_value
+        to_bytes = lambda value: format_value(value).encode('utf-8')  # noqa: E731
+    else:
+        to_bytes = bytes
+
+    def write(value, out):
+        data = to_bytes(value)
+        _write_varint(out, len(data))
+        out.extend(data)
+    return write
+
+
+class _BinaryWriterCompiler(object):
+    """
+    Compiles functions that validate a value and append its binary encoding
+    to a bytearray, much like _EncodePlanCompiler compiles encode plans. The
+    writers are cached on the validators along with the plans, and share the
+    plan compiler's handling of caller permissions.
+    """
+
+    def __init__(self, plan_compiler):
+        # type: (_EncodePlanCompiler) -> None
+        self.plans = plan_compiler
+        self.key = ('binary',) + plan_compiler.key
+        self.element_key = ('binary',) + plan_compiler.element_key
+
+    def get_writer(self, validator):
+        # type: (bv.Validator) -> typing.Callable[[typing.Any, bytearray], None]
+        return self.plans._get_cached_plan(validator, self.key, self._compile)
+
+    def get_element_writer(self, validator):
+        # type: (bv.Validator) -> typing.Callable[[typing.Any, bytearray], None]
+        """
+        Returns a writer that validates a value like ``validator.validate()``.
+        """
+        return self.plans._get_cached_plan(validator, self.element_key, self._compile_element)
+
+    def _compile(self, validator):
+        if isinstance(validator, bv.List):
+            return self._compile_list(validator)
+        elif isinstance(validator, bv.Map):
+            return self._compile_map(validator)
+        elif isinstance(validator, bv.Nullable):
+            return self._compile_nullable(self.get_writer(validator.validator))
+        elif isinstance(validator, bv.Primitive):
+            return self._compile_primitive(validator)
+        elif isinstance(validator, bv.StructTree):
+            return self._compile_struct_tree(validator)
+        elif isinstance(validator, bv.Struct):
+            return self._compile_struct(validator, self.plans.compile_struct_check(validator))
+        elif isinstance(validator, bv.Union):
+            return self._compile_union(validator)
+        else:
+            raise bv.ValidationError('Unsupported data type {}'.format(type(validator).__name__))
+
+    def _compile_element(self, validator):
+        if isinstance(validator, bv.Nullable):
+            return self._compile_nullable(self.get_element_writer(validator.validator))
+        elif isinstance(validator, bv.Struct) and not isinstance(validator, bv.StructTree) \
+                and not self.plans.permissions:
+            return self._compile_struct(validator, validator.validate)
+        else:
+            # Like in _EncodePlanCompiler._compile_element(), the remaining
+            # writers already validate values fully.
+            return self.get_writer(validator)
+
+    def _compile_list(self, validator):
+        validate = validator.validate_type_only
+        write_item = self.get_element_writer(validator.item_validator)
+
+        def write(value, out):
+            validate(value)
+            _write_varint(out, len(value))
+            for item in value:
+                write_item(item, out)
+        return write
+
+    def _compile_map(self, validator):
+        validate = validator.validate_type_only
+        write_key = self.get_element_writer(validator.key_validator)
+        write_value = self.get_element_writer(validator.value_validator)
+
+        def write(value, out):
+            validate(value)
+            _write_varint(out, len(value))
+            for k, v in value.items():
+                write_key(k, out)
+                write_value(v, out)
+        return write
+
+    def _compile_nullable(self, write_value):
+        def write(value, out):
+            if value is None:
+                out.append(0)
+            else:
+                out.append(1)
+                write_value(value, out)
+        return write
+
+    def _compile_primitive(self, validator):
+        validate = validator.validate
+        alias_validator = self.plans.alias_validators.get(validator)
+        write_value = _write_primitive_func(validator)
+
+        if alias_validator is not None:
+            def write(value, out):
+                value = validate(value)
+                alias_validator(value)
+                write_value(value, out)
+        else:
+            def write(value, out):
+                write_value(validate(value), out)
+        return write
+
+    def compile_field(self, validator):
+        # type: (bv.Validator) -> typing.Callable[[typing.Any, bytearray], None]
+        """
+        Returns a writer for the non-null values of a struct field or union
+        tag, which are preceded by their length if need be.
+        """
+        if isinstance(validator, bv.Nullable):
+            validator = validator.validator
+        write_value = self.get_writer(validator)
+        if not _is_length_prefixed(validator):
+            return write_value
+
+        def write(value, out):
+            buf = bytearray()
+            write_value(value, buf)
+            _write_varint(out, len(buf))
+            out.extend(buf)
+        return write
+
+    def _compile_struct(self, validator, validate):
+        write_fields = self._compile_struct_fields(validator.definition)
+
+        def write(value, out):
+            validate(value)
+            write_fields(value, out)
+        return write
+
+    def _compile_struct_tree(self, validator):
+        if self.plans.permissions:
+            validate = self.plans.compile_struct_check(validator)
+        else:
+            validate = validator.validate
+        definition = validator.definition
+        subtypes = {}  # type: typing.Dict[type, typing.Tuple[bytes, typing.Callable]]
+
+        def write(value, out):
+            validate(value)
+            pytype = type(value)
+            try:
+                tag, write_fields = subtypes[pytype]
+            except KeyError:
+                tag, write_fields = subtypes[pytype] = self._compile_subtype(
+                    definition, pytype)
+            out.extend(tag)
+            write_fields(value, out)
+        return write
+
+    def _compile_subtype(self, definition, pytype):
+        # Mirrors _EncodePlanCompiler._compile_subtype().
+        pytype = getattr(pytype, '_lazy_definition_', pytype)
+        assert pytype in definition._pytype_to_tag_and_subtype_, \
+            '%r is not a serializable subtype of %r.' % (pytype, definition)
+
+        tags, subtype = definition._pytype_to_tag_and_subtype_[pytype]
+
+        assert len(tags) == 1, tags
+        assert not isinstance(subtype, bv.StructTree), \
+            'Cannot serialize type %r because it enumerates subtypes.' % subtype.definition
+
+        tag = bytearray()
+        _write_primitive_func(bv.String())(tags[0], tag)
+        return bytes(tag), self._compile_struct_fields(subtype.definition)
+
+    def _compile_struct_fields(self, definition):
+        table = []  # type: typing.List[typing.List[typing.Tuple[typing.Text, typing.Text, bytes, typing.Callable]]] # noqa: E501
+
+        def build_table():
+            field_ids = definition._field_ids_
+            return [(field_name, presence_key,
+                     _wire_key(field_ids[field_name], _wire_type(field_validator)),
+                     self.compile_field(field_validator))
+                    for field_name, presence_key, field_validator
+                    in self.plans.struct_fields(definition)]
+
+        def write_fields(value, out):
+            if not table:
+                table[:] = [build_table()]
+            for field_name, presence_key, key, write_field in table[0]:
+                try:
+                    field_value = getattr(value, field_name)
+                except AttributeError as exc:
+                    raise bv.ValidationError(exc.args[0])
+
+                if field_value is not None and getattr(value, presence_key):
+                    out.extend(key)
+                    try:
+                        write_field(field_value, out)
+                    except bv.ValidationError as exc:
+                        exc.add_parent(field_name)
+                        raise
+            out.append(0)
+        return write_fields
+
+    def _compile_union(self, validator):
+        # Fields are already validated on assignment
+        validate = validator.validate_type_only
+        definition = validator.definition
+        table = []  # type: typing.List[typing.Dict[typing.Text, typing.Callable]]
+
+        def write(value, out):
+            validate(value)
+            tag = value._tag
+            if tag is None:
+                raise bv.ValidationError('no tag set')
+            if not table:
+                table[:] = [self._build_union_table(definition)]
+            try:
+                write_variant = table[0][tag]
+            except KeyError:
+                raise bv.ValidationError(
+                    "caller does not have access to '{}' tag".format(tag))
+            write_variant(value, out)
+        return write
+
+    def _build_union_table(self, definition):
+        # Mirrors _EncodePlanCompiler._build_union_table().
+        tagmap = dict(definition._tagmap)
+        for extra_permission in reversed(self.plans.permissions):
+            tagmap_name = '_{}_tagmap'.format(extra_permission)
+            tagmap.update(getattr(definition, tagmap_name, {}))
+        tag_ids = definition._tag_ids_
+        return {tag: self._compile_variant(tag, tag_ids[tag], field_validator)
+                for tag, field_validator in tagmap.items()}
+
+    def _compile_variant(self, tag, wire_id, field_validator):
+        void_key = _wire_key(wire_id, _WIRE_VOID)
+        if field_validator is None or isinstance(field_validator, bv.Void):
+            return lambda value, out: out.extend(void_key)
+
+        key = _wire_key(wire_id, _wire_type(field_validator))
+        write_field = self.compile_field(field_validator)
+
+        def write_variant(value, out):
+            if value._value is None:
+                # Only nullable tags may hold None
+                out.extend(void_key)
+                return
+            out.extend(key)
+            try:
+                write_field(value._value, out)
+            except bv.ValidationError as exc:
+                exc.add_parent(tag)
+                raise
+        return write_variant
+
+
+class StoneToBinarySerializer(object):
+    """
+    Encodes values in the binary encoding described above. Field masks,
+    redaction and the old style are not supported. Unlike the serializers
+    derived from StoneSerializerBase, it has no encoding hooks to override,
+    since values are only encoded by compiled writers.
+    """
+
+    def __init__(self, caller_permissions, alias_validators):
+        # type: (typing.Optional[CallerPermissionsInterface], typing.Optional[typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]]]) -> None # noqa: E501
+        """
+        See :class:`StoneSerializerBase` for the arguments.
+        """
+        caller_permissions = caller_permissions or CallerPermissionsDefault()
+        self._compiler = _BinaryWriterCompiler(_EncodePlanCompiler(
+            caller_permissions.permissions, alias_validators or {}, True, False, False))
+
+    def encode(self, validator, value):
+        """Returns the binary encoding of ``value`` as bytes."""
+        out = bytearray()
+        self._compiler.get_writer(validator)(value, out)
+        return bytes(out)
+
+
+class _BinaryInput(object):
+    """Binary-encoded input, and the position up to which it has been read."""
+
+    __slots__ = ('data', 'pos')
+
+    def __init__(self, data):
+        # type: (bytearray) -> None
+        self.data = data
+        self.pos = 0
+
+    def read_varint(self):
+        data = self.data
+        pos = self.pos
+        n = data[pos]
+        pos += 1
+        if n >= 0x80:
+            n &= 0x7f
+            shift = 7
+            while True:
+                b = data[pos]
+                pos += 1
+                n |= (b & 0x7f) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+        self.pos = pos
+        return n
+
+    def read_double(self):
+        value, = _double.unpack_from(self.data, self.pos)
+        self.pos += 8
+        return value
+
+    def read_bytes(self):
+        size = self.read_varint()
+        end = self.pos + size
+        if end > len(self.data):
+            raise IndexError(end)
+        data = bytes(self.data[self.pos:end])
+        self.pos = end
+        return data
+
+    def read_text(self):
+        size = self.read_varint()
+        end = self.pos + size
+        if end > len(self.data):
+            raise IndexError(end)
+        # Decodes the slice directly, without copying it into bytes first.
+        data = self.data[self.pos:end]
+        self.pos = end
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            raise bv.ValidationError('could not decode input as binary')
+
+    def skip(self, wire_type):
+        if wire_type == _WIRE_VARINT:
+            self.read_varint()
+        elif wire_type == _WIRE_FIXED64:
+            self.pos += 8
+        elif wire_type == _WIRE_BYTES:
+            self.read_bytes()
+        elif wire_type != _WIRE_VOID:
+            raise bv.ValidationError('could not decode input as binary')
+
+
+class _BinaryReaderCompiler(object):
+    """
+    Compiles functions that read a binary-encoded value from a _BinaryInput
+    into a JSON-compatible object, which is then decoded like msgpack. The
+    readers are cached on the validators, keyed by strictness.
+    """
+
+    def __init__(self, strict):
+        # type: (bool) -> None
+        self.strict = strict
+        self.key = ('binary', strict)
+
+    def get_reader(self, validator):
+        # type: (bv.Validator) -> typing.Callable[[_BinaryInput], typing.Any]
+        """Returns a reader for values written outside of struct fields and unions."""
+        readers = getattr(validator, '_decode_plans', None)
+        if readers is None:
+            readers = validator._decode_plans = {}
+        reader = readers.get(self.key)
+        if reader is None:
+            reader = readers[self.key] = self._compile(validator)
+        return reader
+
+    def _compile(self, validator):
+        if isinstance(validator, bv.Nullable):
+            return self._compile_nullable(validator)
+        elif isinstance(validator, bv.Void):
+            return lambda inp: None
+        elif isinstance(validator, bv.Boolean):
+            return lambda inp: bool(inp.read_varint())
+        elif isinstance(validator, (bv.UInt32, bv.UInt64)):
+            return _BinaryInput.read_varint
+        elif isinstance(validator, bv.Integer):
+            return lambda inp: _unzigzag(inp.read_varint())
+        elif isinstance(validator, bv.Real):
+            return _BinaryInput.read_double
+        elif isinstance(validator, bv.Bytes):
+            return _BinaryInput.read_bytes
+        elif isinstance(validator, bv.Primitive):
+            return _BinaryInput.read_text
+        elif isinstance(validator, bv.List):
+            return self._compile_list(validator)
+        elif isinstance(validator, bv.Map):
+            return self._compile_map(validator)
+        elif isinstance(validator, bv.StructTree):
+            return self._compile_struct_tree(validator)
+        elif isinstance(validator, bv.Struct):
+            read_fields = self._compile_struct_fields(validator.definition)
+            return lambda inp: read_fields(inp, collections.OrderedDict())
+        elif isinstance(validator, bv.Union):
+            return self._compile_union(validator)
+        else:
+            raise AssertionError('Cannot handle type %r.' % validator)
+
+    def _compile_nullable(self, validator):
+        read_value = self.get_reader(validator.validator)
+
+        def read(inp):
+            flag = inp.read_varint()
+            if flag == 0:
+                return None
+            elif flag != 1:
+                raise bv.ValidationError('could not decode input as binary')
+            return read_value(inp)
+        return read
+
+    def _compile_list(self, validator):
+        read_items = self._compile_varint_items(validator.item_validator)
+        if read_items is not None:
+            return read_items
+        read_item = self.get_reader(validator.item_validator)
+        # Every item but a void one takes at least a byte.
+        check_count = not isinstance(validator.item_validator, bv.Void)
+
+        def read(inp):
+            count = inp.read_varint()
+            if check_count and count > len(inp.data) - inp.pos:
+                raise IndexError(count)
+            return [read_item(inp) for _ in six.moves.range(count)]
+        return read
+
+    def _compile_varint_items(self, item_validator):
+        """
+        Returns a reader of a list of booleans or integers, or of nullable
+        ones, which reads the varints of the items inline rather than calling
+        a reader for each, or None for lists of other items.
+        """
+        nullable = isinstance(item_validator, bv.Nullable)
+        if nullable:
+            item_validator = item_validator.validator
+        boolean = isinstance(item_validator, bv.Boolean)
+        if not boolean and not isinstance(item_validator, bv.Integer):
+            return None
+        signed = not boolean and not isinstance(item_validator, (bv.UInt32, bv.UInt64))
+
+        def read(inp):
+            count = inp.read_varint()
+            data = inp.data
+            pos = inp.pos
+            if count > len(data) - pos:
+                raise IndexError(count)
+            items = []  # type: typing.List[typing.Any]
+            append = items.append
+            for _ in six.moves.range(count):
+                if nullable:
+                    flag = data[pos]
+                    pos += 1
+                    if flag == 0:
+                        append(None)
+                        continue
+                    elif flag != 1:
+                        raise bv.ValidationError('could not decode input as binary')
+                n = data[pos]
+                pos += 1
+                if n >= 0x80:
+                    inp.pos = pos - 1
+                    n = inp.read_varint()
+                    pos = inp.pos
+                if signed:
+                    n = ~(n >> 1) if n & 1 else n >> 1
+                append(bool(n) if boolean else n)
+            inp.pos = pos
+            return items
+        return read
+
+    def _compile_map(self, validator):
+        read_key = self.get_reader(validator.key_validator)
+        read_value = self.get_reader(validator.value_validator)
+
+        def read(inp):
+            count = inp.read_varint()
+            if count > len(inp.data) - inp.pos:
+                raise IndexError(count)
+            obj = {}
+            for _ in six.moves.range(count):
+                key = read_key(inp)
+                obj[key] = read_value(inp)
+            return obj
+        return read
+
+    def _compile_struct_tree(self, validator):
+        definition = validator.definition
+        subtypes = {}  # type: typing.Dict[typing.Text, typing.Callable]
+
+        def read(inp):
+            tag = inp.read_text()
+            try:
+                read_fields = subtypes[tag]
+            except KeyError:
+                # Fields of unknown subtypes are read as fields of the base,
+                # which the decoder uses in non-strict mode.
+                subtype = definition._tag_to_subtype_.get((tag,))
+                read_fields = subtypes[tag] = self._compile_struct_fields(
+                    definition if subtype is None else subtype.definition)
+            obj = collections.OrderedDict()  # type: typing.Dict[typing.Text, typing.Any]
+            obj['.tag'] = tag
+            return read_fields(inp, obj)
+        return read
+
+    def _compile_field(self, validator):
+        # type: (bv.Validator) -> typing.Callable[[_BinaryInput, int], typing.Any]
+        """
+        Returns a function that reads the value of a struct field or union
+        tag of a given wire type, or returns None for a null value.
+        """
+        nullable = False
+        if isinstance(validator, bv.Nullable):
+            nullable = True
+            validator = validator.validator
+        expected_wire_type = _wire_type(validator)
+        read_value = self.get_reader(validator)
+        length_prefixed = _is_length_prefixed(validator)
+        # Like in JSON, the value of a void tag, which may have had another
+        # type, is ignored in non-strict mode.
+        ignore_value = isinstance(validator, bv.Void) and not self.strict
+
+        def read_field(inp, wire_type):
+            if wire_type != expected_wire_type:
+                if nullable and wire_type == _WIRE_VOID:
+                    return None
+                elif ignore_value:
+                    inp.skip(wire_type)
+                    return None
+                raise bv.ValidationError('expected wire type %d, got %d'
+                                         % (expected_wire_type, wire_type))
+            if not length_prefixed:
+                return read_value(inp)
+
+            end = inp.read_varint() + inp.pos
+            value = read_value(inp)
+            if inp.pos != end:
+                raise bv.ValidationError('could not decode input as binary')
+            return value
+        return read_field
+
+    def _compile_struct_fields(self, definition):
+        """
+        Returns a function that reads the fields of an instance of
+        ``definition`` into a given dict and returns it.
+        """
+        table = []  # type: typing.List[typing.Dict[int, typing.Tuple[typing.Text, typing.Callable]]] # noqa: E501
+
+        def build_table():
+            fields = {}
+            for field_name, wire_id in definition._field_ids_.items():
+                field_validator = getattr(definition, '_%s_validator' % field_name)
+                fields[wire_id] = (field_name, self._compile_field(field_validator))
+            return fields
+
+        def read_fields(inp, obj):
+            if not table:
+                table[:] = [build_table()]
+            fields = table[0]
+            read_varint = inp.read_varint
+            while True:
+                key = read_varint()
+                if key == 0:
+                    return obj
+                try:
+                    field_name, read_field = fields[key >> 3]
+                except KeyError:
+                    inp.skip(key & 7)
+                    obj['#%d' % (key >> 3)] = None
+                    continue
+                try:
+                    obj[field_name] = read_field(inp, key & 7)
+                except bv.ValidationError as e:
+                    e.add_parent(field_name)
+                    raise
+        return read_fields
+
+    def _compile_union(self, validator):
+        definition = validator.definition
+        table = []  # type: typing.List[typing.Dict[int, typing.Tuple[typing.Text, typing.Callable, bool]]] # noqa: E501
+
+        def build_table():
+            variants = {}
+            for tag, wire_id in definition._tag_ids_.items():
+                field_validator = getattr(definition, '_%s_validator' % tag)
+                variants[wire_id] = (tag, self._compile_field(field_validator),
+                                     _is_flat_struct(field_validator))
+            return variants
+
+        def read(inp):
+            if not table:
+                table[:] = [build_table()]
+            key = inp.read_varint()
+            obj = collections.OrderedDict()  # type: typing.Dict[typing.Text, typing.Any]
+            try:
+                tag, read_field, is_flat_struct = table[0][key >> 3]
+            except KeyError:
+                inp.skip(key & 7)
+                obj['.tag'] = '#%d' % (key >> 3)
+                return obj
+
+            obj['.tag'] = tag
+            try:
+                value = read_field(inp, key & 7)
+            except bv.ValidationError as e:
+                e.add_parent(tag)
+                raise
+            if value is None:
+                pass
+            elif is_flat_struct:
+                obj.update(value)
+            else:
+                obj[tag] = value
+            return obj
+        return read
+
+def _is_flat_struct(validator):
+    if isinstance(validator, bv.Nullable):
+        validator = validator.validator
+    return isinstance(validator, bv.Struct) and not isinstance(validator, bv.StructTree)
+
+def binary_encode(data_type, obj, caller_permissions=None, alias_validators=None):
+    """
+    Encodes an object into the binary encoding described in the binary
+    section of this module. See :func:`json_encode` for the arguments and
+    validation.
+
+    Returns:
+        bytes: The encoded object.
+    """
+    serializer = StoneToBinarySerializer(caller_permissions, alias_validators)
+    return serializer.encode(data_type, obj)
+
+def binary_decode(data_type, serialized_obj, caller_permissions=None, alias_validators=None,
+                  strict=True, lazy=False):
+    """
+    Performs the reverse operation of :func:`binary_encode`. See
+    :func:`json_decode` for the arguments. Input that is truncated, has
+    trailing bytes, or holds text that is not valid UTF-8, raises a
+    ValidationError.
+    """
+    inp = _BinaryInput(bytearray(serialized_obj))
+    try:
+        obj = _BinaryReaderCompiler(strict).get_reader(data_type)(inp)
+    except (IndexError, struct.error):
+        raise bv.ValidationError('could not decode input as binary')
+    if inp.pos != len(inp.data):
+        raise bv.ValidationError('could not decode input as binary')
+    decoder = PythonPrimitiveToStoneDecoder(caller_permissions,
+        alias_validators, True, False, strict, lazy)
+    return decoder.decode(data_type, obj)
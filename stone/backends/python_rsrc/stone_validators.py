@@ -18,6 +18,7 @@ import hashlib
 import math
 import numbers
 import re
+import sys
 import six
 
 _MYPY = False
@@ -30,6 +31,60 @@ if six.PY3:
 else:
     _binary_types = (bytes, buffer)  # noqa: E501,F821 # pylint: disable=undefined-variable,useless-suppression
 
+# Exact item types that the bulk list checks accept. Anything else, including
+# subclasses, is validated one item at a time.
+_bool_types = frozenset([bool])
+_integer_types = frozenset(six.integer_types + (bool,))
+_real_types = frozenset(six.integer_types + (bool, float))
+_text_types = frozenset([six.text_type])
+
+# Lists of real numbers with at least this many items are checked with NumPy
+# when it is installed.
+_NUMPY_MIN_ITEMS = 4096
+
+_numpy = False  # type: typing.Any
+
+
+def _get_numpy():
+    """Returns the numpy module, or None if it is not installed."""
+    global _numpy  # pylint: disable=global-statement
+    if _numpy is False:
+        try:
+            import numpy  # pylint: disable=import-error,useless-suppression
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+# Whether the bulk checks of each validator class can stand in for its validate().
+_bulk_check_classes = {}  # type: typing.Dict[type, bool]
+
+
+def _has_bulk_check(validator):
+    """
+    Subclasses that override validate() without also overriding the bulk
+    checks have their items validated one at a time.
+    """
+    cls = type(validator)
+    has_bulk_check = _bulk_check_classes.get(cls)
+    if has_bulk_check is None:
+        for base in cls.__mro__:
+            if '_validate_items' in vars(base):
+                has_bulk_check = True
+                break
+            elif 'validate' in vars(base):
+                has_bulk_check = False
+                break
+        _bulk_check_classes[cls] = has_bulk_check
+    return has_bulk_check
+
+
+def _is_ndarray(val):
+    # An array can only exist once numpy is imported, so don't import it here.
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(val, numpy.ndarray)
+
 
 class ValidationError(Exception):
     """Raised when a value doesn't pass validation by its validator."""
@@ -96,6 +151,12 @@ class Validator(object):
     """All primitive and composite data types should be a subclass of this."""
     __metaclass__ = ABCMeta
 
+    # The encode and decode plans that stone_serializers compiles for a
+    # validator, cached on it by the options they were compiled with.
+    _encode_plans = None  # type: typing.Optional[typing.Dict[typing.Any, typing.Callable]]
+    _masked_encode_plans = None  # type: typing.Optional[typing.Dict[typing.Any, typing.Callable]]
+    _decode_plans = None  # type: typing.Optional[typing.Dict[typing.Any, typing.Callable]]
+
     @abstractmethod
     def validate(self, val):
         """Validates that val is of this data type.
@@ -111,6 +172,26 @@ class Validator(object):
     def get_default(self):
         raise AssertionError('No default available.')
 
+    def _validate_items(self, vals):
+        """Validates all items of a list or tuple at once.
+
+        Returns: A list of normalized values, or None if there is no bulk
+            check for this data type or any item fails it. The items must
+            then be validated one at a time, which reports the failure.
+        """
+
+    def _validate_array(self, arr):
+        """Like _validate_items(), for a one-dimensional NumPy array."""
+
+    def __getstate__(self):
+        # The plans are closures, which cannot be pickled. They are compiled
+        # again on use.
+        state = self.__dict__.copy()
+        state.pop('_encode_plans', None)
+        state.pop('_masked_encode_plans', None)
+        state.pop('_decode_plans', None)
+        return state
+
 
 class Primitive(Validator):
     """A basic type that is defined by Stone."""
@@ -125,6 +206,11 @@ class Boolean(Primitive):
             raise ValidationError('%r is not a valid boolean' % val)
         return val
 
+    def _validate_items(self, vals):
+        if set(map(type, vals)) <= _bool_types:
+            return list(vals)
+        return None
+
 
 class Integer(Primitive):
     """
@@ -163,6 +249,22 @@ class Integer(Primitive):
                                   % (val, self.minimum, self.maximum))
         return val
 
+    def _validate_items(self, vals):
+        if not set(map(type, vals)) <= _integer_types:
+            return None
+        if vals and not (self.minimum <= min(vals) and max(vals) <= self.maximum):
+            return None
+        return list(vals)
+
+    def _validate_array(self, arr):
+        if arr.dtype.kind not in 'iu':
+            return None
+        # Compare as Python ints, which never overflow.
+        if arr.size and not (self.minimum <= int(arr.min())
+                             and int(arr.max()) <= self.maximum):
+            return None
+        return arr.tolist()
+
     def __repr__(self):
         return '%s()' % self.__class__.__name__
 
@@ -249,6 +351,41 @@ class Real(Primitive):
                                   (val, self.maximum))
         return val
 
+    def _validate_items(self, vals):
+        if not set(map(type, vals)) <= _real_types:
+            return None
+        numpy = _get_numpy() if len(vals) >= _NUMPY_MIN_ITEMS else None
+        if numpy is not None:
+            try:
+                arr = numpy.fromiter(vals, numpy.float64, len(vals))
+            except OverflowError:
+                return None
+            return self._validate_array(arr)
+        try:
+            vals = list(map(float, vals))
+        except OverflowError:
+            return None
+        if vals and (any(map(math.isnan, vals))
+                     or not self._in_range(min(vals), max(vals))):
+            return None
+        return vals
+
+    def _validate_array(self, arr):
+        if arr.dtype.kind not in 'fiu':
+            return None
+        arr = arr.astype('float64')
+        # NaN propagates through the min() and max() of arrays.
+        if arr.size and not self._in_range(float(arr.min()), float(arr.max())):
+            return None
+        return arr.tolist()
+
+    def _in_range(self, lowest, highest):
+        """Whether every value between lowest and highest passes validation."""
+        return (not math.isnan(lowest) and not math.isnan(highest)
+                and not math.isinf(lowest) and not math.isinf(highest)
+                and (self.minimum is None or lowest >= self.minimum)
+                and (self.maximum is None or highest <= self.maximum))
+
     def __repr__(self):
         return '%s()' % self.__class__.__name__
 
@@ -263,6 +400,28 @@ class Float64(Real):
     pass
 
 
+# Compiled patterns of String validators, shared by every validator with the
+# same pattern. Validators keep their own compiled pattern, so the cache is
+# only needed while a module's validators are defined, and is simply cleared
+# once it holds _MAX_PATTERN_RES patterns.
+_pattern_res = {}  # type: typing.Dict[typing.Text, typing.Pattern]
+_MAX_PATTERN_RES = 1024
+
+
+def _compile_pattern(pattern):
+    pattern_re = _pattern_res.get(pattern)
+    if pattern_re is None:
+        try:
+            pattern_re = re.compile(r"\A(?:" + pattern + r")\Z")
+        except re.error as e:
+            raise AssertionError('Regex {!r} failed: {}'.format(
+                pattern, e.args[0]))
+        if len(_pattern_res) >= _MAX_PATTERN_RES:
+            _pattern_res.clear()
+        _pattern_res[pattern] = pattern_re
+    return pattern_re
+
+
 class String(Primitive):
     """Represents a unicode string."""
 
@@ -287,11 +446,7 @@ class String(Primitive):
         self.pattern_re = None
 
         if pattern:
-            try:
-                self.pattern_re = re.compile(r"\A(?:" + pattern + r")\Z")
-            except re.error as e:
-                raise AssertionError('Regex {!r} failed: {}'.format(
-                    pattern, e.args[0]))
+            self.pattern_re = _compile_pattern(pattern)
 
     def validate(self, val):
         """
@@ -320,6 +475,12 @@ class String(Primitive):
                                   % (val, self.pattern))
         return val
 
+    def _validate_items(self, vals):
+        if (self.max_length is None and self.min_length is None
+                and not self.pattern and set(map(type, vals)) <= _text_types):
+            return list(vals)
+        return None
+
 
 class Bytes(Primitive):
 
@@ -401,6 +562,30 @@ class List(Composite):
         self.max_items = max_items
 
     def validate(self, val):
+        """
+        Primitive items are checked in bulk where possible. A NumPy array is
+        accepted as the equivalent list, which is returned.
+        """
+        bulk = _has_bulk_check(self.item_validator)
+        if _is_ndarray(val):
+            items = None
+            if bulk and val.ndim == 1:
+                items = self.item_validator._validate_array(val)
+            if items is not None:
+                self.validate_type_only(items)
+                return items
+            val = val.tolist()
+        self.validate_type_only(val)
+        items = self.item_validator._validate_items(val) if bulk else None
+        if items is None:
+            items = [self.item_validator.validate(item) for item in val]
+        return items
+
+    def validate_type_only(self, val):
+        """
+        Use this when you only want to validate that val is a list of an
+        acceptable length, but not yet validate each item.
+        """
         if not isinstance(val, (tuple, list)):
             raise ValidationError('%r is not a valid list' % val)
         elif self.max_items is not None and len(val) > self.max_items:
@@ -409,7 +594,6 @@ class List(Composite):
         elif self.min_items is not None and len(val) < self.min_items:
             raise ValidationError('%r has fewer than %s items'
                                   % (val, self.min_items))
-        return [self.item_validator.validate(item) for item in val]
 
 
 class Map(Composite):
@@ -424,13 +608,20 @@ class Map(Composite):
         self.value_validator = value_validator
 
     def validate(self, val):
-        if not isinstance(val, dict):
-            raise ValidationError('%r is not a valid dict' % val)
+        self.validate_type_only(val)
         return {
             self.key_validator.validate(key):
                 self.value_validator.validate(value) for key, value in val.items()
         }
 
+    def validate_type_only(self, val):
+        """
+        Use this when you only want to validate that val is a dict, but not
+        yet validate each key and value.
+        """
+        if not isinstance(val, dict):
+            raise ValidationError('%r is not a valid dict' % val)
+
 
 class Struct(Composite):
 
@@ -476,9 +667,13 @@ class Struct(Composite):
         This method assumes that the contents of each field have already been
         validated on assignment, so it's merely a presence check.
 
-        FIXME(kelkabany): Since the definition object does not maintain a list
-        of which fields are required, all fields are scanned.
+        Classes generated with a presence bitmask record which fields are
+        required in ``_required_mask_``, so that the check is a single
+        comparison. Otherwise, all fields are scanned.
         """
+        required_mask = getattr(self.definition, '_required_mask_', None)
+        if required_mask is not None and val._presence & required_mask == required_mask:
+            return
         for field_name in self.definition._all_field_names_:
             if not hasattr(val, field_name):
                 raise ValidationError("missing required field '%s'" %
@@ -628,6 +823,9 @@ class Redactor(object):
             regex: What parts of the field to redact.
         """
         self.regex = regex
+        # Compiled once, rather than looked up in the cache of the re module
+        # for every value redacted.
+        self._pattern = re.compile(regex) if regex else None
 
     @abstractmethod
     def apply(self, val):
@@ -637,10 +835,10 @@ class Redactor(object):
         pass
 
     def _get_matches(self, val):
-        if not self.regex:
+        if self._pattern is None:
             return None
         try:
-            return re.search(self.regex, val)
+            return self._pattern.search(val)
         except TypeError:
             return None
 
@@ -654,7 +852,7 @@ class HashRedactor(Redactor):
         try:
             # add string literal to ensure unicode
             hashed = hashlib.md5(val_to_hash.encode('utf-8')).hexdigest() + ''
-        except [AttributeError, ValueError]:
+        except (AttributeError, ValueError):
             hashed = None
 
         if matches:
@@ -4,9 +4,11 @@ Backend for generating Python types that match the spec.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import collections
 import os
 import re
 import shutil
+import zlib
 
 _MYPY = False
 if _MYPY:
@@ -27,6 +29,7 @@ from stone.ir import (
     is_alias,
     is_boolean_type,
     is_bytes_type,
+    is_integer_type,
     is_list_type,
     is_map_type,
     is_nullable_type,
@@ -40,6 +43,7 @@ from stone.ir import (
     is_void_type,
     RedactedBlot,
     RedactedHash,
+    unwrap,
     unwrap_aliases,
     unwrap_nullable,
 )
@@ -71,6 +75,92 @@ _cmdline_parser.add_argument(
           '{route} for the route name. This is used to translate Stone doc '
           'references to routes to references in Python docstrings.'),
 )
+_cmdline_parser.add_argument(
+    '--generate-codecs',
+    action='store_true',
+    help=('Generate a specialized JSON-compatible encoder and decoder for each '
+          'struct and union. stone_serializers uses them in place of its '
+          'generic codec whenever no caller permissions, alias validators or '
+          'redaction are in effect.'),
+)
+_cmdline_parser.add_argument(
+    '--presence-bitmask',
+    action='store_true',
+    help=('Track which fields of a struct are set in a single integer bitmask '
+          'per instance, instead of a boolean slot per field. This halves the '
+          'number of slots and lets required fields be checked with a single '
+          'mask comparison.'),
+)
+_cmdline_parser.add_argument(
+    '--trusted-constructors',
+    action='store_true',
+    help=('Give each struct class a _new_trusted() class method that builds '
+          'an instance from already validated field values without validating '
+          'them again.'),
+)
+_cmdline_parser.add_argument(
+    '--lazy-namespaces',
+    action='store_true',
+    help=('Define the data types and routes of a namespace module, and import '
+          'the namespaces it references, on first access of one of its names '
+          'rather than at import time. Requires Python 3.7+ to take effect; '
+          'older versions load the module eagerly.'),
+)
+_cmdline_parser.add_argument(
+    '--frozen-types',
+    action='store_true',
+    help=('Make structs immutable once constructed: setting or deleting a field '
+          'raises AttributeError. List and map values of structs and unions are '
+          'stored as read-only copies. stone_serializers caches the encoding of '
+          'each struct instance per serializer configuration; the cached '
+          'encodings are shared and must not be modified.'),
+)
+
+# Defines the names of a namespace module on first access, using the module
+# __getattr__ of PEP 562. The definitions are emitted in _define().
+_lazy_namespace_loader = """\
+import sys as _sys
+import threading as _threading
+
+_load_lock = _threading.RLock()
+_loading = False
+
+
+def _load():
+    global _loading
+    with _load_lock:
+        if _loading:
+            return
+        _loading = True
+        try:
+            definitions = _define()
+            for value in definitions.values():
+                if isinstance(value, type) and value.__module__ == __name__:
+                    # So that pickle finds the class by name
+                    value.__qualname__ = value.__name__
+            globals().update(definitions)
+        except BaseException:
+            _loading = False
+            raise
+
+
+def __getattr__(name):
+    if name.startswith('__') and name != '__all__':
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    _load()
+    if name == '__all__':
+        return [n for n in globals() if not n.startswith('_')]
+    try:
+        return globals()[name]
+    except KeyError:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    _load()
+    return sorted(globals())
+
+"""
 
 
 class PythonTypesBackend(CodeBackend):
@@ -81,6 +171,10 @@ class PythonTypesBackend(CodeBackend):
     # Instance var of the current namespace being generated
     cur_namespace = None  # type: typing.Optional[ApiNamespace]
 
+    # Names of the validators shared by the fields of the current namespace,
+    # keyed by their constructor.
+    shared_validators = {}  # type: typing.Dict[typing.Text, typing.Text]
+
     preserve_aliases = True
 
     def generate(self, api):
@@ -123,6 +217,23 @@ class PythonTypesBackend(CodeBackend):
 
         self.emit_raw(validators_import)
 
+        if self.args.lazy_namespaces:
+            self.emit_raw(_lazy_namespace_loader)
+            self.emit()
+            self.emit('def _define():')
+            with self.indent():
+                self._generate_namespace_definitions(api, namespace)
+                self.emit('return locals()')
+            self.emit()
+            self.emit()
+            self.emit('if _sys.version_info < (3, 7):')
+            with self.indent():
+                self.emit('_load()')
+        else:
+            self._generate_namespace_definitions(api, namespace)
+
+    def _generate_namespace_definitions(self, api, namespace):
+        """Defines the data types and routes of a namespace."""
         # Generate import statements for all referenced namespaces.
         self._generate_imports_for_referenced_namespaces(namespace)
 
@@ -137,6 +248,8 @@ class PythonTypesBackend(CodeBackend):
         for alias in namespace.linearize_aliases():
             self._generate_alias_definition(namespace, alias)
 
+        self._generate_shared_validators(namespace)
+
         # Generate the struct->subtype tag mapping at the end so that
         # references to later-defined subtypes don't cause errors.
         for data_type in namespace.linearize_data_types():
@@ -159,6 +272,51 @@ class PythonTypesBackend(CodeBackend):
                   'keyword, use {} instead.'.format(reserved_namespace_name))
         self.emit('from {} import *'.format(reserved_namespace_name))
 
+    def _generate_shared_validators(self, ns):
+        """
+        Defines a module-level validator for each validator that would
+        otherwise be constructed more than once by the reflection attributes
+        of the namespace. Field validators with a redactor are not shared since
+        the redactor is set on the validator itself.
+        """
+        # Maps the constructor of each validator to its data type and the
+        # number of fields that construct it. Nested validators are visited
+        # first so that they're defined before the validators composed of them.
+        counts = collections.OrderedDict()  # type: typing.Dict[typing.Text, typing.List]
+        for data_type in ns.linearize_data_types():
+            for field in data_type.fields:
+                nested_data_types = list(_iter_nested_data_types(field.data_type))
+                if field.redactor:
+                    nested_data_types.pop()
+                for nested_data_type in nested_data_types:
+                    if is_user_defined_type(nested_data_type) or is_alias(nested_data_type):
+                        continue
+                    constructor = generate_validator_constructor(ns, nested_data_type)
+                    counts.setdefault(constructor, [nested_data_type, 0])[1] += 1
+
+        self.shared_validators = {}
+        names = set()
+        for constructor, (nested_data_type, count) in counts.items():
+            if count < 2:
+                continue
+            name = base_name = '_{}_validator'.format(_fmt_validator_kind(nested_data_type))
+            suffix = 2
+            while name in names:
+                name = '{}_{}'.format(base_name, suffix)
+                suffix += 1
+            names.add(name)
+            self.emit('{} = {}'.format(name, generate_validator_constructor(
+                ns, nested_data_type, self.shared_validators)))
+            self.shared_validators[constructor] = name
+        if names:
+            self.emit()
+
+    def _generate_field_validator(self, ns, field):
+        """Returns the validator assigned to a field by its reflection attribute."""
+        if field.redactor:
+            return generate_validator_constructor(ns, field.data_type, self.shared_validators)
+        return generate_shared_validator(ns, field.data_type, self.shared_validators)
+
     def _generate_alias_definition(self, namespace, alias):
         v = generate_validator_constructor(namespace, alias.data_type)
         if alias.doc:
@@ -261,8 +419,13 @@ class PythonTypesBackend(CodeBackend):
             self._generate_struct_class_slots(data_type)
             self._generate_struct_class_has_required_fields(data_type)
             self._generate_struct_class_init(data_type)
+            if self.args and self.args.trusted_constructors:
+                self._generate_struct_class_trusted_init(data_type)
             self._generate_struct_class_properties(ns, data_type)
             self._generate_struct_class_repr(data_type)
+            self._generate_struct_class_state(data_type)
+            if self.args and self.args.generate_codecs:
+                self._generate_struct_class_codecs(data_type)
         if data_type.has_enumerated_subtypes():
             validator = 'StructTree'
         else:
@@ -287,17 +450,58 @@ class PythonTypesBackend(CodeBackend):
         of instances since attributes cannot be added after declaration.
         """
         with self.block('__slots__ =', delim=('[', ']')):
+            if self.args.presence_bitmask and not data_type.parent_type:
+                # Bit i is set if the i-th field, counting inherited fields
+                # first, is present.
+                self.emit("'_presence',")
+            if self.args.frozen_types and not data_type.parent_type:
+                # Set once the constructor has run, and the encodings of the
+                # instance cached by stone_serializers.
+                self.emit("'_sealed',")
+                self.emit("'_encodings',")
             for field in data_type.fields:
                 field_name = fmt_var(field.name)
                 self.emit("'_%s_value'," % field_name)
-                self.emit("'_%s_present'," % field_name)
+                if not self.args.presence_bitmask:
+                    self.emit("'_%s_present'," % field_name)
         self.emit()
 
     def _generate_struct_class_has_required_fields(self, data_type):
         has_required_fields = len(data_type.all_required_fields) > 0
         self.emit('_has_required_fields = %r' % has_required_fields)
+        if self.args.presence_bitmask:
+            # Checked by Struct.validate_fields_only() in place of the
+            # presence of each of _all_field_names_.
+            required_mask = 0
+            for field, bit in _presence_bits(data_type):
+                if field.omitted_caller is None and _is_required_field(field):
+                    required_mask |= bit
+            self.emit('_required_mask_ = {:#x}'.format(required_mask))
+        if self.args.frozen_types:
+            self.emit('_frozen_ = True')
         self.emit()
 
+    def _fmt_field_present(self, data_type, field, obj='self'):
+        """
+        Returns an expression that is true if ``field`` of the struct
+        ``data_type`` is set on the instance ``obj``.
+        """
+        if self.args.presence_bitmask:
+            return '{}._presence & {:#x}'.format(obj, _presence_bit(data_type, field))
+        return '{}._{}_present'.format(obj, fmt_var(field.name))
+
+    def _fmt_set_field_present(self, data_type, field, present, obj='self'):
+        """
+        Returns a statement that marks ``field`` of the struct ``data_type``
+        as set, or unset, on the instance ``obj``.
+        """
+        if self.args.presence_bitmask:
+            bit = _presence_bit(data_type, field)
+            if present:
+                return '{}._presence |= {:#x}'.format(obj, bit)
+            return '{}._presence &= ~{:#x}'.format(obj, bit)
+        return '{}._{}_present = {!r}'.format(obj, fmt_var(field.name), present)
+
     def _generate_struct_class_reflection_attributes(self, ns, data_type):
         """
         Generates two class attributes:
@@ -312,6 +516,10 @@ class PythonTypesBackend(CodeBackend):
 
         These are needed because serializing a struct with enumerated subtypes
         requires knowing the fields defined in each level of the hierarchy.
+
+        Finally, _field_ids_ maps the name of every field, including inherited
+        fields and fields omitted for some callers, to its id in the binary
+        encoding.
         """
 
         class_name = class_name_for_data_type(data_type)
@@ -323,7 +531,7 @@ class PythonTypesBackend(CodeBackend):
 
         for field in data_type.fields:
             field_name = fmt_var(field.name)
-            validator_name = generate_validator_constructor(ns, field.data_type)
+            validator_name = self._generate_field_validator(ns, field)
             full_validator_name = '{}._{}_validator'.format(class_name, field_name)
             self.emit('{} = {}'.format(full_validator_name, validator_name))
             if field.redactor:
@@ -428,8 +636,21 @@ class PythonTypesBackend(CodeBackend):
                 self.generate_multiline_list(
                     items, before=before, delim=('[', ']'), compact=False)
 
+        self._generate_wire_ids(data_type, '_field_ids_')
         self.emit()
 
+    def _generate_wire_ids(self, data_type, attr_name):
+        """
+        Generates a class attribute that maps the name of each field of a
+        struct, or tag of a union, to its id in the binary encoding.
+        """
+        self.generate_multiline_list(
+            ["'{}': {}".format(fmt_var(field.name), wire_id)
+             for field, wire_id in _wire_ids(data_type)],
+            before='{}.{} = '.format(class_name_for_data_type(data_type), attr_name),
+            delim=('{', '}'),
+            compact=False)
+
     def _generate_struct_class_init(self, data_type):
         """
         Generates constructor. The constructor takes all possible fields as
@@ -456,10 +677,16 @@ class PythonTypesBackend(CodeBackend):
                     before='super({}, self).__init__'.format(class_name))
 
             # initialize each field
+            if self.args.presence_bitmask and not data_type.parent_type:
+                self.emit('self._presence = 0')
+            if self.args.frozen_types and not data_type.parent_type:
+                self.emit('self._sealed = False')
+                self.emit('self._encodings = None')
             for field in data_type.fields:
                 field_var_name = fmt_var(field.name)
                 self.emit('self._{}_value = None'.format(field_var_name))
-                self.emit('self._{}_present = False'.format(field_var_name))
+                if not self.args.presence_bitmask:
+                    self.emit('self._{}_present = False'.format(field_var_name))
 
             # handle arguments that were set
             for field in data_type.fields:
@@ -468,10 +695,58 @@ class PythonTypesBackend(CodeBackend):
                 with self.indent():
                     self.emit('self.{0} = {0}'.format(field_var_name))
 
+            if self.args.frozen_types:
+                # Constructors of subtypes set their own fields after calling
+                # this one, so only the constructor of the instance's class
+                # seals it.
+                self.emit('self._sealed = type(self) is {}'.format(
+                    class_name_for_data_type(data_type)))
+
             if lineno == self.lineno:
                 self.emit('pass')
             self.emit()
 
+    def _generate_struct_class_trusted_init(self, data_type):
+        """
+        Generates the class method ``_new_trusted()``, which takes the same
+        arguments as the constructor but assigns them to the slots of the new
+        instance without validating them. In debug mode (see
+        ``stone_base.trusted_debug``), the instance is checked against one
+        built by the constructor.
+        """
+        args = ['cls']
+        for field in data_type.all_fields:
+            args.append('%s=None' % fmt_var(field.name, True))
+        self.emit('@classmethod')
+        self.generate_multiline_list(args, before='def _new_trusted', after=':')
+        with self.indent():
+            self.emit('ins = cls.__new__(cls)')
+            if self.args.presence_bitmask:
+                presence = ['({:#x} if {} is not None else 0)'.format(
+                    bit, fmt_var(field.name, True)) for field, bit in _presence_bits(data_type)]
+                self.generate_multiline_list(
+                    presence or ['0'], before='ins._presence = ', delim=('(', ')'),
+                    sep=' |')
+            if self.args.frozen_types:
+                self.emit('ins._sealed = True')
+                self.emit('ins._encodings = None')
+            for field in data_type.all_fields:
+                field_var_name = fmt_var(field.name, True)
+                value = field_var_name
+                if self.args.frozen_types and _is_container_type(field.data_type):
+                    value = 'bb.freeze({})'.format(field_var_name)
+                self.emit('ins._{}_value = {}'.format(fmt_var(field.name), value))
+                if not self.args.presence_bitmask:
+                    self.emit('ins._{}_present = {} is not None'.format(
+                        fmt_var(field.name), field_var_name))
+            self.emit('if bb.trusted_debug:')
+            with self.indent():
+                self.generate_multiline_list(
+                    [fmt_var(field.name, True) for field in data_type.all_fields],
+                    before='bb.check_trusted(ins, cls', after=')')
+            self.emit('return ins')
+        self.emit()
+
     def _generate_python_value(self, ns, value):
         if is_tag_ref(value):
             ref = '{}.{}'.format(class_name_for_data_type(value.union_data_type),
@@ -511,7 +786,7 @@ class PythonTypesBackend(CodeBackend):
                 self.emit(':rtype: {}'.format(
                     self._python_type_mapping(ns, field_dt)))
                 self.emit('"""')
-                self.emit('if self._{}_present:'.format(field_name))
+                self.emit('if {}:'.format(self._fmt_field_present(data_type, field)))
                 with self.indent():
                     self.emit('return self._{}_value'.format(field_name))
 
@@ -533,6 +808,8 @@ class PythonTypesBackend(CodeBackend):
             self.emit('@{}.setter'.format(field_name_reserved_check))
             self.emit('def {}(self, val):'.format(field_name_reserved_check))
             with self.indent():
+                if self.args.frozen_types:
+                    self._generate_struct_class_sealed_check(data_type, field)
                 if dt_nullable:
                     self.emit('if val is None:')
                     with self.indent():
@@ -543,18 +820,37 @@ class PythonTypesBackend(CodeBackend):
                               field_name)
                 else:
                     self.emit('val = self._{}_validator.validate(val)'.format(field_name))
+                if self.args.frozen_types and _is_container_type(field_dt):
+                    self.emit('val = bb.freeze(val)')
                 self.emit('self._{}_value = val'.format(field_name))
-                self.emit('self._{}_present = True'.format(field_name))
+                self.emit(self._fmt_set_field_present(data_type, field, True))
             self.emit()
 
             # generate deleter for field
             self.emit('@{}.deleter'.format(field_name_reserved_check))
             self.emit('def {}(self):'.format(field_name_reserved_check))
             with self.indent():
+                if self.args.frozen_types:
+                    self._generate_struct_class_sealed_check(data_type, field)
                 self.emit('self._{}_value = None'.format(field_name))
-                self.emit('self._{}_present = False'.format(field_name))
+                self.emit(self._fmt_set_field_present(data_type, field, False))
             self.emit()
 
+            if self.args.presence_bitmask:
+                # Keeps code that reads the per-field presence flag working.
+                self.emit('@property')
+                self.emit('def _{}_present(self):'.format(field_name))
+                with self.indent():
+                    self.emit('return bool({})'.format(
+                        self._fmt_field_present(data_type, field)))
+                self.emit()
+
+    def _generate_struct_class_sealed_check(self, data_type, field):
+        self.emit('if self._sealed:')
+        with self.indent():
+            self.emit("raise AttributeError(\"can't modify field '{}' of frozen {}\")".format(
+                field.name, class_name_for_data_type(data_type)))
+
     def _generate_struct_class_repr(self, data_type):
         """
         Generates something like:
@@ -585,6 +881,192 @@ class PythonTypesBackend(CodeBackend):
                           class_name_for_data_type(data_type))
         self.emit()
 
+    def _generate_struct_class_state(self, data_type):
+        """
+        Generates ``__getstate__()`` and ``__setstate__()``, which pickle and
+        copy instances as a tuple of (field name, value) pairs of the fields
+        that are set, and ``__copy__()``, which copies the slots directly.
+        Fields are named so that pickles can be loaded by classes generated
+        from later versions of the spec. Values are restored without being
+        validated again.
+        """
+        fields = data_type.all_fields
+
+        self.emit('def __getstate__(self):')
+        with self.indent():
+            self.emit('state = []')
+            for field in fields:
+                self.emit('if {}:'.format(self._fmt_field_present(data_type, field)))
+                with self.indent():
+                    self.emit("state.append(('{0}', self._{0}_value))".format(
+                        fmt_var(field.name)))
+            self.emit('return tuple(state)')
+        self.emit()
+
+        self.emit('def __setstate__(self, state):')
+        with self.indent():
+            self.emit('if bb.is_slot_state(state):')
+            with self.indent():
+                self.emit('bb.set_slot_state(self, state)')
+                self.emit('return')
+            self.emit('fields = dict(state)')
+            if self.args.presence_bitmask:
+                presence = ["({:#x} if '{}' in fields else 0)".format(bit, fmt_var(field.name))
+                            for field, bit in _presence_bits(data_type)]
+                self.generate_multiline_list(
+                    presence or ['0'], before='self._presence = ', delim=('(', ')'),
+                    sep=' |')
+            if self.args.frozen_types:
+                self.emit('self._sealed = True')
+                self.emit('self._encodings = None')
+            for field in fields:
+                field_name = fmt_var(field.name)
+                self.emit("self._{0}_value = fields.get('{0}')".format(field_name))
+                if not self.args.presence_bitmask:
+                    self.emit("self._{0}_present = '{0}' in fields".format(field_name))
+        self.emit()
+
+        self.emit('def __copy__(self):')
+        with self.indent():
+            if self.args.frozen_types:
+                self.emit('if self._sealed:')
+                with self.indent():
+                    self.emit('return self')
+            self.emit('ins = type(self).__new__(type(self))')
+            slots = []
+            if self.args.presence_bitmask:
+                slots.append('_presence')
+            if self.args.frozen_types:
+                slots.extend(['_sealed', '_encodings'])
+            for field in fields:
+                slots.append('_{}_value'.format(fmt_var(field.name)))
+                if not self.args.presence_bitmask:
+                    slots.append('_{}_present'.format(fmt_var(field.name)))
+            for slot in slots:
+                self.emit('ins.{0} = self.{0}'.format(slot))
+            self.emit('return ins')
+        self.emit()
+
+    def _generate_struct_class_codecs(self, data_type):
+        """
+        Generates the class methods ``_to_json_compat()`` and
+        ``_from_json_compat()``. stone_serializers calls them to encode and
+        decode the public fields of the struct instead of interpreting
+        ``_all_fields_``. Fields holding strings, booleans and numbers are
+        read and written inline; all others are passed back to the codec.
+        """
+        fields = _public_fields_in_order(data_type)
+
+        self.emit('@classmethod')
+        self.emit('def _to_json_compat(cls, enc, val, d):')
+        with self.indent():
+            for field in fields:
+                field_name = fmt_var(field.name)
+                field_dt, nullable, _ = unwrap(field.data_type)
+                present = self._fmt_field_present(data_type, field, 'val')
+                if nullable:
+                    self.emit('if {} and val._{}_value is not None:'.format(present, field_name))
+                else:
+                    self.emit('if {}:'.format(present))
+                with self.indent():
+                    if is_integer_type(field_dt):
+                        # Integer fields may hold a bool, which is encoded as an int.
+                        self.emit("d['{0}'] = int(val._{0}_value)".format(field_name))
+                    elif _is_json_native_type(field_dt):
+                        self.emit("d['{0}'] = val._{0}_value".format(field_name))
+                    else:
+                        self._generate_codec_call(
+                            field_name,
+                            "d['{0}'] = enc.encode(cls._{0}_validator, val._{0}_value)".format(
+                                field_name))
+                if _is_required_field(field):
+                    self.emit('else:')
+                    with self.indent():
+                        self.emit("raise bv.ValidationError(\"missing required field '%s'\")"
+                                  % field_name)
+            self.emit('return d')
+        self.emit()
+
+        self.emit('@classmethod')
+        self.emit('def _from_json_compat(cls, dec, obj):')
+        with self.indent():
+            self.emit('if dec.strict:')
+            with self.indent():
+                self.emit('for key in obj:')
+                with self.indent():
+                    self.emit("if key not in cls._all_field_names_ and "
+                              "not key.startswith('.tag'):")
+                    with self.indent():
+                        self.emit("raise bv.ValidationError(\"unknown field '%s'\" % key)")
+            self.emit('ins = cls()')
+            if self.args.frozen_types:
+                self.emit('ins._sealed = False')
+            for field in fields:
+                field_name = fmt_var(field.name)
+                field_dt, nullable, _ = unwrap(field.data_type)
+                if _is_json_native_type(field_dt) and \
+                        (not nullable or is_nullable_type(field.data_type)):
+                    if nullable:
+                        self.emit("if obj.get('{}') is not None:".format(field_name))
+                    else:
+                        self.emit("if '{}' in obj:".format(field_name))
+                    with self.indent():
+                        self._generate_codec_call(
+                            field_name,
+                            "ins._{0}_value = cls._{0}_validator.validate(obj['{0}'])".format(
+                                field_name))
+                        self.emit(self._fmt_set_field_present(data_type, field, True, 'ins'))
+                    continue
+
+                field_name_reserved_check = fmt_func(field.name, check_reserved=True)
+                self.emit("if '{}' in obj:".format(field_name))
+                with self.indent():
+                    self._generate_codec_call(
+                        field_name,
+                        "ins.{0} = dec.json_compat_obj_decode_helper("
+                        "cls._{1}_validator, obj['{1}'])".format(
+                            field_name_reserved_check, field_name))
+                # A missing nullable field is left unset, which is equivalent
+                # to assigning its default.
+                if not is_nullable_type(field.data_type) and \
+                        _validator_has_default(field.data_type):
+                    self.emit('else:')
+                    with self.indent():
+                        self.emit('ins.{} = cls._{}_validator.get_default()'.format(
+                            field_name_reserved_check, field_name))
+            required_fields = [field for field in fields if _is_required_field(field)]
+            if required_fields and self.args.presence_bitmask:
+                # Only look for the missing field if the mask is incomplete.
+                self.emit('if ins._presence & cls._required_mask_ != cls._required_mask_:')
+                with self.indent():
+                    self._generate_struct_class_required_checks(data_type, required_fields)
+            else:
+                self._generate_struct_class_required_checks(data_type, required_fields)
+            if self.args.frozen_types:
+                self.emit('ins._sealed = True')
+            self.emit('return ins')
+        self.emit()
+
+    def _generate_struct_class_required_checks(self, data_type, required_fields):
+        for field in required_fields:
+            self.emit('if not {}:'.format(self._fmt_field_present(data_type, field, 'ins')))
+            with self.indent():
+                self.emit("raise bv.ValidationError(\"missing required field '%s'\")"
+                          % field.name)
+
+    def _generate_codec_call(self, name, statement):
+        """
+        Emits a statement of a generated codec that may raise a
+        ValidationError, adding the field or tag name as its parent.
+        """
+        self.emit('try:')
+        with self.indent():
+            self.emit(statement)
+        self.emit('except bv.ValidationError as exc:')
+        with self.indent():
+            self.emit("exc.add_parent('{}')".format(name))
+            self.emit('raise')
+
     def _generate_enumerated_subtypes_tag_mapping(self, ns, data_type):
         """
         Generates attributes needed for serializing and deserializing structs
@@ -673,16 +1155,33 @@ class PythonTypesBackend(CodeBackend):
             self.emit('"""')
             self.emit()
 
+            self._generate_union_class_slots(data_type)
             self._generate_union_class_vars(data_type)
             self._generate_union_class_variant_creators(ns, data_type)
             self._generate_union_class_is_set(data_type)
             self._generate_union_class_get_helpers(ns, data_type)
             self._generate_union_class_repr(data_type)
+            if self.args and self.args.generate_codecs:
+                self._generate_union_class_codecs(data_type)
         self.emit('{0}_validator = bv.Union({0})'.format(
             class_name_for_data_type(data_type)
         ))
         self.emit()
 
+    def _generate_union_class_slots(self, data_type):
+        """Creates a slots declaration for union classes.
+
+        The _value slot is declared by the first class in the hierarchy with a
+        member that carries a value. Unions composed of only symbols have no
+        _value slot.
+        """
+        if (_union_has_values(data_type)
+                and not (data_type.parent_type and _union_has_values(data_type.parent_type))):
+            self.emit("__slots__ = ['_value']")
+        else:
+            self.emit('__slots__ = []')
+        self.emit()
+
     def _generate_union_class_vars(self, data_type):
         """
         Adds a _catch_all_ attribute to each class. Also, adds a placeholder
@@ -693,6 +1192,8 @@ class PythonTypesBackend(CodeBackend):
             self.emit("_catch_all = '%s'" % data_type.catch_all_field.name)
         elif not data_type.parent_type:
             self.emit('_catch_all = None')
+        if self.args.frozen_types:
+            self.emit('_frozen_ = True')
 
         # Generate stubs for class variables so that IDEs like PyCharms have an
         # easier time detecting their existence.
@@ -708,14 +1209,14 @@ class PythonTypesBackend(CodeBackend):
     def _generate_union_class_reflection_attributes(self, ns, data_type):
         """
         Adds a class attribute for each union member assigned to a validator.
-        Also adds an attribute that is a map from tag names to validators.
+        Also adds an attribute that is a map from tag names to validators, and
+        one that maps every tag name to its id in the binary encoding.
         """
         class_name = fmt_class(data_type.name)
 
         for field in data_type.fields:
             field_name = fmt_var(field.name)
-            validator_name = generate_validator_constructor(
-                ns, field.data_type)
+            validator_name = self._generate_field_validator(ns, field)
             full_validator_name = '{}._{}_validator'.format(class_name, field_name)
             self.emit('{} = {}'.format(full_validator_name, validator_name))
 
@@ -750,6 +1251,7 @@ class PythonTypesBackend(CodeBackend):
                     class_name_for_data_type(data_type.parent_type, ns))
                 )
 
+        self._generate_wire_ids(data_type, '_tag_ids_')
         self.emit()
 
     def _generate_union_class_variant_creators(self, ns, data_type):
@@ -844,6 +1346,123 @@ class PythonTypesBackend(CodeBackend):
             ))
         self.emit()
 
+    def _generate_union_class_codecs(self, data_type):
+        """
+        Generates the class methods ``_to_json_compat()`` and
+        ``_from_json_compat()`` for the public tags of the union.
+
+        The decoder only handles well-formed input. It returns None for
+        anything else, including the catch-all tag, so that
+        stone_serializers falls back to its generic decoder and reports the
+        same errors.
+        """
+        fields = _public_fields_in_order(data_type)
+        catch_all_field = _get_catch_all_field(data_type)
+        void_tags = []
+        symbol_tags = []
+        for field in fields:
+            _, nullable, _ = unwrap(field.data_type)
+            if field is catch_all_field:
+                continue
+            if is_void_type(field.data_type):
+                void_tags.append(fmt_var(field.name))
+            if is_void_type(field.data_type) or nullable:
+                symbol_tags.append(fmt_var(field.name))
+
+        self.emit('@classmethod')
+        self.emit('def _to_json_compat(cls, enc, val):')
+        with self.indent():
+            self.emit('tag = val._tag')
+            all_void_tags = [fmt_var(f.name) for f in fields if is_void_type(f.data_type)]
+            if all_void_tags:
+                self.emit('if tag in {}:'.format(_fmt_tuple(all_void_tags)))
+                with self.indent():
+                    self.emit("return {'.tag': tag}")
+            for field in fields:
+                if is_void_type(field.data_type):
+                    continue
+                field_name = fmt_var(field.name)
+                field_dt, nullable, _ = unwrap(field.data_type)
+                self.emit("if tag == '{}':".format(field_name))
+                with self.indent():
+                    if nullable:
+                        self.emit('if val._value is None:')
+                        with self.indent():
+                            self.emit("return {{'.tag': '{}'}}".format(field_name))
+                    if is_integer_type(field_dt):
+                        encoded_val = 'int(val._value)'
+                    elif _is_json_native_type(field_dt):
+                        encoded_val = 'val._value'
+                    else:
+                        self._generate_codec_call(
+                            field_name,
+                            'encoded_val = enc.encode(cls._{}_validator, val._value)'.format(
+                                field_name))
+                        encoded_val = 'encoded_val'
+                    self.emit('d = enc.new_object()')
+                    self.emit("d['.tag'] = '{}'".format(field_name))
+                    if _is_flat_struct_type(field_dt):
+                        self.emit('d.update({})'.format(encoded_val))
+                    else:
+                        self.emit("d['{}'] = {}".format(field_name, encoded_val))
+                    self.emit('return d')
+            self.emit("raise bv.ValidationError(\"caller does not have access to '{}' tag\""
+                      ".format(tag))")
+        self.emit()
+
+        self.emit('@classmethod')
+        self.emit('def _from_json_compat(cls, dec, obj):')
+        with self.indent():
+            self.emit('if isinstance(obj, dict):')
+            with self.indent():
+                self.emit("tag = obj.get('.tag')")
+                if void_tags:
+                    self.emit('if tag in {} and len(obj) == 1:'.format(_fmt_tuple(void_tags)))
+                    with self.indent():
+                        self.emit('return cls._symbol(tag)')
+                for field in fields:
+                    if field is catch_all_field or is_void_type(field.data_type):
+                        continue
+                    field_name = fmt_var(field.name)
+                    field_dt, nullable, _ = unwrap(field.data_type)
+                    validator = 'cls._{}_validator'.format(field_name)
+                    if nullable:
+                        validator += '.validator'
+                    self.emit("if tag == '{}':".format(field_name))
+                    with self.indent():
+                        if nullable:
+                            self.emit('if len(obj) == 1:')
+                            with self.indent():
+                                self.emit("return cls._symbol('{}')".format(field_name))
+                        if _is_flat_struct_type(field_dt):
+                            self._generate_codec_call(
+                                field_name,
+                                'val = dec.json_compat_obj_decode_helper({}, obj)'.format(
+                                    validator))
+                            self.emit("return cls('{}', val)".format(field_name))
+                            continue
+                        if nullable:
+                            self.emit("if len(obj) == 2 and obj.get('{}') is not None:".format(
+                                field_name))
+                        else:
+                            self.emit("if len(obj) == 2 and '{}' in obj:".format(field_name))
+                        with self.indent():
+                            if _is_json_native_type(field_dt):
+                                # Validated by the constructor.
+                                self.emit("return cls('{0}', obj['{0}'])".format(field_name))
+                            else:
+                                self._generate_codec_call(
+                                    field_name,
+                                    "val = dec.json_compat_obj_decode_helper({}, obj['{}'])"
+                                    .format(validator, field_name))
+                                self.emit("return cls('{}', val)".format(field_name))
+            if symbol_tags:
+                self.emit('elif obj in {}:'.format(_fmt_tuple(symbol_tags)))
+                with self.indent():
+                    self.emit('return cls._symbol(obj)')
+            self.emit('return None')
+        self.emit()
+
     def _generate_union_class_symbol_creators(self, data_type):
         """
         Class attributes that represent a symbol are set after the union class
@@ -854,7 +1473,7 @@ class PythonTypesBackend(CodeBackend):
         for field in data_type.fields:
             if is_void_type(field.data_type):
                 field_name = fmt_func(field.name)
-                self.emit("{0}.{1} = {0}('{1}')".format(class_name, field_name))
+                self.emit("{0}.{1} = {0}._symbol('{1}')".format(class_name, field_name))
         if lineno != self.lineno:
             self.emit()
 
@@ -898,17 +1517,24 @@ class PythonTypesBackend(CodeBackend):
         elif isinstance(redactor, RedactedBlot):
             self.emit("{}._redact = bv.BlotRedactor({})".format(validator_name, regex))
 
-def generate_validator_constructor(ns, data_type):
+def generate_validator_constructor(ns, data_type, shared_validators=None):
     """
     Given a Stone data type, returns a string that can be used to construct
     the appropriate validation object in Python.
+
+    If ``shared_validators`` is given, it maps the constructors of validators
+    defined at module level to their names. Those names are used in place of
+    the constructors of nested validators.
     """
     dt, nullable_dt = unwrap_nullable(data_type)
+    if nullable_dt:
+        return generate_func_call(
+            'bv.Nullable', args=[generate_shared_validator(ns, dt, shared_validators)])
     if is_list_type(dt):
         v = generate_func_call(
             'bv.List',
             args=[
-                generate_validator_constructor(ns, dt.data_type)],
+                generate_shared_validator(ns, dt.data_type, shared_validators)],
             kwargs=[
                 ('min_items', dt.min_items),
                 ('max_items', dt.max_items)],
@@ -917,8 +1543,8 @@ def generate_validator_constructor(ns, data_type):
         v = generate_func_call(
             'bv.Map',
             args=[
-                generate_validator_constructor(ns, dt.key_data_type),
-                generate_validator_constructor(ns, dt.value_data_type),
+                generate_shared_validator(ns, dt.key_data_type, shared_validators),
+                generate_shared_validator(ns, dt.value_data_type, shared_validators),
             ]
         )
     elif is_numeric_type(dt):
@@ -958,11 +1584,52 @@ def generate_validator_constructor(ns, data_type):
         v = generate_func_call('bv.{}'.format(dt.name))
     else:
         raise AssertionError('Unsupported data type: %r' % dt)
+    return v
 
-    if nullable_dt:
-        return generate_func_call('bv.Nullable', args=[v])
+
+def generate_shared_validator(ns, data_type, shared_validators=None):
+    """
+    Like :func:`generate_validator_constructor`, but returns the name of the
+    validator if it is one of ``shared_validators``.
+    """
+    v = generate_validator_constructor(ns, data_type, shared_validators)
+    if shared_validators:
+        return shared_validators.get(generate_validator_constructor(ns, data_type), v)
+    return v
+
+
+def _iter_nested_data_types(data_type):
+    """
+    Yields the data types of the validators that the validator of
+    ``data_type`` is composed of, followed by ``data_type`` itself.
+    """
+    dt, nullable = unwrap_nullable(data_type)
+    if nullable:
+        nested_data_types = [dt]
+    elif is_list_type(dt):
+        nested_data_types = [dt.data_type]
+    elif is_map_type(dt):
+        nested_data_types = [dt.key_data_type, dt.value_data_type]
+    else:
+        nested_data_types = []
+    for nested_data_type in nested_data_types:
+        for nested in _iter_nested_data_types(nested_data_type):
+            yield nested
+    yield data_type
+
+
+def _fmt_validator_kind(data_type):
+    dt, nullable = unwrap_nullable(data_type)
+    if is_list_type(dt):
+        kind = 'List_' + _fmt_validator_kind(dt.data_type)
+    elif is_map_type(dt):
+        kind = 'Map_{}_{}'.format(
+            _fmt_validator_kind(dt.key_data_type), _fmt_validator_kind(dt.value_data_type))
+    elif is_user_defined_type(dt):
+        kind = fmt_class(dt.name)
     else:
-        return v
+        kind = dt.name
+    return 'Nullable_' + kind if nullable else kind
 
 
 def generate_func_call(name, args=None, kwargs=None):
@@ -986,3 +1653,112 @@ def generate_func_call(name, args=None, kwargs=None):
         all_args.extend('{}={}'.format(k, v)
                         for k, v in kwargs if v is not None)
     return '{}({})'.format(name, ', '.join(all_args))
+
+
+def _public_fields_in_order(data_type):
+    """
+    Returns the fields of a struct or union that are visible to callers
+    without extra permissions, in the order of the generated ``_all_fields_``
+    or ``_tagmap``: inherited fields first, then each type's own fields in
+    declaration order.
+    """
+    fields = _public_fields_in_order(data_type.parent_type) if data_type.parent_type else []
+    return fields + [f for f in data_type.fields if f.omitted_caller is None]
+
+
+def _get_catch_all_field(data_type):
+    while data_type is not None:
+        if data_type.catch_all_field is not None:
+            return data_type.catch_all_field
+        data_type = data_type.parent_type
+    return None
+
+
+def _is_required_field(field):
+    # Mirrors the getter generated for the field, which raises if the field
+    # is unset.
+    return not is_nullable_type(field.data_type) and not field.has_default
+
+
+def _is_json_native_type(data_type):
+    # Values of these types are their own JSON-compatible representation.
+    return (is_string_type(data_type)
+            or is_boolean_type(data_type)
+            or is_numeric_type(data_type))
+
+
+def _is_container_type(data_type):
+    # Values of these types are mutable, so frozen types hold read-only
+    # copies of them.
+    data_type, _, _ = unwrap(data_type)
+    return is_list_type(data_type) or is_map_type(data_type)
+
+
+def _is_flat_struct_type(data_type):
+    return is_struct_type(data_type) and not data_type.has_enumerated_subtypes()
+
+
+def _union_has_values(data_type):
+    return any(not is_void_type(field.data_type) for field in data_type.all_fields)
+
+
+def _validator_has_default(data_type):
+    # Mirrors ``has_default()`` of the validator generated for the data type.
+    data_type, nullable, _ = unwrap(data_type)
+    return (nullable
+            or is_void_type(data_type)
+            or (is_struct_type(data_type) and not data_type.all_required_fields))
+
+
+def _fmt_tuple(items):
+    return '({}{})'.format(', '.join("'%s'" % item for item in items),
+                           ',' if len(items) == 1 else '')
+
+
+def _presence_bits(data_type):
+    """
+    Returns a list of (field, bit) pairs for the fields of a struct,
+    including inherited ones, where bit is the field's bit in the presence
+    mask of generated instances. Inherited fields come first, so a field has
+    the same bit in every subtype.
+    """
+    bits = _presence_bits(data_type.parent_type) if data_type.parent_type else []
+    return bits + [(field, 1 << (len(bits) + i)) for i, field in enumerate(data_type.fields)]
+
+
+def _presence_bit(data_type, field):
+    for f, bit in _presence_bits(data_type):
+        if f is field:
+            return bit
+    raise AssertionError('%r is not a field of %r' % (field, data_type))
+
+
+# Ids of struct fields and union tags in the binary encoding are in
+# [1, _MAX_WIRE_ID], so that the key of a field, its id shifted left by the
+# three bits of its wire type, takes at most two bytes as a varint.
+_MAX_WIRE_ID = 2047
+
+
+def _wire_ids(data_type):
+    """
+    Returns a list of (field, id) pairs for the fields of a struct or the
+    tags of a union, including inherited ones, where id identifies the field
+    in the binary encoding of stone_serializers.
+
+    An id is derived from the field's name, like a JSON key, unless that id
+    is taken, since names can collide. Then the field gets the next free id,
+    with inherited fields taking theirs first, then the rest in declaration
+    order. So appending fields to a type keeps the ids of the existing
+    fields, but adding fields to its parent type, inserting fields before
+    others, or reordering them, may change the id of a field whose name
+    collides with another's.
+    """
+    ids = _wire_ids(data_type.parent_type) if data_type.parent_type else []
+    used = {wire_id for _, wire_id in ids}
+    for field in data_type.fields:
+        wire_id = zlib.crc32(field.name.encode('utf-8')) % _MAX_WIRE_ID + 1
+        while wire_id in used:
+            wire_id = wire_id % _MAX_WIRE_ID + 1
+        used.add(wire_id)
+        ids.append((field, wire_id))
+    return ids
@@ -3,20 +3,32 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import base64
+import copy
 import datetime
+import functools
 import json
+import multiprocessing
+import pickle
 import shutil
 import six
 import subprocess
 import sys
+import threading
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # type: ignore
+
 import stone.backends.python_rsrc.stone_validators as bv
 
 from stone.backends.python_rsrc.stone_serializers import (
     CallerPermissionsInterface,
+    StoneToPythonPrimitiveSerializer,
     json_encode,
     json_decode,
+    _get_timestamp_codec,
     _strftime as stone_strftime,
 )
 
@@ -59,6 +71,19 @@ class TestDropInModules(unittest.TestCase):
         f('_xyz')
         f('xyz_')
 
+    def test_string_pattern_cache(self):
+        s = bv.String(pattern=r'[a-z]+')
+        self.assertIs(bv.String(max_length=5, pattern=r'[a-z]+').pattern_re, s.pattern_re)
+        self.assertIsNot(bv.String(pattern=r'[a-z]*').pattern_re, s.pattern_re)
+        with self.assertRaises(AssertionError):
+            bv.String(pattern=r'(')
+
+        # The cache is bounded
+        for i in range(bv._MAX_PATTERN_RES + 1):
+            bv.String(pattern='x{%d}' % i)
+        self.assertLessEqual(len(bv._pattern_res), bv._MAX_PATTERN_RES)
+        self.assertTrue(s.pattern_re.match('abc'))
+
     def test_boolean_validator(self):
         b = bv.Boolean()
         b.validate(True)
@@ -165,6 +190,59 @@ class TestDropInModules(unittest.TestCase):
         # Passes
         l1.validate(['a'])
 
+    def test_list_validator_bulk_checks(self):
+        def error(validator, val):
+            try:
+                validator.validate(val)
+            except bv.ValidationError as e:
+                return str(e)
+            self.fail('%r passed validation' % (val,))
+
+        # Failures report the first invalid item, as item validators do
+        cases = [
+            (bv.Boolean(), [True, False], 1),
+            (bv.Int32(), [1, True, -2**31], 2**31),
+            (bv.UInt64(min_value=2), [2, 2**64 - 1], 1),
+            (bv.Float64(), [1, 1.5, False], float('nan')),
+            (bv.Float32(max_value=10), [0.5, 10], 10.5),
+            (bv.String(), ['a', 'b'], None),
+        ]
+        for item_validator, valid, invalid_item in cases:
+            l1 = bv.List(item_validator)
+            expected = [item_validator.validate(item) for item in valid]
+            self.assertEqual(l1.validate(valid), expected)
+            self.assertEqual(l1.validate(tuple(valid)), expected)
+            self.assertEqual(error(l1, valid + [invalid_item]),
+                             error(item_validator, invalid_item))
+
+        # Real numbers in large lists are checked the same way
+        l2 = bv.List(bv.Float64())
+        self.assertEqual(l2.validate([1] * 5000), [1.0] * 5000)
+        self.assertEqual(error(l2, [1.0] * 5000 + [float('inf')]),
+                         'inf values are not supported')
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_list_validator_numpy_arrays(self):
+        l1 = bv.List(bv.Int32(), max_items=3)
+        result = l1.validate(numpy.array([1, 2, 3], dtype=numpy.int64))
+        self.assertEqual(result, [1, 2, 3])
+        self.assertIs(type(result[0]), int)
+        self.assertRaises(bv.ValidationError,
+                          lambda: l1.validate(numpy.array([2**31], dtype=numpy.int64)))
+        self.assertRaises(bv.ValidationError,
+                          lambda: l1.validate(numpy.array([1, 2, 3, 4])))
+        self.assertRaises(bv.ValidationError,
+                          lambda: l1.validate(numpy.array([1.5])))
+
+        l2 = bv.List(bv.Float64())
+        self.assertEqual(l2.validate(numpy.array([1, 2], dtype=numpy.uint8)), [1.0, 2.0])
+        self.assertRaises(bv.ValidationError,
+                          lambda: l2.validate(numpy.array([1.0, numpy.nan])))
+        self.assertEqual(json_encode(l2, numpy.array([0.5, 1.5])), json.dumps([0.5, 1.5]))
+
+        l3 = bv.List(bv.List(bv.Boolean()))
+        self.assertEqual(l3.validate(numpy.array([[True], [False]])), [[True], [False]])
+
     def test_map_validator(self):
         m = bv.Map(bv.String(pattern="^foo.*"), bv.String(pattern=".*bar$"))
 
@@ -393,6 +471,84 @@ class TestDropInModules(unittest.TestCase):
                 self.assertEqual(prefix, str(e)[:len(prefix)])
                 raise
 
+    def test_json_encoder_plans(self):
+        # pylint: disable=attribute-defined-outside-init
+        class S(object):
+            _all_field_names_ = {'f'}
+            _all_fields_ = [('f', bv.List(bv.UInt32()))]
+
+        s = S()
+        s.f = [1, 2]
+        s._f_present = True
+        s_validator = bv.Struct(S)
+
+        # Plans are compiled once per set of options and shared by serializers
+        self.assertEqual(json_encode(s_validator, s), json.dumps({'f': [1, 2]}))
+        plans = dict(getattr(s_validator, '_encode_plans'))
+        self.assertEqual(len(plans), 1)
+        self.assertEqual(json_encode(s_validator, s), json.dumps({'f': [1, 2]}))
+        self.assertEqual(getattr(s_validator, '_encode_plans'), plans)
+        json_encode(s_validator, s, old_style=True)
+        self.assertEqual(len(getattr(s_validator, '_encode_plans')), 2)
+
+        # Plans that invoke alias validators are not kept on the validators,
+        # as alias validators are often made anew for each call
+        for _ in range(3):
+            self.assertEqual(
+                json_encode(s_validator, s, alias_validators={s_validator: lambda v: None}),
+                json.dumps({'f': [1, 2]}))
+        self.assertEqual(len(getattr(s_validator, '_encode_plans')), 2)
+
+        # Masks often vary by request, so only the most recently used masked
+        # plans are kept, apart from the others
+        for i in range(40):
+            self.assertEqual(json_encode(s_validator, s, field_mask=['f', 'g%d' % i]),
+                             json.dumps({'f': [1, 2]}))
+        self.assertEqual(len(getattr(s_validator, '_masked_encode_plans')), 16)
+        self.assertEqual(len(getattr(s_validator, '_encode_plans')), 2)
+
+        # Lists are still validated on every encode
+        s.f.append(-1)
+        self.assertRaises(bv.ValidationError, lambda: json_encode(s_validator, s))
+
+        # Subclasses that override an encoding hook don't use plans
+        class UpperCaseSerializer(StoneToPythonPrimitiveSerializer):
+            def encode_primitive(self, validator, value):
+                return value.upper()
+
+        serializer = UpperCaseSerializer(None, None, False, False, False)
+        self.assertEqual(serializer.encode(bv.List(bv.String()), ['a']), ['A'])
+
+    def test_json_encoder_containers_validate_items_once(self):
+        validated = []
+
+        class CountingString(bv.String):
+            def validate(self, val):
+                validated.append(val)
+                return super(CountingString, self).validate(val)
+
+        v = bv.List(bv.Map(CountingString(), bv.List(CountingString())))
+        value = [{'a': ['b', 'c']}, {'d': []}]
+        self.assertEqual(json_encode(v, value), json.dumps(value))
+        self.assertEqual(sorted(validated), ['a', 'b', 'c', 'd'])
+
+        # Items are encoded as validated
+        self.assertEqual(json_encode(bv.List(bv.Float64()), [1]), json.dumps([1.0]))
+        self.assertEqual(json_encode(bv.Nullable(bv.List(bv.Float64())), [1]),
+                         json.dumps([1.0]))
+        self.assertRaises(bv.ValidationError,
+                          lambda: json_encode(bv.List(bv.Nullable(bv.Int32())), [None, 'a']))
+
+        # Encoding through the hooks validates items once as well
+        class IdentitySerializer(StoneToPythonPrimitiveSerializer):
+            def encode_primitive(self, validator, value):
+                return value
+
+        del validated[:]
+        serializer = IdentitySerializer(None, None, False, False, False)
+        self.assertEqual(serializer.encode(v, value), value)
+        self.assertEqual(sorted(validated), ['a', 'b', 'c', 'd'])
+
     def test_json_decoder(self):
         self.assertEqual(json_decode(bv.String(), json.dumps('abc')), 'abc')
         self.assertRaises(bv.ValidationError,
@@ -708,6 +864,13 @@ union V
     t11 Map(String, Int32)
     t12 Map(String, U)
 
+union Sym
+    s0
+    s1
+
+union SymExtend extends Sym
+    s2 String?
+
 struct S
     f String
 
@@ -763,6 +926,10 @@ struct ContainsAlias
 
 struct S3
     u ns2.BaseU = z
+
+struct CollidingIds
+    ah String
+    ei String
 """
 
 test_ns2_spec = """\
@@ -780,21 +947,36 @@ alias AliasedBaseU = BaseU
 """
 
 
-class TestGeneratedPython(unittest.TestCase):
+class _GeneratedPythonTestCase(unittest.TestCase):
+    """
+    Generates Python modules from the test spec with the backend arguments
+    of the class, and imports them for each test.
+    """
+
+    output_dir = 'output'
+    backend_args = []  # type: list
+
+    _generated_modules = ('ns', 'ns2', 'stone_base', 'stone_serializers', 'stone_validators')
 
     def setUp(self):
 
         # Sanity check: stone must be importable for the compiler to work
         __import__('stone')
 
+        # Set aside modules generated by other tests, possibly with other
+        # backend arguments.
+        self._saved_modules = {
+            name: sys.modules.pop(name)
+            for name in self._generated_modules if name in sys.modules}
+
         # Compile spec by calling out to stone
         p = subprocess.Popen(
             [sys.executable,
              '-m',
              'stone.cli',
              'python_types',
-             'output',
-             '-'],
+             self.output_dir,
+             '-'] + (['--'] + self.backend_args if self.backend_args else []),
             stdin=subprocess.PIPE,
             stderr=subprocess.PIPE)
         _, stderr = p.communicate(
@@ -803,7 +985,7 @@ class TestGeneratedPython(unittest.TestCase):
             raise AssertionError('Could not execute stone tool: %s' %
                                  stderr.decode('utf-8'))
 
-        sys.path.append('output')
+        sys.path.append(self.output_dir)
         self.ns2 = __import__('ns2')
         self.ns = __import__('ns')
         self.sv = __import__('stone_validators')
@@ -813,22 +995,22 @@ class TestGeneratedPython(unittest.TestCase):
         self.decode = self.ss.json_decode
         self.compat_obj_decode = self.ss.json_compat_obj_decode
 
-    def test_docstring(self):
-        # Check that the docstrings from the spec have in some form made it
-        # into the Python docstrings for the generated objects.
-        self.assertIn('Sample struct doc.', self.ns.A.__doc__)
-        self.assertIn('Sample field doc.', self.ns.A.a.__doc__)
-        self.assertIn('Sample union doc.', self.ns.U.__doc__)
-        self.assertIn('Sample field doc.', self.ns.U.t0.__doc__)
+    def tearDown(self):
+        # Clear output of stone tool after all tests.
+        shutil.rmtree(self.output_dir)
+        sys.path.remove(self.output_dir)
+        for name in self._generated_modules:
+            sys.modules.pop(name, None)
+        sys.modules.update(self._saved_modules)
 
-        # Test doc conversion of Python bool.
-        self.assertIn('``True``', self.ns.DocTest.b.__doc__)
-        # Test doc converts type reference to sphinx-friendly representation.
-        self.assertIn(':class:`D`', self.ns.DocTest.t.__doc__)
 
-    def test_aliases(self):
-        # The left is a validator, the right is the struct devs can use...
-        self.assertEqual(self.ns.AliasedS2, self.ns.S2)
+class _CodingTests(object):
+    """
+    Encoding and decoding tests, run against the modules generated with
+    each option that changes how values are encoded or decoded.
+    """
+    # Mixed into subclasses of _GeneratedPythonTestCase.
+    # pylint: disable=no-member
 
     def test_struct_decoding(self):
         d = self.decode(self.sv.Struct(self.ns.D),
@@ -1114,72 +1296,6 @@ class TestGeneratedPython(unittest.TestCase):
         self.assertEqual(b.f1, 'hello')
         self.assertEqual(b.f2, 3)
 
-    def test_union_equality_with_object(self):
-        """Should not throw an error when comparing with object.
-
-        Object is a superclass of Union, but it should not be considered for equality.
-        """
-        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
-        self.assertFalse(u == object())
-
-    def test_union_equality_with_tag(self):
-        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
-        u_equal = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
-        u_unequal = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't2'}))
-        self.assertEqual(u, u_equal)
-        self.assertEqual(hash(u), hash(u_equal))
-        self.assertNotEqual(u, u_unequal)
-        self.assertNotEqual(hash(u), hash(u_unequal))
-
-    def test_union_equality_with_value(self):
-        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't1', 't1': 'a'}))
-        u_equal = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't1', 't1': 'a'}))
-        u_unequal = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't1', 't1': 'b'}))
-        self.assertEqual(u, u_equal)
-        self.assertEqual(hash(u), hash(u_equal))
-        self.assertNotEqual(u, u_unequal)
-        self.assertNotEqual(hash(u), hash(u_unequal))
-
-    def test_union_equality_with_closed_and_open(self):
-        """A closed union should be considered equal to an open union if they have a direct
-        inheritance relationship."""
-        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
-        u_open = self.decode(self.sv.Union(self.ns.UOpen), json.dumps({'.tag': 't0'}))
-        self.assertEqual(u, u_open)
-        self.assertEqual(hash(u), hash(u_open))
-
-    def test_union_equality_with_different_types(self):
-        """Unions of different types that do not have an inheritance relationship are not considered
-        equal to each other."""
-        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
-        v = self.decode(self.sv.Union(self.ns.V), json.dumps({'.tag': 't0'}))
-        self.assertNotEqual(u, v)
-        # They still hash to the same value, since they have the same tag and value, but this is
-        # fine since we don't expect to use a large number of unions as dict keys.
-        self.assertEqual(hash(u), hash(v))
-
-        # U_extend and U_extend2 are indirectly related because they both extend U, but they do not
-        # have a direct line of inheritance to each other.
-        u_extend = self.decode(self.sv.Union(self.ns.UExtend), json.dumps({'.tag': 't0'}))
-        u_extend2 = self.decode(self.sv.Union(self.ns.UExtend2), json.dumps({'.tag': 't0'}))
-        self.assertNotEqual(u_extend, u_extend2)
-        # They still hash to the same value, since they have the same tag and value, but this is
-        # fine since we don't expect to use a large number of unions as dict keys.
-        self.assertEqual(hash(u_extend), hash(u_extend2))
-
-    def test_extended_union_equality(self):
-        """Unions which subclass each other are considered equal to each other."""
-        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
-        u_extend = self.decode(self.sv.Union(self.ns.UExtend), json.dumps({'.tag': 't0'}))
-        u_extend_extend = self.decode(self.sv.Union(self.ns.UExtendExtend),
-                                      json.dumps({'.tag': 't0'}))
-        self.assertEqual(u, u_extend)
-        self.assertEqual(hash(u), hash(u_extend))
-        self.assertEqual(u, u_extend_extend)
-        self.assertEqual(hash(u), hash(u_extend_extend))
-        self.assertEqual(u_extend, u_extend_extend)
-        self.assertEqual(hash(u_extend), hash(u_extend_extend))
-
     def test_struct_decoding_with_optional_struct(self):
         opt_s = self.decode(
             self.sv.Struct(self.ns.OptionalS),
@@ -1289,6 +1405,81 @@ class TestGeneratedPython(unittest.TestCase):
             [self.ns.S('Test')])
         self.assertEqual(v, json.dumps([{'f': 'Test'}]))
 
+    def test_union_symbols(self):
+        # Symbols decode to the shared class attributes
+        self.assertIs(self.decode(self.ns.U_validator, '"t0"'), self.ns.U.t0)
+        self.assertIs(self.decode(self.ns.U_validator, '{".tag": "t2"}'), self.ns.U.t2)
+        self.assertIs(self.decode(self.ns.Sym_validator, '"s1"'), self.ns.Sym.s1)
+        self.assertIs(self.decode(self.ns.Sym_validator, '"zz"', strict=False),
+                      self.ns.Sym.other)
+        self.assertIs(self.compat_obj_decode(self.ns.U_validator, 't0', old_style=True),
+                      self.ns.U.t0)
+        v = self.decode(self.ns.V_validator, '{".tag": "t5", "t5": "t0"}')
+        self.assertIs(v.get_t5(), self.ns.U.t0)
+
+        # Subclasses share their own instances, not those of their parent
+        t0 = self.decode(self.ns.UOpen_validator, '"t0"')
+        self.assertIsInstance(t0, self.ns.UOpen)
+        self.assertIs(self.decode(self.ns.UOpen_validator, '"t0"'), t0)
+        self.assertIs(self.decode(self.ns.UOpen_validator, '"t3"'), self.ns.UOpen.t3)
+        self.assertEqual(t0, self.ns.U.t0)
+        s2 = self.decode(self.ns.SymExtend_validator, '{".tag": "s2"}')
+        self.assertIsInstance(s2, self.ns.SymExtend)
+        self.assertIs(self.decode(self.ns.SymExtend_validator, '"s2"'), s2)
+        self.assertTrue(s2.is_s2())
+        self.assertIsNone(s2.get_s2())
+        s2 = self.decode(self.ns.SymExtend_validator, '{".tag": "s2", "s2": "x"}')
+        self.assertEqual(s2.get_s2(), 'x')
+
+        # Unions composed of only symbols have no _value slot
+        self.assertEqual(self.ns.Sym.__slots__, [])
+        self.assertEqual(self.ns.SymExtend.__slots__, ['_value'])
+        self.assertEqual(self.ns.UOpen.__slots__, [])
+        with self.assertRaises(AttributeError):
+            self.ns.Sym.s0.x = 1
+        sym = self.ns.Sym('s0')
+        self.assertIsNone(sym._value)
+        self.assertEqual(sym, self.ns.Sym.s0)
+        self.assertEqual(hash(sym), hash(self.ns.Sym.s0))
+        self.assertNotEqual(sym, self.ns.Sym.s1)
+        self.assertEqual(self.encode(self.ns.Sym_validator, sym), json.dumps({'.tag': 's0'}))
+
+    def test_field_mask(self):
+        d = self.ns.D(a='A', c='C', d=[1], e={})
+        self.assertEqual(self.encode(self.ns.D_validator, d, field_mask=['c', 'a']),
+                         json.dumps({'a': 'A', 'c': 'C'}))
+        self.assertEqual(self.compat_obj_encode(self.ns.D_validator, d, field_mask={'d': True}),
+                         {'d': [1]})
+
+        # Required fields are only checked if they are in the mask
+        d = self.ns.D(c='C', d=[], e={})
+        self.assertEqual(self.encode(self.ns.D_validator, d, field_mask=['c']),
+                         json.dumps({'c': 'C'}))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.encode(self.ns.D_validator, d, field_mask=['a'])
+        self.assertEqual("missing required field 'a'", str(cm.exception))
+
+        # Masks are carried through lists, maps, nullables, unions and subtypes
+        resources = [self.ns.File(name='f', size=1), self.ns.Folder(name='g')]
+        self.assertEqual(
+            self.encode(self.sv.List(self.ns.Resource_validator), resources,
+                        field_mask=['size']),
+            json.dumps([{'.tag': 'file', 'size': 1}, {'.tag': 'folder'}]))
+        self.assertEqual(
+            self.encode(self.sv.Map(self.sv.String(), self.sv.Nullable(self.ns.A_validator)),
+                        {'x': self.ns.A(a='a', b=1), 'y': None}, field_mask=['b']),
+            json.dumps({'x': {'b': 1}, 'y': None}))
+        v = self.ns.V.t3(self.ns.S(f='F'))
+        self.assertEqual(self.encode(self.ns.V_validator, v, field_mask={'t3': {}}),
+                         json.dumps({'.tag': 't3'}))
+        self.assertEqual(self.encode(self.ns.V_validator, v, field_mask={'t4': {}}),
+                         json.dumps({'.tag': 't3', 'f': 'F'}))
+        s2 = self.ns.S2(f1=self.ns.OptionalS(f1='x', f2=2))
+        self.assertEqual(self.encode(self.ns.S2_validator, s2, field_mask=['f1.f2', 'f1.f2.z']),
+                         json.dumps({'f1': {'f2': 2}}))
+        self.assertEqual(self.encode(self.ns.S2_validator, s2, field_mask=['f1.f2', 'f1']),
+                         self.encode(self.ns.S2_validator, s2))
+
     def test_objs(self):
 
         # Test initializing struct params (also tests parent class fields)
@@ -1390,40 +1581,6 @@ class TestGeneratedPython(unittest.TestCase):
         self.assertFalse(s.has_default())
         self.assertRaises(AssertionError, s.get_default)
 
-    def tearDown(self):
-        # Clear output of stone tool after all tests.
-        shutil.rmtree('output')
-
-    def test_msgpack(self):
-        # Do a limited amount of testing just to make sure that unicode
-        # handling and byte array handling are functional.
-
-        # If the machine doesn't have msgpack, don't worry about these tests.
-        try:
-            from stone_serializers import (
-                msgpack_encode,
-                msgpack_decode,
-            )
-        except ImportError:
-            return
-
-        b = self.ns.B(a='hi', b=32, c=b'\x00\x01')
-        s = msgpack_encode(self.sv.Struct(self.ns.B), b)
-        b2 = msgpack_decode(self.sv.Struct(self.ns.B), s)
-        self.assertEqual(b.a, b2.a)
-        self.assertEqual(b.b, b2.b)
-        self.assertEqual(b.c, b2.c)
-
-        bs = b'\x00\x01'
-        s = msgpack_encode(self.sv.Bytes(), bs)
-        bs2 = msgpack_decode(self.sv.Bytes(), s)
-        self.assertEqual(bs, bs2)
-
-        u = u'\u2650'
-        s = msgpack_encode(self.sv.String(), u)
-        u2 = msgpack_decode(self.sv.String(), s)
-        self.assertEqual(u, u2)
-
     def test_alias_validators(self):
 
         def aliased_string_validator(val):
@@ -1469,10 +1626,1183 @@ class TestGeneratedPython(unittest.TestCase):
                 alias_validators=aliased_validators)
         self.assertEqual("s: No spaces allowed", str(cm.exception))
 
+
+class TestGeneratedPython(_CodingTests, _GeneratedPythonTestCase):
+
+    def test_docstring(self):
+        # Check that the docstrings from the spec have in some form made it
+        # into the Python docstrings for the generated objects.
+        self.assertIn('Sample struct doc.', self.ns.A.__doc__)
+        self.assertIn('Sample field doc.', self.ns.A.a.__doc__)
+        self.assertIn('Sample union doc.', self.ns.U.__doc__)
+        self.assertIn('Sample field doc.', self.ns.U.t0.__doc__)
+
+        # Test doc conversion of Python bool.
+        self.assertIn('``True``', self.ns.DocTest.b.__doc__)
+        # Test doc converts type reference to sphinx-friendly representation.
+        self.assertIn(':class:`D`', self.ns.DocTest.t.__doc__)
+
+    def test_aliases(self):
+        # The left is a validator, the right is the struct devs can use...
+        self.assertEqual(self.ns.AliasedS2, self.ns.S2)
+
+    def test_union_equality_with_object(self):
+        """Should not throw an error when comparing with object.
+
+        Object is a superclass of Union, but it should not be considered for equality.
+        """
+        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
+        self.assertFalse(u == object())
+
+    def test_union_equality_with_tag(self):
+        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
+        u_equal = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
+        u_unequal = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't2'}))
+        self.assertEqual(u, u_equal)
+        self.assertEqual(hash(u), hash(u_equal))
+        self.assertNotEqual(u, u_unequal)
+        self.assertNotEqual(hash(u), hash(u_unequal))
+
+    def test_union_equality_with_value(self):
+        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't1', 't1': 'a'}))
+        u_equal = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't1', 't1': 'a'}))
+        u_unequal = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't1', 't1': 'b'}))
+        self.assertEqual(u, u_equal)
+        self.assertEqual(hash(u), hash(u_equal))
+        self.assertNotEqual(u, u_unequal)
+        self.assertNotEqual(hash(u), hash(u_unequal))
+
+    def test_union_equality_with_closed_and_open(self):
+        """A closed union should be considered equal to an open union if they have a direct
+        inheritance relationship."""
+        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
+        u_open = self.decode(self.sv.Union(self.ns.UOpen), json.dumps({'.tag': 't0'}))
+        self.assertEqual(u, u_open)
+        self.assertEqual(hash(u), hash(u_open))
+
+    def test_union_equality_with_different_types(self):
+        """Unions of different types that do not have an inheritance relationship are not considered
+        equal to each other."""
+        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
+        v = self.decode(self.sv.Union(self.ns.V), json.dumps({'.tag': 't0'}))
+        self.assertNotEqual(u, v)
+        # They still hash to the same value, since they have the same tag and value, but this is
+        # fine since we don't expect to use a large number of unions as dict keys.
+        self.assertEqual(hash(u), hash(v))
+
+        # U_extend and U_extend2 are indirectly related because they both extend U, but they do not
+        # have a direct line of inheritance to each other.
+        u_extend = self.decode(self.sv.Union(self.ns.UExtend), json.dumps({'.tag': 't0'}))
+        u_extend2 = self.decode(self.sv.Union(self.ns.UExtend2), json.dumps({'.tag': 't0'}))
+        self.assertNotEqual(u_extend, u_extend2)
+        # They still hash to the same value, since they have the same tag and value, but this is
+        # fine since we don't expect to use a large number of unions as dict keys.
+        self.assertEqual(hash(u_extend), hash(u_extend2))
+
+    def test_extended_union_equality(self):
+        """Unions which subclass each other are considered equal to each other."""
+        u = self.decode(self.sv.Union(self.ns.U), json.dumps({'.tag': 't0'}))
+        u_extend = self.decode(self.sv.Union(self.ns.UExtend), json.dumps({'.tag': 't0'}))
+        u_extend_extend = self.decode(self.sv.Union(self.ns.UExtendExtend),
+                                      json.dumps({'.tag': 't0'}))
+        self.assertEqual(u, u_extend)
+        self.assertEqual(hash(u), hash(u_extend))
+        self.assertEqual(u, u_extend_extend)
+        self.assertEqual(hash(u), hash(u_extend_extend))
+        self.assertEqual(u_extend, u_extend_extend)
+        self.assertEqual(hash(u_extend), hash(u_extend_extend))
+
+    def test_json_encode_iter(self):
+        s = self.ns.S('Test \u2650')
+        d = self.ns.D(a='x', c=None, d=[1, None, -2], e={'k': None, 'k2': 'v'})
+        cases = [
+            (self.sv.List(self.ns.S_validator), [s] * 3),
+            (self.sv.List(self.ns.S_validator), []),
+            (self.sv.Map(self.sv.String(), self.ns.D_validator), {'a': d, 'b\n': d}),
+            (self.sv.Map(self.sv.String(), self.sv.Int32()), {}),
+            (self.sv.Nullable(self.sv.List(self.ns.U_validator)), None),
+            (self.sv.Nullable(self.sv.List(self.ns.U_validator)),
+             [self.ns.U.t0, self.ns.U.t1('a')]),
+            (self.ns.D_validator, d),
+            (self.ns.DocTest_validator, self.ns.DocTest(b=True, t='t')),
+            (self.ns.Resource_validator, self.ns.File(name='f', size=1)),
+            (self.ns.V_validator, self.ns.V.t9(['a', 'b'])),
+            (self.sv.Float64(), 1.5),
+        ]
+        for data_type, obj in cases:
+            expected = self.encode(data_type, obj)
+            for chunk_size in (1, 10, 1 << 16):
+                chunks = self.ss.json_encode_iter(data_type, obj, chunk_size=chunk_size)
+                self.assertEqual(''.join(chunks), expected)
+            stream = six.StringIO()
+            self.ss.json_encode_to(stream, data_type, obj)
+            self.assertEqual(stream.getvalue(), expected)
+
+        # List items are yielded as they are encoded
+        chunks = self.ss.json_encode_iter(self.sv.List(self.ns.S_validator), [s] * 3, chunk_size=1)
+        self.assertEqual(next(chunks), '[')
+        self.assertEqual(next(chunks), json.dumps({'f': s.f}))
+
+        # Errors carry the same path, though part of the output may have been
+        # yielded already.
+        d = self.ns.D(c=None, d=[1, None, -2], e={'k': None, 'k2': 'v'})
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            ''.join(self.ss.json_encode_iter(self.sv.List(self.ns.D_validator), [d]))
+        self.assertEqual("missing required field 'a'", str(cm.exception))
+        s2 = self.ns.S2(f1=self.ns.OptionalS())
+        s2._f1_value = 'invalid'
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            ''.join(self.ss.json_encode_iter(self.ns.S2_validator, s2))
+        self.assertEqual("f1: expected type OptionalS, got string", str(cm.exception))
+        nullable_list = self.sv.Nullable(self.sv.List(self.ns.S_validator))
+        for obj, error in [(s, "S(f='Test \u2650') is not a valid list"),
+                           ([s, 'x'], 'expected type S, got string')]:
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                ''.join(self.ss.json_encode_iter(nullable_list, obj))
+            self.assertEqual(error, str(cm.exception))
+
+    def test_json_decode_iter(self):
+        list_validator = self.sv.List(self.ns.S_validator)
+        serialized = json.dumps([{'f': 'a'}, {'f': '\u2650'}, {'f': 'c'}], indent=2)
+        for chunk_size in (1, 5, 1 << 16):
+            for stream in (six.StringIO(serialized), six.BytesIO(serialized.encode('utf-8'))):
+                items = list(self.ss.json_decode_iter(stream, list_validator,
+                                                      chunk_size=chunk_size))
+                self.assertEqual([item.f for item in items], ['a', '\u2650', 'c'])
+
+        # Reads may end in the middle of a character, and invalid UTF-8 is
+        # an error
+        class ByteReader(object):
+            def __init__(self, data):
+                self.stream = six.BytesIO(data)
+
+            def read(self, size):  # pylint: disable=unused-argument,useless-suppression
+                return self.stream.read(1)
+
+        string_list = self.sv.List(self.sv.String())
+        self.assertEqual(
+            list(self.ss.json_decode_iter(
+                ByteReader('["\u00e9abc", "x"]'.encode('utf-8')), string_list)),
+            ['\u00e9abc', 'x'])
+        for data in (b'["\xff"]', b'["\xc3'):
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                list(self.ss.json_decode_iter(ByteReader(data), string_list))
+            self.assertEqual('could not decode input as JSON', str(cm.exception))
+
+        # Items are decoded as they are read
+        items = self.ss.json_decode_iter(six.StringIO('[{"f": "a"}, {"f": 1}'), list_validator)
+        self.assertEqual(next(items).f, 'a')
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            next(items)
+        self.assertEqual("f: '1' expected to be a string, got integer", str(cm.exception))
+
+        self.assertEqual(
+            list(self.ss.json_decode_iter(
+                six.StringIO('null'), self.sv.Nullable(list_validator))),
+            [])
+        for serialized, error in [('[{"f": "a"}', 'could not decode input as JSON'),
+                                  ('[] []', 'could not decode input as JSON'),
+                                  ('{}', 'expected list, got dict')]:
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                list(self.ss.json_decode_iter(six.StringIO(serialized), list_validator))
+            self.assertEqual(error, str(cm.exception))
+
+        # Invalid input is reported once it is read, without reading the
+        # rest of the stream
+        stream = six.StringIO('[{"f" "a"}, ' + '{"f": "b"}, ' * 100000 + '{"f": "c"}]')
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            list(self.ss.json_decode_iter(stream, list_validator, chunk_size=64))
+        self.assertEqual('could not decode input as JSON', str(cm.exception))
+        self.assertLessEqual(stream.tell(), 128)
+
+        # Items of a struct field
+        serialized = json.dumps({'a': 'x', 'd': [1, None, 3], 'e': {'k': 'v'}})
+        self.assertEqual(
+            list(self.ss.json_decode_iter(
+                six.StringIO(serialized), self.ns.D_validator, 'd', chunk_size=3)),
+            [1, None, 3])
+        for serialized, strict, error in [
+                ('{"d": [1, "2"]}', True, 'd: expected integer, got string'),
+                ('{"d": [1], "z": 2}', True, "unknown field 'z'"),
+                ('{"a": "x"}', True, "missing required field 'd'")]:
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                list(self.ss.json_decode_iter(
+                    six.StringIO(serialized), self.ns.D_validator, 'd', strict=strict))
+            self.assertEqual(error, str(cm.exception))
+        self.assertEqual(
+            list(self.ss.json_decode_iter(
+                six.StringIO('{"d": [1], "z": 2}'), self.ns.D_validator, 'd', strict=False)),
+            [1])
+
+    def test_stone_encoder_decoder(self):
+        encoder = self.ss.StoneEncoder()
+        decoder = self.ss.StoneDecoder()
+        list_validator = self.sv.List(self.ns.D_validator)
+        ds = [self.ns.D(a='a%d' % i, d=[i], e={'k': None}) for i in range(50)]
+        serialized = self.encode(list_validator, ds)
+
+        self.assertEqual(encoder.encode(list_validator, ds), serialized)
+        self.assertEqual(encoder.encode_compat(list_validator, ds), json.loads(serialized))
+        self.assertEqual(''.join(encoder.iterencode(list_validator, ds, 16)), serialized)
+        stream = six.StringIO()
+        encoder.encode_to(stream, list_validator, ds)
+        self.assertEqual(stream.getvalue(), serialized)
+        self.assertEqual([d.a for d in decoder.decode(list_validator, serialized)],
+                         [d.a for d in ds])
+        self.assertEqual(
+            decoder.decode_compat(self.ns.D_validator, {'a': 'x', 'd': [], 'e': {}}).a, 'x')
+        self.assertEqual(
+            [d.a for d in decoder.iterdecode(six.StringIO(serialized), list_validator)],
+            [d.a for d in ds])
+
+        # The options of each encoder and decoder are fixed
+        extra_field = '{"a": "x", "d": [], "e": {}, "z": 1}'
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            decoder.decode(self.ns.D_validator, extra_field)
+        self.assertEqual("unknown field 'z'", str(cm.exception))
+        lax_decoder = self.ss.StoneDecoder(strict=False)
+        self.assertEqual(lax_decoder.decode(self.ns.D_validator, extra_field).a, 'x')
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            decoder.decode(self.ns.D_validator, 'x')
+        self.assertEqual('could not decode input as JSON', str(cm.exception))
+
+        # Encoders and decoders may be shared by threads
+        def run():
+            for _ in range(20):
+                self.assertEqual(encoder.encode(list_validator, ds), serialized)
+                decoded = decoder.decode(list_validator, serialized)
+                self.assertEqual(encoder.encode(list_validator, decoded), serialized)
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def test_serialization_observer(self):
+        bb = __import__('stone_base')
+        reports = []
+        times = []
+
+        class Observer(self.ss.SerializationObserver):
+            count_structs = True
+
+            def on_encode(self, name, seconds, size, struct_counts):
+                times.append(seconds)
+                reports.append(('encode', name, size, struct_counts))
+
+            def on_decode(self, name, seconds, size, struct_counts):
+                times.append(seconds)
+                reports.append(('decode', name, size, struct_counts))
+
+        observer = Observer()
+        encoder = self.ss.StoneEncoder(observer=observer)
+        decoder = self.ss.StoneDecoder(observer=observer)
+        list_validator = self.sv.List(self.sv.Nullable(self.ns.V_validator))
+        vs = [self.ns.V.t7(self.ns.File(name='f', size=1)),
+              self.ns.V.t3(self.ns.S(f='s')),
+              self.ns.V.t12({'k': self.ns.U.t1('u')}),
+              self.ns.V.t4(None),
+              None]
+        serialized = self.encode(list_validator, vs)
+        counts = {'File': 1, 'S': 1}
+
+        self.assertEqual(encoder.encode(list_validator, vs), serialized)
+        self.assertEqual(''.join(encoder.iterencode(list_validator, vs, 16)), serialized)
+        encoder.encode_compat(list_validator, vs)
+        decoder.decode(list_validator, serialized)
+        decoder.decode_compat(self.ns.S_validator, {'f': 's'})
+        self.assertEqual(reports, [
+            ('encode', 'List(V?)', len(serialized), counts),
+            ('encode', 'List(V?)', len(serialized), counts),
+            ('encode', 'List(V?)', None, counts),
+            ('decode', 'List(V?)', len(serialized), counts),
+            ('decode', 'S', None, {'S': 1}),
+        ])
+        self.assertTrue(all(seconds >= 0 for seconds in times))
+
+        # Routes are named like their module-level variables
+        route = bb.Route('get', 2, False, self.ns.S_validator, self.ns.D_validator,
+                         self.sv.Map(self.sv.String(), self.ns.U_validator), {})
+        del reports[:]
+        d = self.ns.D(a='a', d=[1], e={})
+        self.assertEqual(decoder.decode_route_arg(route, encoder.encode_route_arg(
+            route, self.ns.S(f='s'))).f, 's')
+        self.assertEqual(decoder.decode_route_result(route, encoder.encode_route_result(
+            route, d)).a, 'a')
+        encoder.encode_route_error(route, {'k': self.ns.U.t0})
+        self.assertEqual([(kind, name) for kind, name, _, _ in reports], [
+            ('encode', 'get_v2.arg'),
+            ('decode', 'get_v2.arg'),
+            ('encode', 'get_v2.result'),
+            ('decode', 'get_v2.result'),
+            ('encode', 'get_v2.error'),
+        ])
+
+        # Without an observer, route methods encode like encode()
+        self.assertEqual(self.ss.StoneEncoder().encode_route_result(route, d),
+                         self.encode(self.ns.D_validator, d))
+        self.assertIs(self.ss.StoneDecoder().decode_route_error(route, '{}').get('k'), None)
+
+        # Struct counts are off by default, and failed calls are not reported
+        del reports[:]
+        Observer.count_structs = False
+        with self.assertRaises(self.sv.ValidationError):
+            decoder.decode(self.ns.S_validator, '{}')
+        decoder.decode(self.ns.S_validator, '{"f": "s"}')
+        self.assertEqual(reports, [('decode', 'S', 10, None)])
+
+    def test_shared_validators(self):
+        # Structurally identical validators of fields are a single instance
+        self.assertIs(self.ns.D._a_validator, self.ns.DocTest._t_validator)
+        self.assertIs(self.ns.D._b_validator, self.ns.E._b_validator)
+        self.assertIs(self.ns.D._e_validator.value_validator, self.ns.D._c_validator)
+        self.assertIs(self.ns.V._t1_validator, self.ns.U._t1_validator)
+        self.assertIs(self.ns.V._t0_validator, self.ns.U._t0_validator)
+        self.assertIsNot(self.ns.D._b_validator, self.ns.E._c_validator)
+        self.assertIsInstance(self.ns.V._t2_validator, self.sv.Nullable)
+
+    def test_lazy_decoding(self):
+        serialized = json.dumps({'a': 'A', 'c': 'C', 'd': [1, None], 'e': {'k': 'v'}})
+        d = self.decode(self.ns.D_validator, serialized, lazy=True)
+        self.assertIsInstance(d, self.ns.D)
+        self.assertIn('d', d._lazy_fields)
+        self.assertEqual(d.d, [1, None])
+        self.assertNotIn('d', d._lazy_fields)
+        self.assertEqual(d.b, 10)
+        self.assertEqual(repr(d), repr(self.decode(self.ns.D_validator, serialized)))
+        self.assertEqual(self.encode(self.ns.D_validator, d), serialized)
+        d.a = 'B'
+        del d.c
+        self.assertEqual((d.a, d.c), ('B', None))
+        self.assertEqual(d._lazy_fields, {})
+
+        # Required fields and unknown fields are checked up front, but the
+        # values of fields only when they are read.
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.decode(self.ns.D_validator, json.dumps({'d': [], 'e': {}}), lazy=True)
+        self.assertEqual("missing required field 'a'", str(cm.exception))
+        self.assertRaises(self.sv.ValidationError, self.decode, self.ns.D_validator,
+                          json.dumps({'a': 'A', 'd': [], 'e': {}, 'z': 1}), lazy=True)
+        d = self.decode(self.ns.D_validator, json.dumps({'a': 1, 'd': [], 'e': {}}), lazy=True)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            d.a  # pylint: disable=pointless-statement
+        self.assertIn('a: ', str(cm.exception))
+
+        # Nested structs are decoded lazily, and subtypes are encoded as usual
+        list_validator = self.sv.List(self.ns.Resource_validator)
+        serialized = json.dumps([{'.tag': 'file', 'name': 'f', 'size': 1},
+                                 {'.tag': 'folder', 'name': 'g'}])
+        resources = self.ss.StoneDecoder(lazy=True).decode(list_validator, serialized)
+        self.assertIsInstance(resources[0], self.ns.File)
+        self.assertEqual(resources[0].size, 1)
+        self.assertEqual(self.encode(list_validator, resources), serialized)
+        s3 = self.decode(self.ns.S3_validator, '{"u": "z"}', lazy=True)
+        self.assertIs(s3.u, self.ns2.BaseU.z)
+
+    def test_columns(self):
+        columns = {'a': ['x', 'y', 'z'], 'b': (1, None, 2**64 - 1), 'c': [None, 'C', None],
+                   'd': [[], [1, None], [2]], 'e': [{}, {'k': None}, {}]}
+        expected = [self.ns.D(a='x', b=1, d=[], e={}),
+                    self.ns.D(a='y', c='C', d=[1, None], e={'k': None}),
+                    self.ns.D(a='z', b=2**64 - 1, d=[2], e={})]
+        list_validator = self.sv.List(self.ns.D_validator)
+        ds = self.ss.struct_list_from_columns(self.ns.D_validator, columns)
+        self.assertEqual([repr(d) for d in ds], [repr(d) for d in expected])
+        self.assertEqual(ds[1].b, 10)
+        self.assertEqual(self.encode(list_validator, ds), self.encode(list_validator, expected))
+        self.assertEqual(self.ss.json_encode_columns(self.ns.D_validator, columns),
+                         self.encode(list_validator, expected))
+        rows = list(zip(*(columns[name] for name in 'abcde')))
+        self.assertEqual(self.ss.json_encode_columns(self.ns.D_validator, rows=rows),
+                         self.encode(list_validator, expected))
+        self.assertEqual(self.ss.struct_list_from_columns(self.ns.D_validator, rows=[]), [])
+
+        # The options of json_encode() apply alike
+        us = [self.ns2.BaseU.z, self.ns2.BaseU.x('a')]
+        s3s = [self.ns.S3(u=u) for u in us]
+        self.ss.register_json_engine(
+            'compact', lambda obj: json.dumps(obj, separators=(',', ':')), json.loads)
+        for kwargs in [{'old_style': True}, {'json_engine': 'compact'}]:
+            self.assertEqual(
+                self.ss.json_encode_columns(self.ns.S3_validator, {'u': us}, **kwargs),
+                self.ss.json_encode(self.sv.List(self.ns.S3_validator), s3s, **kwargs))
+
+        # Columns are validated like the values of each field
+        def error(**kwargs):
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                self.ss.json_encode_columns(self.ns.D_validator, **kwargs)
+            return str(cm.exception)
+
+        self.assertEqual(error(columns=dict(columns, b=[1, 2, -1])),
+                         'b: -1 is not within range [0, 18446744073709551615]')
+        self.assertEqual(error(columns=dict(columns, a=['x', None, 'z'])),
+                         "missing required field 'a'")
+        self.assertEqual(error(columns=dict(columns, d=[[], ['1'], []])),
+                         "d: expected integer, got string")
+        self.assertEqual(error(columns={'a': ['x']}), "missing required field 'd'")
+        self.assertEqual(error(columns=dict(columns, z=[1, 2, 3])), "unknown field 'z'")
+        self.assertEqual(error(columns=dict(columns, c=['C'])),
+                         "column 'c' has 1 values, expected 3")
+        self.assertEqual(error(rows=[('x', 1)]), 'row 0 has 2 values, expected 5')
+
+        # Struct values are type checked like by setters
+        s2s = self.ss.struct_list_from_columns(
+            self.ns.S2_validator, {'f1': [self.ns.OptionalS(f1='x')]})
+        self.assertEqual(s2s[0].f1.f1, 'x')
+        self.assertRaises(self.sv.ValidationError, self.ss.struct_list_from_columns,
+                          self.ns.S2_validator, {'f1': [self.ns.S(f='F')]})
+
+    def test_pickle_and_copy(self):
+        def roundtrips(value):
+            return [pickle.loads(pickle.dumps(value, protocol))
+                    for protocol in range(pickle.HIGHEST_PROTOCOL + 1)] + [
+                copy.copy(value), copy.deepcopy(value)]
+
+        d = self.ns.D(a='A', c='C', d=[1, None], e={'k': None})
+        self.assertEqual(d.__getstate__(),
+                         (('a', 'A'), ('d', [1, None]), ('e', {'k': None}), ('c', 'C')))
+        for d2 in roundtrips(d):
+            self.assertIsInstance(d2, self.ns.D)
+            self.assertEqual(repr(d2), repr(d))
+            self.assertEqual(d2.b, 10)
+            self.assertEqual(self.encode(self.ns.D_validator, d2),
+                             self.encode(self.ns.D_validator, d))
+        self.assertIs(copy.copy(d).d, d.d)
+        self.assertIsNot(copy.deepcopy(d).d, d.d)
+
+        # Fields are restored by name, and unset fields stay unset
+        d2 = pickle.loads(pickle.dumps(self.ns.D(d=[], e={})))
+        self.assertRaises(AttributeError, lambda: d2.a)
+        d2.__setstate__((('a', 'B'), ('z', 1)))
+        self.assertEqual((d2.a, d2.b, d2.c), ('B', 10, None))
+        self.assertRaises(AttributeError, lambda: d2.d)
+
+        # Subtypes, lazily decoded structs and pickles of slots
+        for f in roundtrips(self.ns.File(name='f', size=1)):
+            self.assertEqual((type(f), f.name, f.size), (self.ns.File, 'f', 1))
+        serialized = json.dumps({'a': 'A', 'd': [1], 'e': {}})
+        lazy_d = self.decode(self.ns.D_validator, serialized, lazy=True)
+        for d2 in roundtrips(lazy_d):
+            self.assertIs(type(d2), self.ns.D)
+            self.assertEqual(self.encode(self.ns.D_validator, d2), serialized)
+        d2 = self.ns.D.__new__(self.ns.D)
+        d2.__setstate__((None, {slot: getattr(d, slot) for cls in type(d).__mro__
+                                for slot in vars(cls).get('__slots__', ())}))
+        self.assertEqual(repr(d2), repr(d))
+
+        # Unions, with symbols restored as the shared instance
+        for u in roundtrips(self.ns.U.t0):
+            self.assertIs(u, self.ns.U.t0)
+        v = self.ns.V.t10([self.ns.U.t0, self.ns.U.t1('x')])
+        for v2 in roundtrips(v):
+            self.assertEqual(v2, v)
+            self.assertIs(v2.get_t10()[0], self.ns.U.t0)
+        self.assertIs(copy.copy(v), v)
+        self.assertIsNot(copy.deepcopy(v).get_t10(), v.get_t10())
+
+    def test_json_encode_parallel(self):
+        class PicklingPool(object):
+            # Sends chunks through pickle, as a process pool does.
+            def map(self, func, iterable):
+                return [func(pickle.loads(pickle.dumps(args))) for args in iterable]
+
+        list_validator = self.sv.List(self.ns.D_validator)
+        ds = [self.ns.D(a=str(i), c='C' if i % 2 else None, d=[i, None], e={'k': str(i)})
+              for i in range(7)]
+        expected = self.encode(list_validator, ds)
+        for chunk_items in (1, 3, 7):
+            self.assertEqual(
+                self.ss.json_encode_parallel(list_validator, ds, pool=PicklingPool(),
+                                             chunk_items=chunk_items, min_items=1),
+                expected)
+        start_method = None if six.PY2 else multiprocessing.get_start_method(allow_none=True)
+        self.assertEqual(
+            self.ss.json_encode_parallel(self.sv.Nullable(list_validator), ds, processes=2,
+                                         chunk_items=2, min_items=1),
+            expected)
+        # The pool started for the call leaves the start method to the
+        # application
+        if not six.PY2:
+            self.assertEqual(multiprocessing.get_start_method(allow_none=True), start_method)
+        self.assertEqual(
+            self.ss.json_encode_parallel(self.sv.List(self.sv.UInt64()), list(range(10)),
+                                         pool=PicklingPool(), chunk_items=4, min_items=1),
+            self.encode(self.sv.List(self.sv.UInt64()), list(range(10))))
+        self.assertEqual(self.ss.json_encode_parallel(list_validator, ds, pool=PicklingPool()),
+                         expected)
+        self.assertEqual(
+            self.ss.json_encode_parallel(list_validator, ds, pool=PicklingPool(),
+                                         field_mask=['c'], chunk_items=3, min_items=1),
+            self.encode(list_validator, ds, field_mask=['c']))
+
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.json_encode_parallel(list_validator, ds + [self.ns.D(d=[], e={})],
+                                         pool=PicklingPool(), chunk_items=3, min_items=1)
+        self.assertEqual("missing required field 'a'", str(cm.exception))
+        self.assertRaises(self.sv.ValidationError, self.ss.json_encode_parallel,
+                          self.sv.List(self.ns.D_validator, max_items=5), ds,
+                          pool=PicklingPool(), min_items=1)
+
+    def test_json_engines(self):
+        # Conformance of every installed engine with the standard library on
+        # the same payloads: the text must hold the same values, with object
+        # keys in the same order, and decode to the same values.
+        def parse(text):
+            return json.loads(text, object_pairs_hook=lambda pairs: pairs)
+
+        payloads = [
+            (self.sv.List(self.ns.D_validator), [
+                self.ns.D(a='\u00e9\u2603\U0001F600 </ "\\\n\t\x00\x7f', c='',
+                          d=[0, None, 2**63 - 1, -2**63], e={'\u00e9': None, '': 'x'}),
+                self.ns.D(a='x', b=2**64 - 1, d=[], e={})]),
+            (self.sv.List(self.sv.Float64()),
+             [0.0, -0.0, 0.1, 1.5, 3.0, 1e16, 1e-7, 5e-324, 1.7976931348623157e308,
+              -2.5e-300, 123456789.12345679]),
+            (self.sv.List(self.sv.Boolean()), [True, False]),
+            (self.sv.Nullable(self.sv.Int32()), None),
+            (self.ns.V_validator, self.ns.V.t10([self.ns.U.t0, self.ns.U.t1('\u00e9')])),
+            (self.sv.List(self.ns.Resource_validator),
+             [self.ns.File(name='f', size=1), self.ns.Folder(name='g')]),
+            (self.sv.Map(self.sv.String(), self.sv.Bytes()), {'b': b'\x00\xff', 'a': b''}),
+            (self.sv.Timestamp('%a, %d %b %Y %H:%M:%S +0000'),
+             datetime.datetime(2015, 5, 12, 15, 50, 38)),
+        ]
+        self.ss.register_json_engine(
+            'compact', lambda obj: json.dumps(obj, separators=(',', ':')), json.loads)
+        engines = ['compact']
+        for name in ['json', 'orjson', 'ujson', 'rapidjson']:
+            try:
+                self.ss.get_json_engine(name)
+            except ImportError:
+                continue
+            engines.append(name)
+
+        for name in engines:
+            for validator, value in payloads:
+                expected = self.encode(validator, value)
+                text = self.encode(validator, value, json_engine=name)
+                self.assertEqual(parse(text), parse(expected), name)
+                self.assertEqual(''.join(self.ss.json_encode_iter(
+                    validator, value, chunk_size=1, json_engine=name)), text, name)
+                self.assertEqual(
+                    self.ss.StoneEncoder(json_engine=name).encode(validator, value), text)
+                for serialized in (text, expected, text.encode('utf-8')):
+                    decoded = self.decode(validator, serialized, json_engine=name)
+                    self.assertEqual(self.encode(validator, decoded), expected, name)
+                    decoded = self.ss.StoneDecoder(json_engine=name).decode(
+                        validator, serialized)
+                    self.assertEqual(self.encode(validator, decoded), expected, name)
+            self.assertRaises(self.sv.ValidationError, self.decode, self.sv.List(self.sv.Int32()),
+                              '[1,', json_engine=name)
+
+        # The default engine is the first of those given that is installed
+        try:
+            self.assertEqual(self.ss.set_json_engine(*engines[::-1]), engines[-1])
+            self.assertEqual(self.ss.set_json_engine('compact'), 'compact')
+            d = self.ns.D(a='A', d=[1], e={})
+            self.assertEqual(self.encode(self.ns.D_validator, d), '{"a":"A","d":[1],"e":{}}')
+            self.assertEqual(''.join(self.ss.json_encode_iter(self.ns.D_validator, d)),
+                             '{"a":"A","d":[1],"e":{}}')
+            self.assertEqual(self.encode(self.ns.D_validator, d, json_engine='json'),
+                             '{"a": "A", "d": [1], "e": {}}')
+        finally:
+            self.ss.set_json_engine()
+        self.assertEqual(self.ss.get_json_engine().name, 'json')
+        self.assertRaises(ValueError, self.ss.get_json_engine, 'missing_engine_module')
+
+    def test_msgpack(self):
+        # Do a limited amount of testing just to make sure that unicode
+        # handling and byte array handling are functional.
+
+        # If the machine doesn't have msgpack, don't worry about these tests.
+        try:
+            from stone_serializers import (
+                msgpack_encode,
+                msgpack_decode,
+            )
+        except ImportError:
+            return
+
+        b = self.ns.B(a='hi', b=32, c=b'\x00\x01')
+        s = msgpack_encode(self.sv.Struct(self.ns.B), b)
+        b2 = msgpack_decode(self.sv.Struct(self.ns.B), s)
+        self.assertEqual(b.a, b2.a)
+        self.assertEqual(b.b, b2.b)
+        self.assertEqual(b.c, b2.c)
+
+        bs = b'\x00\x01'
+        s = msgpack_encode(self.sv.Bytes(), bs)
+        bs2 = msgpack_decode(self.sv.Bytes(), s)
+        self.assertEqual(bs, bs2)
+
+        u = u'\u2650'
+        s = msgpack_encode(self.sv.String(), u)
+        u2 = msgpack_decode(self.sv.String(), s)
+        self.assertEqual(u, u2)
+
+    def test_msgpack_round_trips(self):
+        try:
+            import msgpack
+        except ImportError:
+            return
+
+        payloads = [
+            (self.sv.List(self.ns.D_validator), [
+                self.ns.D(a='\u00e9\u2603\U0001F600', c='', d=[0, None, -2**63], e={'k': None}),
+                self.ns.D(a='x', b=2**64 - 1, d=[], e={})]),
+            (self.sv.List(self.sv.Float64()), [0.1, -2.5e-300, 1.7976931348623157e308]),
+            (self.ns.V_validator, self.ns.V.t10([self.ns.U.t0, self.ns.U.t1('x')])),
+            (self.sv.List(self.ns.Resource_validator),
+             [self.ns.File(name='f', size=1), self.ns.Folder(name='g')]),
+            (self.sv.Map(self.sv.String(), self.sv.Bytes()), {'b': b'\x00\xff', 'a': b''}),
+            (self.sv.List(self.sv.Timestamp('%a, %d %b %Y %H:%M:%S +0000')),
+             [datetime.datetime(2015, 5, 12, 15, 50, 38), datetime.datetime(1901, 1, 1)]),
+            (self.sv.Nullable(self.sv.List(self.sv.Int32())), None),
+        ]
+        for validator, value in payloads:
+            for native_timestamps in (False, True):
+                s = self.ss.msgpack_encode(validator, value, native_timestamps=native_timestamps)
+                decoded = self.ss.msgpack_decode(validator, s)
+                self.assertEqual(self.encode(validator, decoded), self.encode(validator, value))
+                self.assertEqual(self.ss.msgpack_encode(
+                    validator, decoded, native_timestamps=native_timestamps), s)
+                self.assertEqual(b''.join(self.ss.msgpack_encode_iter(
+                    validator, value, chunk_size=1, native_timestamps=native_timestamps)), s)
+                self.assertEqual(self.encode(validator, self.ss.msgpack_compat_obj_decode(
+                    validator, msgpack.unpackb(s, raw=False))), self.encode(validator, value))
+
+        # Bytes are bin, and timestamps formatted strings, as in JSON
+        self.assertEqual(self.ss.msgpack_encode(self.sv.Bytes(), b'\xff'), b'\xc4\x01\xff')
+        ts = datetime.datetime(2015, 5, 12, 15, 50, 38, 123456)
+        timestamp_validator = self.sv.Timestamp('%Y-%m-%dT%H:%M:%SZ')
+        self.assertEqual(msgpack.unpackb(self.ss.msgpack_encode(timestamp_validator, ts)),
+                         '2015-05-12T15:50:38Z')
+
+        # Unless they are native, which keeps microseconds
+        s = self.ss.msgpack_encode(timestamp_validator, ts, native_timestamps=True)
+        self.assertEqual(msgpack.unpackb(s), msgpack.Timestamp(1431445838, 123456000))
+        self.assertEqual(self.ss.msgpack_decode(timestamp_validator, s), ts)
+
+        # Either way, the fields of an aware datetime, which only trusted
+        # values may have in another time zone than UTC, are taken to be in
+        # UTC, and decode to the same datetime as JSON
+        class Tz(datetime.tzinfo):  # pylint: disable=abstract-method
+            def utcoffset(self, dt):  # pylint: disable=unused-argument,useless-suppression
+                return datetime.timedelta(hours=2)
+        aware_ts = ts.replace(microsecond=0, tzinfo=Tz())
+        expected = self.decode(timestamp_validator, self.ss.json_encode(
+            timestamp_validator, aware_ts, trusted=True))
+        self.assertEqual(expected, datetime.datetime(2015, 5, 12, 15, 50, 38))
+        for native_timestamps in (False, True):
+            s = self.ss.msgpack_encode(timestamp_validator, aware_ts, trusted=True,
+                                       native_timestamps=native_timestamps)
+            self.assertEqual(self.ss.msgpack_decode(timestamp_validator, s), expected)
+
+        # Bytes as str, as written by earlier versions, are still decoded
+        self.assertEqual(self.ss.msgpack_decode(self.sv.Bytes(), msgpack.packb('ab')), b'ab')
+
+        # Invalid UTF-8 and malformed input are errors, not silently dropped
+        for s in (b'\xa2\xff\xfe', b'\x92\x01', b'\x01\x02'):
+            self.assertRaises(self.sv.ValidationError, self.ss.msgpack_decode,
+                              self.sv.List(self.sv.String()), s)
+
+    def test_msgpack_streaming(self):
+        try:
+            import msgpack
+        except ImportError:
+            return
+
+        list_validator = self.sv.List(self.ns.D_validator)
+        ds = [self.ns.D(a=str(i), d=[i], e={}) for i in range(5)]
+        stream = six.BytesIO()
+        self.ss.msgpack_encode_to(stream, list_validator, ds, chunk_size=4)
+        self.assertEqual(stream.getvalue(), self.ss.msgpack_encode(list_validator, ds))
+        items = list(self.ss.msgpack_decode_iter(six.BytesIO(stream.getvalue()),
+                                                 list_validator, chunk_size=3))
+        self.assertEqual([repr(d) for d in items], [repr(d) for d in ds])
+
+        # Items of a list field of a struct
+        s = msgpack.packb({'a': 'A', 'z': {'y': [1]}, 'd': [1, None], 'e': {}})
+        self.assertEqual(list(self.ss.msgpack_decode_iter(
+            six.BytesIO(s), self.ns.D_validator, field_name='d', strict=False)), [1, None])
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            list(self.ss.msgpack_decode_iter(six.BytesIO(s), self.ns.D_validator,
+                                             field_name='d'))
+        self.assertEqual("unknown field 'z'", str(cm.exception))
+
+        def error(s, data_type=list_validator):
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                list(self.ss.msgpack_decode_iter(six.BytesIO(s), data_type))
+            return str(cm.exception)
+
+        self.assertEqual(error(msgpack.packb({})), 'expected list, got dict')
+        self.assertEqual(error(msgpack.packb(None)), 'expected list, got null')
+        self.assertEqual(list(self.ss.msgpack_decode_iter(
+            six.BytesIO(msgpack.packb(None)), self.sv.Nullable(list_validator))), [])
+        self.assertEqual(error(msgpack.packb([]) + b'\x01'), 'could not decode input as msgpack')
+        self.assertEqual(error(msgpack.packb([{'a': 'A'}])[:-1]),
+                         'could not decode input as msgpack')
+        self.assertEqual(error(msgpack.packb([{'a': 'A', 'd': []}])),
+                         "missing required field 'e'")
+
+    def test_binary_round_trips(self):
+        payloads = [
+            (self.sv.List(self.ns.D_validator), [
+                self.ns.D(a='é☃\U0001F600', c='', d=[0, None, -2**63], e={'k': None}),
+                self.ns.D(a='x', b=2**64 - 1, d=[], e={})]),
+            (self.sv.List(self.sv.Float64()), [0.1, -2.5e-300, 1.7976931348623157e308]),
+            (self.sv.List(self.sv.Boolean()), [True, False]),
+            (self.sv.List(self.sv.Nullable(self.sv.UInt64())), [300, None, 2**64 - 1]),
+            (self.sv.List(self.ns.V_validator), [
+                self.ns.V.t0, self.ns.V.t2(None), self.ns.V.t3(self.ns.S(f='s')),
+                self.ns.V.t4(None), self.ns.V.t7(self.ns.File(name='f', size=1)),
+                self.ns.V.t10([self.ns.U.t0, self.ns.U.t1('x')]),
+                self.ns.V.t11({'a': -1})]),
+            (self.sv.List(self.ns.Resource_validator),
+             [self.ns.File(name='f', size=1), self.ns.Folder(name='g')]),
+            (self.sv.Map(self.sv.String(), self.sv.Bytes()), {'b': b'\x00\xff', 'a': b''}),
+            (self.sv.List(self.sv.Timestamp('%a, %d %b %Y %H:%M:%S +0000')),
+             [datetime.datetime(2015, 5, 12, 15, 50, 38), datetime.datetime(1901, 1, 1)]),
+            (self.sv.Nullable(self.sv.List(self.sv.Int32())), None),
+            (self.ns.C_validator, self.ns.C(a='a', b=-1, c=b'c', d=0.5)),
+        ]
+        for validator, value in payloads:
+            s = self.ss.binary_encode(validator, value)
+            decoded = self.ss.binary_decode(validator, s)
+            self.assertEqual(self.encode(validator, decoded), self.encode(validator, value))
+            self.assertEqual(self.ss.binary_encode(validator, decoded), s)
+
+        # Fields are keyed by the ids recorded by the backend
+        self.assertEqual(self.ns.C._field_ids_,
+                         {'a': self.ns.A._field_ids_['a'], 'b': self.ns.A._field_ids_['b'],
+                          'c': self.ns.B._field_ids_['c'], 'd': self.ns.C._field_ids_['d']})
+        self.assertEqual(len(set(self.ns.V._tag_ids_.values())), len(self.ns.V._tag_ids_))
+        # Of two names with the same id, the later one gets the next free id
+        self.assertEqual(self.ns.CollidingIds._field_ids_, {'ah': 1601, 'ei': 1602})
+        colliding = self.ns.CollidingIds(ah='a', ei='e')
+        self.assertEqual(repr(self.ss.binary_decode(
+            self.ns.CollidingIds_validator,
+            self.ss.binary_encode(self.ns.CollidingIds_validator, colliding))), repr(colliding))
+        s = self.ss.binary_encode(self.ns.S_validator, self.ns.S(f='é'))
+        key = self.ns.S._field_ids_['f'] << 3 | 2
+        self.assertEqual(s, bytes(bytearray([key & 0x7f | 0x80, key >> 7, 2, 0xc3, 0xa9, 0])))
+        self.assertEqual(self.ss.binary_encode(self.sv.Int64(), -2), b'\x03')
+        self.assertEqual(self.ss.binary_encode(self.sv.UInt32(), 300), b'\xac\x02')
+        self.assertEqual(self.ss.binary_encode(self.sv.Nullable(self.sv.Int64()), None), b'\x00')
+
+        # Encoding validates like JSON
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.binary_encode(self.sv.List(self.ns.D_validator), [self.ns.D(a='x')])
+        self.assertIn('missing required field', str(cm.exception))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.binary_encode(self.ns.D_validator,
+                                  self.ns.D(a='x', d=[1.5], e={}))
+        self.assertIn('d', str(cm.exception))
+
+        # Truncated input, trailing bytes and mismatched wire types are errors
+        s = self.ss.binary_encode(self.ns.S_validator, self.ns.S(f='s'))
+        for bad in (s[:-1], s[:-2], s + b'\x00'):
+            self.assertRaises(self.sv.ValidationError, self.ss.binary_decode,
+                              self.ns.S_validator, bad)
+        key = self.ns.S._field_ids_['f'] << 3
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.binary_decode(self.ns.S_validator,
+                                  bytes(bytearray([key & 0x7f | 0x80, key >> 7, 5, 0])))
+        self.assertEqual('f: expected wire type 2, got 0', str(cm.exception))
+        nullable_ints = self.sv.List(self.sv.Nullable(self.sv.Int64()))
+        for bad in (b'\x01\x02\x00', b'\x02\x01\x00', b'\x01\x01\x80'):
+            self.assertRaises(self.sv.ValidationError, self.ss.binary_decode,
+                              nullable_ints, bad)
+
+    def test_binary_compatibility(self):
+        # A B decoded as its supertype A has an unknown field
+        b = self.ns.B(a='a', b=1, c=b'c')
+        s = self.ss.binary_encode(self.ns.B_validator, b)
+        a = self.ss.binary_decode(self.ns.A_validator, s, strict=False)
+        self.assertEqual(self.encode(self.ns.A_validator, a), '{"a": "a", "b": 1}')
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.binary_decode(self.ns.A_validator, s)
+        self.assertEqual("unknown field '#%d'" % self.ns.B._field_ids_['c'],
+                         str(cm.exception))
+
+        # An unknown tag is decoded as the catch-all tag if not strict
+        s = self.ss.binary_encode(self.ns.SymExtend_validator, self.ns.SymExtend.s2('x'))
+        self.assertEqual(self.ss.binary_decode(self.ns.Sym_validator, s, strict=False)._tag,
+                         'other')
+        self.assertRaises(self.sv.ValidationError, self.ss.binary_decode,
+                          self.ns.Sym_validator, s)
+
+        # So is an unknown subtype, with its fields skipped
+        s = self.ss.binary_encode(self.ns.ResourceLax_validator,
+                                  self.ns.File2(name='f', size=1))
+        s = s.replace(b'\x04file', b'\x04fold')
+        r = self.ss.binary_decode(self.ns.ResourceLax_validator, s, strict=False)
+        self.assertEqual(type(r), self.ns.ResourceLax)
+        self.assertEqual(r.name, 'f')
+
     def test_struct_union_default(self):
         s = self.ns.S3()
         assert s.u == self.ns2.BaseU.z
 
+
+class TestGeneratedPythonWithCodecs(_CodingTests, _GeneratedPythonTestCase):
+    """
+    Runs the encoding and decoding tests against modules generated with
+    specialized codecs.
+    """
+
+    output_dir = 'output_codecs'
+    backend_args = ['--generate-codecs']
+
+    def test_codecs_generated(self):
+        for cls in (self.ns.A, self.ns.Resource, self.ns.File, self.ns.U, self.ns.V):
+            self.assertIn('_to_json_compat', vars(cls))
+            self.assertIn('_from_json_compat', vars(cls))
+
+    def test_codecs_bypassed(self):
+        # Generated codecs are only used without caller permissions, alias
+        # validators or redaction; make sure the generic path still works
+        # for the same classes.
+        def fail(*args):
+            raise AssertionError('codec called')
+
+        orig_to = vars(self.ns.A)['_to_json_compat']
+        orig_from = vars(self.ns.A)['_from_json_compat']
+        self.ns.A._to_json_compat = classmethod(fail)
+        self.ns.A._from_json_compat = classmethod(fail)
+        try:
+            a = self.ns.A(a='hello', b=1)
+            with self.assertRaises(AssertionError):
+                self.compat_obj_encode(self.ns.A_validator, a)
+            self.assertEqual(
+                self.compat_obj_encode(
+                    self.ns.A_validator, a, alias_validators={self.sv.String(): fail}),
+                {'a': 'hello', 'b': 1})
+            self.assertEqual(
+                self.compat_obj_encode(self.ns.A_validator, a, should_redact=True),
+                {'a': 'hello', 'b': 1})
+            a2 = self.compat_obj_decode(
+                self.ns.A_validator, {'a': 'hello', 'b': 1},
+                alias_validators={self.sv.String(): fail})
+            self.assertEqual((a2.a, a2.b), ('hello', 1))
+        finally:
+            self.ns.A._to_json_compat = orig_to
+            self.ns.A._from_json_compat = orig_from
+
+    def test_union_codec_fallback(self):
+        # Input that the generated decoder does not handle is reported by
+        # the generic decoder.
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.compat_obj_decode(self.ns.U_validator, {'.tag': 't1', 't1': 1, 'x': 2})
+        self.assertEqual("unexpected key 'x'", str(cm.exception))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.compat_obj_decode(self.ns.U_validator, 't1')
+        self.assertEqual("expected object for 't1', got symbol", str(cm.exception))
+        self.assertEqual(
+            self.compat_obj_decode(self.ns.V_validator, {'.tag': 'z'}, strict=False),
+            self.ns.V.other)
+
+
+class TestGeneratedPythonWithPresenceBitmask(_GeneratedPythonTestCase):
+    """
+    Tests modules whose structs track the presence of fields in a bitmask.
+    """
+
+    output_dir = 'output_bitmask'
+    backend_args = ['--presence-bitmask']
+
+    def test_presence_bitmask(self):
+        self.assertNotIn('_a_present', self.ns.A.__slots__)
+        self.assertIn('_presence', self.ns.A.__slots__)
+        self.assertNotIn('_presence', self.ns.C.__slots__)
+        self.assertEqual(self.ns.A._required_mask_, 0x3)
+        self.assertEqual(self.ns.C._required_mask_, 0xf)
+        # Fields with defaults and nullable fields are not required
+        self.assertEqual(self.ns.D._required_mask_, 0x19)
+
+        c = self.ns.C(a='a', d=1.0)
+        self.assertEqual(c._presence, 0x9)
+        self.assertTrue(c._a_present)
+        self.assertFalse(c._b_present)
+        c.b = 1
+        c.c = b''
+        self.assertEqual(c._presence, 0xf)
+        del c.a
+        self.assertEqual(c._presence, 0xe)
+        self.assertFalse(c._a_present)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.compat_obj_encode(self.ns.C_validator, c)
+        self.assertEqual("missing required field 'a'", str(cm.exception))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.compat_obj_decode(self.ns.C_validator, {'a': 'a', 'b': 1, 'd': 1.0})
+        self.assertEqual("missing required field 'c'", str(cm.exception))
+
+        d = self.ns.D(a='a', d=[], e={})
+        self.ns.D_validator.validate_fields_only(d)
+        self.assertEqual(self.compat_obj_encode(self.ns.D_validator, d),
+                         {'a': 'a', 'd': [], 'e': {}})
+
+
+class TestGeneratedPythonWithCodecsAndPresenceBitmask(
+        TestGeneratedPythonWithCodecs, TestGeneratedPythonWithPresenceBitmask):
+    """
+    Generated codecs read and set the presence bitmask directly, so the
+    encoding and decoding tests run against the two options together.
+    """
+
+    output_dir = 'output_codecs_bitmask'
+    backend_args = ['--generate-codecs', '--presence-bitmask']
+
+
+class TestGeneratedPythonWithTrustedConstructors(_GeneratedPythonTestCase):
+    """
+    Tests struct and union classes with trusted constructors.
+    """
+
+    output_dir = 'output_trusted'
+    backend_args = ['--trusted-constructors']
+
+    def test_trusted_constructors(self):
+        bb = __import__('stone_base')
+        c = self.ns.C._new_trusted(a='a', b=1, c=b'\x00', d=1.5)
+        self.assertEqual(repr(c), repr(self.ns.C(a='a', b=1, c=b'\x00', d=1.5)))
+        self.assertEqual(self.encode(self.ns.C_validator, c, trusted=True),
+                         self.encode(self.ns.C_validator, c))
+        v = self.ns.V._new_trusted('t1', 'x')
+        self.assertEqual(v, self.ns.V.t1('x'))
+        self.assertIs(self.ns.U._new_trusted('t0'), self.ns.U.t0)
+
+        # Trusted encodes don't validate values, but do check required fields
+        a = self.ns.A._new_trusted(a='a', b='not an integer')
+        self.assertEqual(self.encode(self.ns.A_validator, a, trusted=True),
+                         json.dumps({'a': 'a', 'b': 'not an integer'}))
+        self.assertRaises(self.sv.ValidationError, self.encode, self.ns.A_validator, a)
+        encoder = self.ss.StoneEncoder(trusted=True)
+        self.assertEqual(encoder.encode(self.sv.List(self.ns.A_validator), [a]),
+                         json.dumps([{'a': 'a', 'b': 'not an integer'}]))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.encode(self.ns.A_validator, self.ns.A._new_trusted(a='a'), trusted=True)
+        self.assertEqual("missing required field 'b'", str(cm.exception))
+
+        # In debug mode, trusted instances and encodings are validated
+        bb.trusted_debug = True
+        try:
+            self.assertRaises(self.sv.ValidationError, self.ns.A._new_trusted, a=1)
+            self.assertRaises(self.sv.ValidationError, self.ns.V._new_trusted, 't1', 1)
+            self.assertRaises(self.sv.ValidationError, self.encode, self.ns.A_validator, a,
+                              trusted=True)
+            # An encoder checks its JSON-compatible encodings as it does
+            # its JSON text
+            for encode in (encoder.encode, encoder.encode_compat):
+                self.assertRaises(self.sv.ValidationError, encode, self.ns.A_validator, a)
+            self.assertEqual(
+                self.encode(self.ns.A_validator, self.ns.A._new_trusted(a='a', b=1),
+                            trusted=True),
+                json.dumps({'a': 'a', 'b': 1}))
+        finally:
+            bb.trusted_debug = False
+
+
+class TestGeneratedPythonWithTrustedConstructorsAndPresenceBitmask(
+        TestGeneratedPythonWithTrustedConstructors):
+    """
+    Trusted constructors set fields without their properties, so they are
+    tested against struct classes with a presence bitmask as well.
+    """
+
+    output_dir = 'output_trusted_bitmask'
+    backend_args = ['--trusted-constructors', '--presence-bitmask']
+
+
+class TestGeneratedPythonWithLazyNamespaces(_GeneratedPythonTestCase):
+    """
+    Tests namespace modules that are defined on first access.
+    """
+
+    output_dir = 'output_lazy'
+    backend_args = ['--lazy-namespaces']
+
+    def test_lazy_namespaces(self):
+        # Importing a namespace module defines none of its names
+        self.assertNotIn('A', vars(self.ns))
+        self.assertNotIn('BaseS', vars(self.ns2))
+        self.assertNotIn('ns2', vars(self.ns))
+
+        # Accessing one defines the namespace. The namespaces it references are
+        # defined as they're used.
+        self.assertIs(self.ns.ImportTestS.__bases__[0], self.ns2.BaseS)
+        self.assertIn('A', vars(self.ns))
+        self.assertIs(self.ns.ns2, self.ns2)
+        self.assertIn('BaseS', vars(self.ns2))
+        s = self.ns.S3()
+        self.assertIs(s.u, self.ns2.BaseU.z)
+        self.assertIs(self.decode(self.ns.S3_validator, '{"u": "z"}').u, self.ns2.BaseU.z)
+
+        with self.assertRaises(AttributeError):
+            self.ns.DoesNotExist  # pylint: disable=pointless-statement
+        self.assertFalse(hasattr(self.ns, '__path__'))
+        self.assertIn('A', dir(self.ns))
+        scope = {}
+        exec('from ns import *', scope)  # pylint: disable=exec-used
+        self.assertIs(scope['A'], self.ns.A)
+        self.assertNotIn('_load', scope)
+
+    def test_lazy_namespaces_from_import(self):
+        scope = {}
+        exec('from ns2 import BaseS, AliasedBaseU_validator', scope)  # pylint: disable=exec-used
+        self.assertIs(scope['BaseS'], self.ns2.BaseS)
+        self.assertIsInstance(scope['AliasedBaseU_validator'], self.sv.Union)
+
+class TestGeneratedPythonWithFrozenTypes(_CodingTests, _GeneratedPythonTestCase):
+    """
+    Runs the encoding and decoding tests against frozen struct and union
+    classes, whose encodings are cached.
+    """
+
+    output_dir = 'output_frozen'
+    backend_args = ['--frozen-types', '--generate-codecs']
+
+    def test_frozen_structs(self):
+        d = self.ns.D(a='A', d=[1, None], e={'k': 'v'})
+        with self.assertRaises(AttributeError):
+            d.a = 'B'
+        with self.assertRaises(AttributeError):
+            del d.c
+        self.assertEqual(d.d, [1, None])
+        self.assertRaises(TypeError, d.d.append, 2)
+        self.assertRaises(TypeError, d.e.update, {'k2': 'v'})
+        self.assertEqual(copy.deepcopy(d.e), {'k': 'v'})
+
+        # Instances of subtypes are sealed once their own fields are set
+        f = self.ns.File(name='f', size=1)
+        self.assertEqual((f.name, f.size), ('f', 1))
+        with self.assertRaises(AttributeError):
+            f.size = 2
+
+        # Union values are read-only as well
+        self.assertRaises(TypeError, self.ns.V.t9(['a']).get_t9().append, 'b')
+
+        # Structs built by decoders and from columns are frozen
+        serialized = self.encode(self.ns.D_validator, d)
+        ds = [self.decode(self.ns.D_validator, serialized),
+              self.ss.json_compat_obj_decode(self.ns.D_validator, json.loads(serialized),
+                                             lazy=True),
+              self.ss.struct_list_from_columns(
+                  self.ns.D_validator, {'a': ['A'], 'd': [[1, None]], 'e': [{'k': 'v'}]})[0]]
+        for d2 in ds:
+            self.assertEqual(self.encode(self.ns.D_validator, d2), serialized)
+            self.assertRaises(TypeError, d2.d.append, 2)
+            with self.assertRaises(AttributeError):
+                d2.a = 'B'
+
+    def test_frozen_encoding_cache(self):
+        d = self.ns.D(a='A', d=[1], e={})
+        list_validator = self.sv.List(self.ns.D_validator)
+        encoded = self.compat_obj_encode(self.ns.D_validator, d)
+        self.assertIs(self.compat_obj_encode(self.ns.D_validator, d), encoded)
+        self.assertIs(self.compat_obj_encode(list_validator, [d])[0], encoded)
+        serialized = self.encode(self.ns.D_validator, d)
+        self.assertIs(self.encode(self.ns.D_validator, d), serialized)
+        self.assertEqual(serialized, json.dumps(encoded))
+
+        # Each configuration has its own encoding, but masked encodings, which
+        # vary by request, are not cached
+        self.assertEqual(self.encode(self.ns.D_validator, d, field_mask=['a']),
+                         json.dumps({'a': 'A'}))
+        self.assertEqual(self.encode(self.ns.D_validator, d), serialized)
+        encodings = len(getattr(d, '_encodings'))
+        self.assertEqual(self.encode(self.ns.D_validator, d, field_mask=['d']),
+                         json.dumps({'d': [1]}))
+        self.assertEqual(len(getattr(d, '_encodings')), encodings)
+        self.assertEqual(self.ss.json_encode(self.ns.D_validator, d, trusted=True), serialized)
+
+        # Invalid instances are not cached
+        d = self.ns.D(d=[], e={})
+        for _ in range(2):
+            self.assertRaises(self.sv.ValidationError, self.encode, self.ns.D_validator, d)
+
+    def test_lazy_decoding(self):
+        # Lazily decoded instances are sealed, but still decode fields when
+        # they are first read.
+        serialized = json.dumps({'a': 'A', 'c': 'C', 'd': [1, None], 'e': {'k': 'v'}})
+        d = self.decode(self.ns.D_validator, serialized, lazy=True)
+        self.assertIn('d', d._lazy_fields)
+        self.assertEqual(d.d, [1, None])
+        self.assertNotIn('d', d._lazy_fields)
+        self.assertRaises(TypeError, d.d.append, 2)
+        with self.assertRaises(AttributeError):
+            d.a = 'B'
+        self.assertEqual(self.encode(self.ns.D_validator, d), serialized)
+
+
+class TestGeneratedPythonWithFusedDecoding(_CodingTests, _GeneratedPythonTestCase):
+    """
+    Runs the encoding and decoding tests with a JSON decoder that parses
+    JSON text straight into Stone objects.
+    """
+
+    output_dir = 'output_fused'
+
+    def setUp(self):
+        super(TestGeneratedPythonWithFusedDecoding, self).setUp()
+        self.decode = functools.partial(self.ss.json_decode, fused=True)
+
+    def test_fused_decoding(self):
+        list_validator = self.sv.List(self.ns.D_validator)
+        serialized = ' [ {"a" : "\\u00e9", "d": [1, null], "e": {"k": null}, "c": "C"},\n'\
+            '{"a": "b", "b": 2, "d": [], "e": {}} ] '
+        ds = self.decode(list_validator, serialized)
+        self.assertEqual(
+            self.encode(list_validator, ds),
+            self.encode(list_validator, self.ss.json_decode(list_validator, serialized)))
+
+        # UTF-8 bytes, bytearrays and memoryviews are decoded as well
+        data = serialized.encode('utf-8')
+        for s in (data, bytearray(data), memoryview(data)):
+            self.assertEqual(self.encode(list_validator, self.decode(list_validator, s)),
+                             self.encode(list_validator, ds))
+
+        # Unions and subtypes are decoded from the scanned objects
+        v = self.ns.V.t10([self.ns.U.t0, self.ns.U.t1('x')])
+        self.assertEqual(self.decode(self.ns.V_validator, self.encode(self.ns.V_validator, v)),
+                         v)
+        s2 = self.ns.S2(f1=self.ns.OptionalS())
+        self.assertEqual(self.encode(self.ns.S2_validator,
+                                     self.decode(self.ns.S2_validator, '{"f1": null}')),
+                         self.encode(self.ns.S2_validator, s2))
+
+        # Unknown fields are skipped if not strict
+        d = self.decode(self.ns.D_validator,
+                        '{"z": {"y": [1, {}]}, "a": "A", "d": [], "e": {}}', strict=False)
+        self.assertEqual(d.a, 'A')
+
+        def error(s, data_type=list_validator):
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                self.decode(data_type, s)
+            return str(cm.exception)
+
+        self.assertEqual(error('[{"a": "A", "d": [], "e": {}, "z": 1}]'), "unknown field 'z'")
+        self.assertEqual(error('[{"a": 1, "d": [], "e": {}}]'),
+                         "a: '1' expected to be a string, got integer")
+        self.assertEqual(error('{}'), 'expected list, got dict')
+        for s in ('[', '[{"a": "A",}]', '[{"a" "A"}]', '[] []', '[{"a": "A"]', b'[\xff]'):
+            self.assertEqual(error(s), 'could not decode input as JSON')
+
+        # Without the internals of the json module, JSONDecoder.raw_decode()
+        # parses values and keys
+        scan_once, scanstring = self.ss._scan_once, self.ss._scanstring
+        self.ss._scan_once, self.ss._scanstring = self.ss._raw_decode, self.ss._raw_scanstring
+        try:
+            self.assertEqual(self.encode(list_validator, self.decode(list_validator, serialized)),
+                             self.encode(list_validator, ds))
+            self.assertEqual(error('[{"a": "A", "d": [], "e": {}, "z": 1}]'),
+                             "unknown field 'z'")
+            for s in ('[', '[{"a": "A",}]', '[{"a" "A"}]', '[{"a": "A}]', '[{"a": }]'):
+                self.assertEqual(error(s), 'could not decode input as JSON')
+        finally:
+            self.ss._scan_once, self.ss._scanstring = scan_once, scanstring
+
+
 # Adapted from:
 # http://code.activestate.com/recipes/306860-proleptic-gregorian-dates-and-strftime-before-1900/
 # Make sure that the day names are in order from 0001/01/01 until
@@ -1507,6 +2837,38 @@ class TestCustomStrftime(unittest.TestCase):
             testdate = testdate + one_day
 
 
+class TestTimestampCodec(unittest.TestCase):
+    def test_specialized_format(self):
+        codec = _get_timestamp_codec('%Y-%m-%dT%H:%M:%SZ')
+        self.assertIs(codec, _get_timestamp_codec('%Y-%m-%dT%H:%M:%SZ'))
+        dt = datetime.datetime(2015, 5, 12, 3, 4, 5)
+        self.assertEqual(codec.format_value(dt), '2015-05-12T03:04:05Z')
+        self.assertEqual(codec.parse('2015-05-12T03:04:05Z'), dt)
+        # Years before 1000 and inputs strptime() accepts but the specialized
+        # parser doesn't, fall back to _strftime() and strptime().
+        old = datetime.datetime(999, 1, 2)
+        self.assertEqual(codec.format_value(old), stone_strftime(old, '%Y-%m-%dT%H:%M:%SZ'))
+        self.assertEqual(codec.parse('2015-5-12T03:04:05z'), dt)
+        for bad in ('2015-02-30T03:04:05Z', '2015-05-12T03:04:05', '2015-05-12T03:04:05Zx'):
+            self.assertRaises(ValueError, codec.parse, bad)
+        self.assertRaises(TypeError, codec.parse, 1)
+
+    def test_partial_and_unordered_formats(self):
+        codec = _get_timestamp_codec('%d/%m/%Y %%')
+        self.assertEqual(codec.parse('12/05/2015 %'), datetime.datetime(2015, 5, 12))
+        self.assertEqual(codec.format_value(datetime.datetime(2015, 5, 12)), '12/05/2015 %')
+        codec = _get_timestamp_codec('%H:%M')
+        self.assertEqual(codec.parse('03:04'), datetime.datetime(1900, 1, 1, 3, 4))
+        self.assertEqual(codec.format_value(datetime.datetime(2015, 5, 12, 3, 4)), '03:04')
+
+    def test_generic_format(self):
+        f = '%a, %d %b %Y %H:%M:%S +0000'
+        codec = _get_timestamp_codec(f)
+        dt = datetime.datetime(2015, 5, 12, 3, 4, 5)
+        self.assertEqual(codec.format_value(dt), dt.strftime(f))
+        self.assertEqual(codec.parse(dt.strftime(f)), dt)
+
+
 class CallerPermissionsTest(CallerPermissionsInterface):
     def __init__(self, permissions):
         self._permissions = permissions
@@ -1702,6 +3064,41 @@ class TestAnnotationsGeneratedPython(unittest.TestCase):
         self.alpha_cp = CallerPermissionsTest(['alpha'])
         self.internal_and_alpha_cp = CallerPermissionsTest(['internal', 'alpha'])
 
+    def test_shared_validators_with_redaction(self):
+        # Redactors are set on the validator, so redacted fields have their own
+        self.assertIs(self.ns3.B._x_validator, self.ns3.UOpen._t6_validator)
+        self.assertIsNot(self.ns3.X._a_validator, self.ns3.B._x_validator)
+        self.assertIsNot(self.ns3.X._a_validator, self.ns3.X._b_validator)
+        self.assertFalse(hasattr(self.ns3.B._x_validator, '_redact'))
+        self.assertIs(self.ns3.S2._a_validator.item_validator, self.ns3.B._x_validator)
+
+    def test_stone_decoder_with_permissions(self):
+        json_data = {
+            'a': 'A',
+            'b': 1,
+            'c': 'C',
+            'd': [{'a': 'A', 'b': 'B'}],
+            'e': {},
+            'f': {'a': 'A', 'b': 'B'},
+            'g': 4,
+        }
+        decoder = self.ss.StoneDecoder(caller_permissions=self.internal_and_alpha_cp)
+        encoder = self.ss.StoneEncoder(caller_permissions=self.internal_and_alpha_cp)
+        for _ in range(2):
+            a = decoder.decode_compat(self.sv.Struct(self.ns3.A), json_data)
+            self.assertEqual((a.c, a.d[0].b, a.f.b, a.g), ('C', 'B', 'B', 4))
+            self.assertEqual(encoder.encode_compat(self.sv.Struct(self.ns3.A), a), json_data)
+
+        # Fields visible to some callers only are unknown to others
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.StoneDecoder().decode_compat(self.sv.Struct(self.ns3.A), json_data)
+        self.assertIn('unknown field', str(cm.exception))
+
+        del json_data['g']
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            decoder.decode_compat(self.sv.Struct(self.ns3.A), json_data)
+        self.assertEqual("missing required field 'g'", str(cm.exception))
+
     def test_struct_parent_decoding(self):
         json_data = {
             'a': 'A',
@@ -3295,6 +4692,34 @@ class TestAnnotationsGeneratedPython(unittest.TestCase):
             self.compat_obj_encode(self.sv.Union(self.ns3.U2), ui,
                 caller_permissions=self.internal_and_alpha_cp, should_redact=True), json_data)
 
+        # Streamed encoding redacts the same way
+        for data_type, obj in ((self.sv.Struct(self.ns3.S2), s),
+                               (self.sv.List(self.sv.Union(self.ns3.U2)), [ui])):
+            self.assertEqual(
+                ''.join(self.ss.json_encode_iter(data_type, obj, chunk_size=1,
+                    caller_permissions=self.internal_and_alpha_cp, should_redact=True)),
+                self.encode(data_type, obj,
+                    caller_permissions=self.internal_and_alpha_cp, should_redact=True))
+
+    def test_encoding_for_log(self):
+        xs = [self.ns3.X(a='TEST-blot-TEST', b='TEST-hash-%d' % (i % 3)) for i in range(10)]
+        ai = self.ns3.A(a='A', b=1, c='C', d=xs, e={'e1': 'e2'}, f=xs[0], g=4)
+        data_type = self.sv.Struct(self.ns3.A)
+        for cp in (self.default_cp, self.internal_cp, self.internal_and_alpha_cp):
+            expected = self.encode(data_type, ai, caller_permissions=cp, should_redact=True)
+            for cache_size in (0, 1, 1024):
+                self.assertEqual(
+                    self.ss.json_encode_for_log(data_type, ai, caller_permissions=cp,
+                                                redaction_cache_size=cache_size),
+                    expected)
+
+        # Cached redactions tell apart values that compare equal
+        apply = self.ss._cache_redactions(self.sv.HashRedactor('').apply, 2)
+        self.assertEqual(apply(1), 'c4ca4238a0b923820dcc509a6f75849b')
+        self.assertEqual(apply(1.0), 'e4c2e8edac362acab7123654b9e73432')
+        self.assertEqual(apply(True), 'f827cf462f62848df37c5e1e94a4da74')
+        self.assertEqual(apply(1), 'c4ca4238a0b923820dcc509a6f75849b')
+
     def test_encoding_unicode_with_redaction(self):
         unicode_val = u"Unicode val'`~$%&\u53c9\u71d2"
 